@@ -0,0 +1,254 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+
+'''
+In process metrics in the Prometheus text format, served on /metrics. Each process keeps its own registry so with
+several workers every process has to be scraped (or the values summed) to get the whole picture.
+'''
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry():
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+registry = MetricsRegistry()
+
+
+'''Base for metrics with a fixed set of label names, one value is kept per combination of label values'''
+class Metric():
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def labelKey(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def formatLabels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escapeLabel(value)}"' for name, value in pairs) + '}'
+
+    def copyValue(self, value):
+        return value
+
+    def render(self):
+        with self.lock:
+            values = [(key, self.copyValue(value)) for key, value in sorted(self.values.items())]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in values:
+            lines += self.samples(key, value)
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.labelKey(labels), 0)
+
+    def samples(self, key, value):
+        return [f"{self.name}{self.formatLabels(key)} {formatValue(value)}"]
+
+
+'''Value that goes up and down, such as a queue depth or a state'''
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.labelKey(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.labelKey(labels), 0)
+
+    def samples(self, key, value):
+        return [f"{self.name}{self.formatLabels(key)} {formatValue(value)}"]
+
+
+'''Histogram with fixed upper bounds, each value is [per bucket counts (the last one is +Inf), sum, count]'''
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=registry):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        key = self.labelKey(labels)
+        index = bisect_left(self.buckets, amount)
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                value = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            value[0][index] += 1
+            value[1] += amount
+            value[2] += 1
+
+    def get(self, **labels):
+        value = self.values.get(self.labelKey(labels))
+        return {'sum': value[1], 'count': value[2]} if value else {'sum': 0, 'count': 0}
+
+    def copyValue(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def samples(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self.formatLabels(key, [('le', formatValue(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{self.formatLabels(key)} {formatValue(total)}")
+        lines.append(f"{self.name}_count{self.formatLabels(key)} {count}")
+        return lines
+
+
+http_requests = Counter('http_requests_total', "Requests per url name, method and status code", ['view', 'method', 'status'])
+http_request_duration = Histogram('http_request_duration_seconds', "Time to build the response per url name", ['view', 'method'])
+http_request_db_queries = Histogram('http_request_db_queries', "SQL queries run per request", ['view'],
+                                    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200))
+http_request_db_duration = Histogram('http_request_db_duration_seconds', "Time spent in SQL per request", ['view'])
+http_request_llm_duration = Histogram('http_request_llm_duration_seconds', "Time spent waiting on the LLM per request", ['view'])
+db_query_duration = Histogram('db_query_duration_seconds', "Duration of single SQL queries")
+
+
+'''Totals for the request being handled, shared with the threads sync_to_async runs its queries in'''
+class RequestStats():
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.llm_seconds = 0.0
+
+
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def currentRequestStats():
+    return _request_stats.get()
+
+
+'''Database execute wrapper timing every query'''
+def timeQuery(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        db_query_duration.observe(elapsed)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += elapsed
+
+
+'''Connections are per thread, so the wrapper is added to each one as it connects'''
+def installQueryTimer(sender=None, connection=connection, **kwargs):
+    if settings.METRICS['ENABLED'] and timeQuery not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timeQuery)
+
+
+connection_created.connect(installQueryTimer)
+
+
+'''Records request latency, SQL and LLM time per url name, works under both WSGI and ASGI'''
+class MetricsMiddleware():
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        installQueryTimer()
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    # Streaming responses are measured until the response starts, not until the last chunk is sent
+    def record(self, request, response, stats, seconds):
+        match = request.resolver_match
+        view = (match.url_name or match.route) if match else 'unmatched'
+        http_requests.inc(view=view, method=request.method, status=response.status_code)
+        http_request_duration.observe(seconds, view=view, method=request.method)
+        http_request_db_queries.observe(stats.queries, view=view)
+        http_request_db_duration.observe(stats.query_seconds, view=view)
+        http_request_llm_duration.observe(stats.llm_seconds, view=view)
+
+
+def metricsView(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
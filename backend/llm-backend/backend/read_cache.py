@@ -0,0 +1,70 @@
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+'''
+Read-through cache of serialized GET payloads. Entries are keyed by user and by the user's current version, and any
+write to the user's rows replaces the version, so stale entries are never read again and simply age out. Versions are
+random rather than counted up, a version evicted from the cache can not come back and revive old entries.
+
+Payloads that depend on only some of the user's rows are kept under a scope with its own version, bumped only by
+writes to those rows.
+
+With several server processes the cache backend has to be shared (database or file), the local backend only sees the
+invalidations of its own process.
+'''
+
+CACHE_ALIAS = 'read'
+# Scope of payloads built from the user's profile and health data alone
+HEALTH_SCOPE = 'health'
+# Scope of the user row authentication reads on every request
+AUTH_SCOPE = 'auth'
+
+
+def cache():
+    return caches[CACHE_ALIAS]
+
+
+def versionKey(user_id, scope=None):
+    return f'version:{user_id}' if scope is None else f'version:{scope}:{user_id}'
+
+
+def currentVersion(user_id, scope=None):
+    key = versionKey(user_id, scope)
+    version = cache().get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        # add rather than set, a concurrent invalidation is not overwritten
+        if not cache().add(key, version, None):
+            version = cache().get(key) or version
+    return version
+
+
+def bumpVersion(user_id, scope=None):
+    cache().set(versionKey(user_id, scope), uuid.uuid4().hex, None)
+
+
+'''
+Invalidates everything cached for the user, or only their payloads under scope, once the current transaction commits.
+Until then other requests still read the old rows, and caching those under the old version is harmless.
+'''
+def invalidateUser(user_id, scope=None):
+    if user_id is not None:
+        transaction.on_commit(partial(bumpVersion, user_id, scope))
+
+
+'''
+Returns the cached payload for (user, name), or builds and caches it, under the version of scope if given. The version is read before the database so a
+payload built from rows that change meanwhile is stored under a version that is already outdated.
+'''
+def cachedRead(user_id, name, build, scope=None):
+    key = f'read:{user_id}:{currentVersion(user_id, scope)}:{name}'
+    payload = cache().get(key)
+    if payload is None:
+        payload = build()
+        cache().set(key, payload, settings.READ_CACHE['TTL'])
+    return payload
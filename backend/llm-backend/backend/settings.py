@@ -13,6 +13,7 @@ import os
 from datetime import timedelta
 from pathlib import Path
 from configparser import ConfigParser
+from corsheaders.defaults import default_headers
 
 
 
@@ -39,12 +40,135 @@ CORS_ALLOW_ALL_ORIGINS = config['Django'].getboolean('CORS_ALLOW_ALL_ORIGINS')
 API_KEY = config['LLM']['API_KEY']
 MODEL_VERSION = config['LLM']['MODEL_VERSION']
 
+# LLM provider, gemini or fake (a local stand in for load testing, see workout.llm_providers.FakeProvider)
+LLM_PROVIDER = config.get('LLM', 'PROVIDER', fallback='gemini')
+LLM_FAKE = {
+    # constant, uniform (MEAN +/- SPREAD) or lognormal (median MEAN, sigma SPREAD), in seconds
+    'LATENCY_DISTRIBUTION': config.get('LLM_FAKE', 'LATENCY_DISTRIBUTION', fallback='constant'),
+    'LATENCY_MEAN': config.getfloat('LLM_FAKE', 'LATENCY_MEAN', fallback=1.0),
+    'LATENCY_SPREAD': config.getfloat('LLM_FAKE', 'LATENCY_SPREAD', fallback=0.0),
+    'ERROR_RATE': config.getfloat('LLM_FAKE', 'ERROR_RATE', fallback=0.0),
+    'SEED': config.getint('LLM_FAKE', 'SEED', fallback=0),
+}
+
+# LLM response cache, BACKEND is one of local, database or none
+LLM_CACHE = {
+    'BACKEND': config.get('LLM_CACHE', 'BACKEND', fallback='local'),
+    'TTL': config.getint('LLM_CACHE', 'TTL', fallback=86400),
+    'MAX_ENTRIES': config.getint('LLM_CACHE', 'MAX_ENTRIES', fallback=1000),
+    # Coalesce identical in-flight requests across processes with a Postgres advisory lock
+    'ADVISORY_LOCK': config.getboolean('LLM_CACHE', 'ADVISORY_LOCK', fallback=False),
+    'LOCK_TIMEOUT': config.getint('LLM_CACHE', 'LOCK_TIMEOUT', fallback=30),
+}
+
+# Deadline, retries, circuit breaker and hedging of llm calls, see workout.llm_resilience. TIMEOUT is per attempt in
+# seconds, HEDGE_DELAY 0 sends no hedged requests
+LLM_RESILIENCE = {
+    'ENABLED': config.getboolean('LLM_RESILIENCE', 'ENABLED', fallback=True),
+    'TIMEOUT': config.getfloat('LLM_RESILIENCE', 'TIMEOUT', fallback=30.0),
+    'MAX_ATTEMPTS': config.getint('LLM_RESILIENCE', 'MAX_ATTEMPTS', fallback=3),
+    'BACKOFF_BASE': config.getfloat('LLM_RESILIENCE', 'BACKOFF_BASE', fallback=0.5),
+    'BACKOFF_MAX': config.getfloat('LLM_RESILIENCE', 'BACKOFF_MAX', fallback=4.0),
+    'BREAKER_FAILURES': config.getint('LLM_RESILIENCE', 'BREAKER_FAILURES', fallback=5),
+    'BREAKER_RESET': config.getfloat('LLM_RESILIENCE', 'BREAKER_RESET', fallback=30.0),
+    'HEDGE_DELAY': config.getfloat('LLM_RESILIENCE', 'HEDGE_DELAY', fallback=0.0),
+    'POOL_SIZE': config.getint('LLM_RESILIENCE', 'POOL_SIZE', fallback=32),
+}
+
+# LLM calls running at once per process, and calls waiting for one of those slots. A call that finds the queue full or
+# waits MAX_WAIT seconds is answered with a 503, see workout.llm_admission
+LLM_ADMISSION = {
+    'ENABLED': config.getboolean('LLM_ADMISSION', 'ENABLED', fallback=True),
+    'MAX_CONCURRENT': config.getint('LLM_ADMISSION', 'MAX_CONCURRENT', fallback=16),
+    'MAX_QUEUE': config.getint('LLM_ADMISSION', 'MAX_QUEUE', fallback=32),
+    'MAX_WAIT': config.getfloat('LLM_ADMISSION', 'MAX_WAIT', fallback=10.0),
+}
+
+# Background workout generation (python manage.py run_workout_worker)
+WORKOUT_JOBS = {
+    'MAX_ATTEMPTS': config.getint('WORKOUT_JOBS', 'MAX_ATTEMPTS', fallback=3),
+    'RETRY_DELAY': config.getint('WORKOUT_JOBS', 'RETRY_DELAY', fallback=5),
+    'LEASE_SECONDS': config.getint('WORKOUT_JOBS', 'LEASE_SECONDS', fallback=300),
+}
+
+# Chat history sent with a workout change, older change requests are condensed into a summary to stay in MAX_TOKENS
+REVISION_HISTORY = {
+    'MAX_TOKENS': config.getint('REVISION_HISTORY', 'MAX_TOKENS', fallback=2000),
+    'RECENT_CHANGES': config.getint('REVISION_HISTORY', 'RECENT_CHANGES', fallback=3),
+}
+
+# Ledger of llm calls, written in batches of BATCH_SIZE or every FLUSH_INTERVAL seconds (see workout.llm_usage).
+# python manage.py rollup_llm_usage deletes ledger rows after RETENTION_DAYS once they are in the daily totals
+LLM_USAGE = {
+    'ENABLED': config.getboolean('LLM_USAGE', 'ENABLED', fallback=True),
+    'BATCH_SIZE': config.getint('LLM_USAGE', 'BATCH_SIZE', fallback=100),
+    'FLUSH_INTERVAL': config.getint('LLM_USAGE', 'FLUSH_INTERVAL', fallback=10),
+    'RETENTION_DAYS': config.getint('LLM_USAGE', 'RETENTION_DAYS', fallback=90),
+}
+
+'''"BURST, PER_MINUTE, CONCURRENT" from the config, see LLM_THROTTLE'''
+def throttleLimit(value):
+    burst, per_minute, concurrent = [part.strip() for part in value.split(',')]
+    return {'BURST': float(burst), 'PER_MINUTE': float(per_minute), 'CONCURRENT': int(concurrent)}
+
+# Rate limits of the llm backed endpoints. Each user gets a token bucket of BURST requests refilled with PER_MINUTE
+# per minute on every endpoint, and CONCURRENT generations in flight at once. LIMITS is keyed by tier (free, premium,
+# staff) or by endpoint.tier to override a tier on one endpoint (workout, change or recommendation)
+LLM_THROTTLE = {
+    'ENABLED': config.getboolean('LLM_THROTTLE', 'ENABLED', fallback=True),
+    # Generations not released by then (e.g. a killed process) stop counting
+    'LEASE_SECONDS': config.getint('LLM_THROTTLE', 'LEASE_SECONDS', fallback=300),
+    'LIMITS': {
+        'free': throttleLimit('10, 5, 2'),
+        'premium': throttleLimit('30, 20, 4'),
+        'staff': throttleLimit('100, 100, 8'),
+        **{key: throttleLimit(value) for key, value in (config.items('LLM_THROTTLE') if config.has_section('LLM_THROTTLE') else [])
+           if key not in ('enabled', 'lease_seconds')},
+    },
+}
+
+# Responses of requests sent with an Idempotency-Key header are replayed to retries for TTL seconds, retries of a
+# request still running wait up to WAIT_TIMEOUT seconds for it
+IDEMPOTENCY = {
+    'ENABLED': config.getboolean('IDEMPOTENCY', 'ENABLED', fallback=True),
+    'TTL': config.getint('IDEMPOTENCY', 'TTL', fallback=86400),
+    'WAIT_TIMEOUT': config.getfloat('IDEMPOTENCY', 'WAIT_TIMEOUT', fallback=60.0),
+}
+
+# Workouts created at once by api/workout/plan/ and how many of them are generated at the same time
+WORKOUT_PLAN = {
+    'MAX_WORKOUTS': config.getint('WORKOUT_PLAN', 'MAX_WORKOUTS', fallback=7),
+    'CONCURRENCY': config.getint('WORKOUT_PLAN', 'CONCURRENCY', fallback=7),
+}
+
+# Workout history list (api/workout/list/), pages are capped at MAX_PAGE_SIZE
+WORKOUT_LIST = {
+    'PAGE_SIZE': config.getint('WORKOUT_LIST', 'PAGE_SIZE', fallback=50),
+    'MAX_PAGE_SIZE': config.getint('WORKOUT_LIST', 'MAX_PAGE_SIZE', fallback=200),
+}
+
+# Prometheus style metrics on /metrics
+METRICS = {
+    'ENABLED': config.getboolean('METRICS', 'ENABLED', fallback=True),
+}
+
+# Access tokens revoked on logout are checked against an in-memory list reloaded every REVOCATION_REFRESH seconds
+AUTH_TOKENS = {
+    'REVOCATION_REFRESH': config.getint('AUTH_TOKENS', 'REVOCATION_REFRESH', fallback=30),
+}
+
 SITE_ID = 1
 
 # Google OAuth
 GOOGLE_OAUTH_CLIENT_ID = config['Google']['CLIENT_ID']
 GOOGLE_OAUTH_CLIENT_SECRET = config['Google']['CLIENT_SECRET']
 GOOGLE_OAUTH_CALLBACK_URL = config['Google']['REDIRECT_URL']
+GOOGLE_AUTH = {
+    # Seconds to wait on Google when fetching signing keys or user info
+    'TIMEOUT': config.getfloat('Google', 'TIMEOUT', fallback=5.0),
+    # Connections to Google kept open per process
+    'POOL_SIZE': config.getint('Google', 'POOL_SIZE', fallback=10),
+}
 
 
 # Application definition
@@ -110,7 +234,7 @@ REST_USE_JWT = True  # Enable to use JWT tokens for authentication
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.AccessTokenAuthentication',
     ],
 }
 
@@ -146,6 +270,7 @@ AUTHENTICATION_BACKENDS = [
 CSRF_USE_SESSIONS = False
 
 MIDDLEWARE = [
+    'backend.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -176,6 +301,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
 
 
 # Database
@@ -192,6 +318,32 @@ DATABASES = {
     }
 }
 
+# Cache of GET payloads per user (backend/read_cache.py). BACKEND is local, file, database or none. local is per
+# process, so use file or database when running several processes. database needs python manage.py createcachetable
+READ_CACHE = {
+    'BACKEND': config.get('READ_CACHE', 'BACKEND', fallback='local'),
+    'LOCATION': config.get('READ_CACHE', 'LOCATION', fallback=''),
+    'TTL': config.getint('READ_CACHE', 'TTL', fallback=3600),
+    'MAX_ENTRIES': config.getint('READ_CACHE', 'MAX_ENTRIES', fallback=10000),
+}
+READ_CACHE_BACKENDS = {
+    'local': ('django.core.cache.backends.locmem.LocMemCache', 'read-cache'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, 'read_cache')),
+    'database': ('django.core.cache.backends.db.DatabaseCache', 'read_cache'),
+    'none': ('django.core.cache.backends.dummy.DummyCache', ''),
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'read': {
+        'BACKEND': READ_CACHE_BACKENDS[READ_CACHE['BACKEND']][0],
+        'LOCATION': READ_CACHE['LOCATION'] or READ_CACHE_BACKENDS[READ_CACHE['BACKEND']][1],
+        'OPTIONS': {'MAX_ENTRIES': READ_CACHE['MAX_ENTRIES']},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -236,6 +388,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # CORS settings
 CORS_ALLOW_CREDENTIALS = True
+# Lets the frontend read the next page link of the workout list, and whether a response was replayed
+CORS_EXPOSE_HEADERS = ['Link', 'Idempotent-Replayed']
+# Lets the frontend retry workout creation and changes safely
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 # CORS_ALLOWED_ORIGINS = [
 #     "http://localhost:5173",  # Frontend URL mentioned by Tom
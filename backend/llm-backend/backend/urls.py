@@ -14,13 +14,19 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from django.urls.conf import include
 
+from .metrics import metricsView
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/workout/', include('workout.urls')),
     path('api/users/', include('users.urls')),
 ]
+
+if settings.METRICS['ENABLED']:
+    urlpatterns.append(path('metrics', metricsView, name='metrics'))
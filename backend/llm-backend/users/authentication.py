@@ -0,0 +1,107 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from backend.read_cache import AUTH_SCOPE, cachedRead
+from users.models import RevokedToken
+
+
+'''
+Revoked access token jtis, kept in memory and reloaded from the RevokedToken table every refresh_interval seconds so
+requests do not query it. A token revoked by another process is honoured after at most refresh_interval seconds,
+one revoked by this process immediately.
+'''
+class RevocationList():
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.jtis = frozenset()
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def isRevoked(self, jti):
+        if self.isStale():
+            self.refresh()
+        return jti in self.jtis
+
+    '''Only one thread reloads a stale list, the others keep using the previous one meanwhile'''
+    def isStale(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.loaded_at is not None and now - self.loaded_at < self.refresh_interval:
+                return False
+            self.loaded_at = now
+            return True
+
+    def refresh(self):
+        jtis = frozenset(RevokedToken.objects.filter(expires__gt=timezone.now()).values_list('jti', flat=True))
+        with self.lock:
+            self.jtis = jtis
+
+    def add(self, jti):
+        with self.lock:
+            self.jtis = self.jtis | {jti}
+
+    def clear(self):
+        with self.lock:
+            self.jtis = frozenset()
+            self.loaded_at = None
+
+
+revoked_tokens = RevocationList(settings.AUTH_TOKENS['REVOCATION_REFRESH'])
+
+
+'''Revokes an access token for every process, its jti is kept until the token would have expired anyway'''
+def revokeAccessToken(token, user):
+    jti = token[api_settings.JTI_CLAIM]
+    RevokedToken.objects.get_or_create(jti=jti, defaults={'user': user, 'expires': datetime_from_epoch(token['exp'])})
+    revoked_tokens.add(jti)
+
+
+# One statement however many sessions the user has, tokens that are already blacklisted are skipped
+BLACKLIST_USER_TOKENS = """
+    INSERT INTO token_blacklist_blacklistedtoken (token_id, blacklisted_at)
+    SELECT id, now() FROM token_blacklist_outstandingtoken
+    WHERE user_id = %s AND expires_at > now()
+    ON CONFLICT (token_id) DO NOTHING
+"""
+
+
+'''Blacklists all of the user's unexpired refresh tokens, returns how many were newly blacklisted'''
+def blacklistUserTokens(user):
+    with connection.cursor() as cursor:
+        cursor.execute(BLACKLIST_USER_TOKENS, [user.id])
+        return cursor.rowcount
+
+
+'''
+Verifies the bearer token once per request and only accepts access tokens. The validated token is request.auth, so
+views read its claims from there instead of decoding the header again.
+'''
+class AccessTokenAuthentication(JWTAuthentication):
+
+    def get_validated_token(self, raw_token):
+        try:
+            # AccessToken checks the signature, the expiry and that token_type is access
+            token = AccessToken(raw_token)
+        except TokenError as e:
+            raise InvalidToken({"detail": "Only valid access tokens are accepted.", "messages": [str(e)]})
+        if revoked_tokens.isRevoked(token.get(api_settings.JTI_CLAIM)):
+            raise InvalidToken({"detail": "Token has been revoked."})
+        return token
+
+    '''
+    The user row comes from the read cache under its own version, invalidated when the user or their profile changes
+    but not by their workouts or logins
+    '''
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        return cachedRead(user_id, 'user', lambda: super(AccessTokenAuthentication, self).get_user(validated_token), AUTH_SCOPE)
@@ -0,0 +1,109 @@
+import re
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v3/userinfo'
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
+
+'''The Google token is invalid, expired, or was not issued to this app'''
+class InvalidGoogleToken(Exception):
+    pass
+
+
+'''Kept for the life of the process so calls to Google reuse their TLS connections'''
+def createSession():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=settings.GOOGLE_AUTH['POOL_SIZE'])
+    session.mount('https://', adapter)
+    return session
+
+
+session = createSession()
+
+
+'''
+Google's ID token signing keys, fetched once and kept for as long as Google's Cache-Control allows. Google rotates the
+keys every few days and publishes the next one ahead of time, a kid that is not in the set refetches it, at most once
+every min_refresh seconds so tokens with made up kids can not make every request call Google.
+'''
+class GoogleKeySet():
+
+    def __init__(self, url=GOOGLE_CERTS_URL, min_refresh=60):
+        self.url = url
+        self.min_refresh = min_refresh
+        self.keys = {}
+        self.expires = 0
+        self.fetched = None
+        self.lock = threading.Lock()
+
+    def getKey(self, kid):
+        with self.lock:
+            now = time.monotonic()
+            stale = now >= self.expires
+            unknown = kid not in self.keys and (self.fetched is None or now - self.fetched >= self.min_refresh)
+            if stale or unknown:
+                try:
+                    self.fetch(now)
+                except requests.RequestException as e:
+                    # Keys that expired a moment ago are still better than failing every login while Google is down
+                    if kid not in self.keys:
+                        raise
+                    print(f"[ERROR]: Refreshing Google signing keys failed, using the cached ones: {str(e)}")
+            key = self.keys.get(kid)
+        if key is None:
+            raise InvalidGoogleToken("Unknown signing key")
+        return key
+
+    def fetch(self, now):
+        response = session.get(self.url, timeout=settings.GOOGLE_AUTH['TIMEOUT'])
+        response.raise_for_status()
+        self.keys = {jwk['kid']: jwt.PyJWK(jwk).key for jwk in response.json()['keys']}
+        self.fetched = now
+        self.expires = now + self.maxAge(response.headers.get('Cache-Control', ''))
+
+    def maxAge(self, cache_control):
+        match = re.search(r'max-age=(\d+)', cache_control)
+        return int(match.group(1)) if match else 3600
+
+    def clear(self):
+        with self.lock:
+            self.keys = {}
+            self.expires = 0
+            self.fetched = None
+
+
+google_keys = GoogleKeySet()
+
+
+'''Verifies a Google ID token locally and returns its claims, only the signing keys are ever fetched from Google'''
+def verifyIdToken(id_token):
+    try:
+        kid = jwt.get_unverified_header(id_token).get('kid')
+        claims = jwt.decode(id_token, google_keys.getKey(kid), algorithms=['RS256'],
+                            audience=settings.GOOGLE_OAUTH_CLIENT_ID, issuer=GOOGLE_ISSUERS)
+    except jwt.PyJWTError as e:
+        raise InvalidGoogleToken(str(e))
+    if not claims.get('email') or not claims.get('email_verified'):
+        raise InvalidGoogleToken("Email address is not verified")
+    return claims
+
+
+'''User info for an OAuth access token, for clients that do not send an ID token. This one needs a call to Google'''
+def fetchUserInfo(access_token):
+    response = session.get(GOOGLE_USERINFO_URL, headers={'Authorization': f'Bearer {access_token}'},
+                           timeout=settings.GOOGLE_AUTH['TIMEOUT'])
+    if response.status_code == 401:
+        raise InvalidGoogleToken("Access token was rejected by Google")
+    response.raise_for_status()
+    user_info = response.json()
+    if not user_info.get('email'):
+        raise InvalidGoogleToken("Access token does not grant the email scope")
+    return user_info
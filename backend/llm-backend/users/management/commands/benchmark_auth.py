@@ -0,0 +1,69 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from users.authentication import AccessTokenAuthentication
+from users.views import IsAccessToken
+from workout.management.commands._benchmark import benchmarkDatabase
+
+
+'''The permission check as it was before AccessTokenAuthentication, it decoded and verified the header a second time'''
+def legacyIsAccessToken(request):
+    token = request.headers.get("Authorization").split(" ")[1]
+    AccessToken(token)
+    return True
+
+
+class Command(BaseCommand):
+    help = ("Measures the per request cost of authenticating a bearer token, comparing JWTAuthentication followed by "
+            "the old IsAccessToken (two decodes) against AccessTokenAuthentication (one decode)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20000, help="Requests authenticated per pipeline")
+        parser.add_argument('--output', help="Optional path to write the results as json")
+
+    def handle(self, *args, **options):
+        with benchmarkDatabase():
+            user = User.objects.create_user(username='benchmark', email='benchmark@example.com', password=None)
+            access = str(RefreshToken.for_user(user).access_token)
+            request = Request(APIRequestFactory().get('/', HTTP_AUTHORIZATION='Bearer ' + access))
+
+            legacy = JWTAuthentication()
+            current = AccessTokenAuthentication()
+            raw = access.encode('utf-8')
+            # Token verification alone, then the whole of authentication including the user lookup
+            pipelines = [
+                ('verify', 'legacy', lambda: legacy.get_validated_token(raw) and legacyIsAccessToken(request)),
+                ('verify', 'current', lambda: current.get_validated_token(raw)),
+                ('full', 'legacy', lambda: legacy.authenticate(request) and legacyIsAccessToken(request)),
+                ('full', 'current', lambda: self.authenticate(current, request)),
+            ]
+            results = [self.run(stage, name, authenticate, options['requests']) for stage, name, authenticate in pipelines]
+
+        for result in results:
+            self.stdout.write(f"{result['stage']:<7} {result['pipeline']:<8} {result['microseconds_per_request']:.1f} us/request")
+        for stage in ('verify', 'full'):
+            legacy_us, current_us = [result['microseconds_per_request'] for result in results if result['stage'] == stage]
+            self.stdout.write(f"{stage:<7} saves {legacy_us - current_us:.1f} us/request ({(1 - current_us / legacy_us) * 100:.0f}%)")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'requests': options['requests'], 'results': results}, f, indent=2)
+
+    def authenticate(self, authenticator, request):
+        user, request.auth = authenticator.authenticate(request)
+        return IsAccessToken().has_permission(request, None)
+
+    def run(self, stage, pipeline, authenticate, count):
+        # Warm up caches, e.g. the revocation list, before timing
+        authenticate()
+        start = time.perf_counter()
+        for _ in range(count):
+            authenticate()
+        seconds = time.perf_counter() - start
+        return {'stage': stage, 'pipeline': pipeline, 'requests': count, 'microseconds_per_request': seconds / count * 1e6}
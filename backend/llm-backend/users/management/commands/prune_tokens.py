@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from users.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = ("Deletes expired refresh tokens from the outstanding and blacklisted token tables, and expired access token "
+            "revocations. Expired tokens are rejected on their expiry alone, so nothing is lost. Deletes in small "
+            "batches so it can run next to the API, e.g. hourly from cron")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Tokens deleted per transaction")
+        parser.add_argument('--pause', type=float, default=0.1, help="Seconds to wait between batches")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        outstanding = self.prune(OutstandingToken.objects.filter(expires_at__lte=now), options, self.deleteOutstanding)
+        revoked = self.prune(RevokedToken.objects.filter(expires__lte=now), options,
+                             lambda ids: RevokedToken.objects.filter(id__in=ids).delete())
+        self.stdout.write(f"Done, deleted {outstanding} expired refresh tokens and {revoked} expired revocations")
+
+    def prune(self, expired, options, delete):
+        deleted = 0
+        while True:
+            # Expired tokens are the oldest, so walking the primary key finds them first
+            ids = list(expired.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                return deleted
+            with transaction.atomic():
+                delete(ids)
+            deleted += len(ids)
+            time.sleep(options['pause'])
+
+    '''Blacklist rows reference the tokens, so they go first'''
+    def deleteOutstanding(self, ids):
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        OutstandingToken.objects.filter(id__in=ids).delete()
@@ -1,8 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
+from backend.read_cache import AUTH_SCOPE, HEALTH_SCOPE, invalidateUser
+
+'''User tiers, each has its own llm rate limits'''
+USER_TIERS = [('free', 'Free'),
+              ('premium', 'Premium')]
+
 class HealthData(models.Model):
     # One-to-One relationship with the UserProfile model
     profile = models.OneToOneField('UserProfile', on_delete=models.CASCADE, related_name="health_data")
@@ -54,13 +60,23 @@ class UserProfile(models.Model):
     # One-to-One relationship with the Django User model
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     is_new = models.BooleanField(default=True) # Flag to check if user has completed registration
+    # Selects the llm rate limits, see settings.LLM_THROTTLE. Staff users get the staff limits whatever their tier
+    tier = models.CharField("Tier", max_length=20, choices=USER_TIERS, default='free')
 
     def __str__(self):
         return self.user.username
 
+
+'''A login only records last_login, which nothing cached depends on'''
+def isLoginOnly(update_fields):
+    return update_fields is not None and set(update_fields) == {'last_login'}
+
+
 # Signal to create or update profile and health data automatically when a user is created or updated
 @receiver(post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
+def create_or_update_user_profile(sender, instance, created, update_fields=None, **kwargs):
+    if isLoginOnly(update_fields):
+        return
     if created:
         # Create the user profile and health data when a new user is created
         profile = UserProfile.objects.create(user=instance)
@@ -76,4 +92,34 @@ def create_or_update_user_profile(sender, instance, created, **kwargs):
         if not hasattr(instance.profile, 'health_data'):
             HealthData.objects.create(profile=instance.profile)
         else:
-            instance.profile.health_data.save()
\ No newline at end of file
+            instance.profile.health_data.save()
+
+
+# Cached profile payloads and authenticated users are invalidated whenever the rows they are built from change
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_cache(sender, instance, update_fields=None, **kwargs):
+    invalidateUser(instance.id)
+    if not isLoginOnly(update_fields):
+        invalidateUser(instance.id, AUTH_SCOPE)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_profile_cache(sender, instance, **kwargs):
+    invalidateUser(instance.user_id)
+    invalidateUser(instance.user_id, HEALTH_SCOPE)
+    invalidateUser(instance.user_id, AUTH_SCOPE)
+
+
+@receiver([post_save, post_delete], sender=HealthData)
+def invalidate_health_data_cache(sender, instance, **kwargs):
+    user_id = UserProfile.objects.filter(id=instance.profile_id).values_list('user_id', flat=True).first()
+    invalidateUser(user_id)
+    invalidateUser(user_id, HEALTH_SCOPE)
+
+
+class RevokedToken(models.Model):
+    '''Access tokens revoked before they expire, read into memory by users.authentication.RevocationList'''
+    jti = models.CharField("Token ID", max_length=255, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="revoked_tokens")
+    expires = models.DateTimeField("Expires", db_index=True)
+    created = models.DateTimeField("Date Revoked", auto_now_add=True)
@@ -4,8 +4,20 @@ from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import RefreshToken
 from unittest.mock import Mock, patch
-from users.models import UserProfile
-from rest_framework.response import Response
+from users.models import RevokedToken, UserProfile
+from users.authentication import AccessTokenAuthentication, RevocationList, revoked_tokens
+from backend.read_cache import invalidateUser
+from django.utils import timezone
+from datetime import timedelta
+from django.core.management import call_command
+from io import StringIO
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from users.google import google_keys
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.test import override_settings
+import jwt
+import time
 
 
 
@@ -13,8 +25,7 @@ User = get_user_model()
 
 class UserGoogleLoginTests(APITestCase):
     @patch('users.views.GoogleLoginView.get_google_user_info')
-    @patch('dj_rest_auth.registration.views.SocialLoginView.post')
-    def test_google_login_new_user(self, mock_super_post, mock_get_google_user_info):
+    def test_google_login_new_user(self, mock_get_google_user_info):
         # Mock the response from the Google API
         mock_get_google_user_info.return_value = {
             'email': 'testuser@example.com',
@@ -22,9 +33,6 @@ class UserGoogleLoginTests(APITestCase):
             'family_name': 'User'
         }
 
-        # Simulate the response from super().post()
-        mock_super_post.return_value = Response(status=status.HTTP_200_OK)
-
         # Now make a request to the Google login endpoint
         url = reverse('auth_social_google')
         data = {'access_token': 'fake-access-token'}
@@ -44,8 +52,7 @@ class UserGoogleLoginTests(APITestCase):
         self.assertIn('refresh', response.data)
 
     @patch('users.views.GoogleLoginView.get_google_user_info')
-    @patch('dj_rest_auth.registration.views.SocialLoginView.post')
-    def test_google_login_existing_user(self, mock_super_post, mock_get_google_user_info):
+    def test_google_login_existing_user(self, mock_get_google_user_info):
         # Create a user that already exists
         existing_user = User.objects.create_user(
             username='testuser',
@@ -61,9 +68,6 @@ class UserGoogleLoginTests(APITestCase):
             'family_name': 'User'
         }
 
-        # Simulate the response from super().post()
-        mock_super_post.return_value = Response(status=status.HTTP_200_OK)
-
         # Now make a request to the Google login endpoint
         url = reverse('auth_social_google')
         data = {'access_token': 'fake-access-token'}
@@ -81,6 +85,63 @@ class UserGoogleLoginTests(APITestCase):
         self.assertIn('refresh', response.data)
 
 
+'''A signing key like Google's, with its public half as a JWK'''
+def googleKey(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    return private_key, dict(jwk, kid=kid, alg='RS256', use='sig')
+
+
+@override_settings(GOOGLE_OAUTH_CLIENT_ID='test-client.apps.googleusercontent.com')
+class GoogleIdTokenLoginTests(APITestCase):
+    def setUp(self):
+        self.keys = [googleKey('key-1'), googleKey('key-2')]
+        self.published = [self.keys[0][1]]
+        google_keys.clear()
+        patcher = patch('users.google.session.get', side_effect=self.certs)
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def certs(self, url, **kwargs):
+        return Mock(status_code=200, headers={'Cache-Control': 'public, max-age=3600'}, json=Mock(return_value={'keys': list(self.published)}))
+
+    def idToken(self, key=0, **claims):
+        now = int(time.time())
+        payload = dict({'iss': 'https://accounts.google.com', 'aud': settings.GOOGLE_OAUTH_CLIENT_ID, 'iat': now, 'exp': now + 3600,
+                        'sub': '1234', 'email': 'testuser@example.com', 'email_verified': True,
+                        'given_name': 'Test', 'family_name': 'User'}, **claims)
+        private_key, jwk = self.keys[key]
+        return jwt.encode(payload, private_key, algorithm='RS256', headers={'kid': jwk['kid']})
+
+    def login(self, id_token):
+        return self.client.post(reverse('auth_social_google'), {'id_token': id_token}, format='json')
+
+    def test_login_verifies_locally(self):
+        response = self.login(self.idToken())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('access', response.data)
+        self.assertEqual(User.objects.get(email='testuser@example.com').first_name, 'Test')
+
+        # The keys are cached, logging in again does not call Google
+        self.assertEqual(self.login(self.idToken()).status_code, status.HTTP_200_OK)
+        self.assertEqual(User.objects.filter(email='testuser@example.com').count(), 1)
+        self.assertEqual(self.get.call_count, 1)
+
+    def test_rotated_key_is_fetched(self):
+        self.assertEqual(self.login(self.idToken()).status_code, status.HTTP_200_OK)
+        self.published.append(self.keys[1][1])
+        google_keys.fetched -= google_keys.min_refresh
+        self.assertEqual(self.login(self.idToken(key=1)).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_invalid_tokens_rejected(self):
+        for token in [self.idToken(aud='another-app'), self.idToken(exp=int(time.time()) - 60),
+                      self.idToken(email_verified=False), self.idToken(key=1), 'not-a-token']:
+            response = self.login(token)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(User.objects.filter(email='testuser@example.com').exists())
+
+
 class UserProfileTests(APITestCase):
     def setUp(self):
         # Create a test user and retrieve tokens
@@ -148,4 +209,99 @@ class UserLogoutTests(APITestCase):
 
         # Assert logout is successful and token is blacklisted
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn('Successfully logged out', response.data['detail'])
\ No newline at end of file
+        self.assertIn('Successfully logged out', response.data['detail'])
+        # The access token used to log out stops working right away
+        response = self.client.get(reverse('user_profile'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class AccessTokenAuthenticationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='testuser@example.com', password='testpassword')
+        self.refresh_token = RefreshToken.for_user(self.user)
+        self.access_token = self.refresh_token.access_token
+        revoked_tokens.clear()
+
+    def test_refresh_token_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(self.refresh_token))
+        response = self.client.get(reverse('user_profile'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revocation_list_is_not_queried_per_request(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(self.access_token))
+        self.assertEqual(self.client.get(reverse('user_profile')).status_code, status.HTTP_200_OK)
+        with patch.object(RevocationList, 'refresh') as refresh:
+            self.assertEqual(self.client.get(reverse('user_profile')).status_code, status.HTTP_200_OK)
+        refresh.assert_not_called()
+
+    def test_user_cache_kept_across_workout_writes_and_logins(self):
+        authentication = AccessTokenAuthentication()
+        authentication.get_user(self.access_token)
+        with self.captureOnCommitCallbacks(execute=True):
+            # What workout writes invalidate, and a login
+            invalidateUser(self.user.id)
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            authentication.get_user(self.access_token)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Updated'
+            self.user.save()
+        self.assertEqual(authentication.get_user(self.access_token).first_name, 'Updated')
+
+    def test_revoked_by_another_process(self):
+        RevokedToken.objects.create(jti=self.access_token['jti'], user=self.user, expires=timezone.now() + timedelta(hours=1))
+        # Picked up on the next reload of the list
+        revoked_tokens.clear()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(self.access_token))
+        response = self.client.get(reverse('user_profile'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenPruningTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='testuser@example.com', password='testpassword')
+        self.refresh_tokens = [RefreshToken.for_user(self.user) for _ in range(3)]
+        self.access_token = str(self.refresh_tokens[0].access_token)
+
+    def test_logout_all(self):
+        self.refresh_tokens[1].blacklist()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        response = self.client.post(reverse('auth_logout_all'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['detail'], 'Logged out of 2 sessions.')
+        self.assertEqual(BlacklistedToken.objects.filter(token__user=self.user).count(), 3)
+
+        # None of the sessions can refresh any more
+        response = self.client.post(reverse('auth_token_refresh'), {'refresh': str(self.refresh_tokens[2])}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_prune_expired_tokens(self):
+        self.refresh_tokens[0].blacklist()
+        expired = [token['jti'] for token in self.refresh_tokens[:2]]
+        OutstandingToken.objects.filter(jti__in=expired).update(expires_at=timezone.now() - timedelta(minutes=1))
+        RevokedToken.objects.create(jti='expired', user=self.user, expires=timezone.now() - timedelta(minutes=1))
+
+        call_command('prune_tokens', '--batch-size', '1', '--pause', '0', stdout=StringIO())
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), [self.refresh_tokens[2]['jti']])
+        self.assertFalse(BlacklistedToken.objects.exists())
+        self.assertFalse(RevokedToken.objects.exists())
+
+
+class ProfileReadCacheTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='testuser@example.com', password='testpassword')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+
+    def test_profile_reads_are_cached_until_updated(self):
+        url = reverse('user_profile')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['first_name'], '')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(url, {'first_name': 'Updated', 'health_data': {'height': 1.8}}, format='json')
+        response = self.client.get(url)
+        self.assertEqual(response.data['first_name'], 'Updated')
+        self.assertEqual(response.data['health_data']['height'], 1.8)
@@ -1,5 +1,5 @@
 from django.urls import path, include
-from .views import GoogleLoginView, UserProfileView, UserLogoutView
+from .views import GoogleLoginView, UserProfileView, UserLogoutView, UserLogoutAllView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 urlpatterns = [
@@ -12,6 +12,7 @@ urlpatterns = [
 
     # Logout (JWT-specific logout endpoint)
     path('auth/logout/', UserLogoutView.as_view(), name='auth_logout'),  # Custom JWT logout
+    path('auth/logout/all/', UserLogoutAllView.as_view(), name='auth_logout_all'),  # Log out every session of the user
 
     # JWT token actions (obtain and refresh)
     # path('auth/token/', TokenObtainPairView.as_view(), name='auth_token_obtain'),  # Obtain JWT tokens
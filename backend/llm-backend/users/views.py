@@ -1,9 +1,5 @@
-from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
-from allauth.socialaccount.providers.oauth2.client import OAuth2Client
-
-from dj_rest_auth.registration.views import SocialLoginView
-
-from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
 from django.shortcuts import render
 from rest_framework import status
 from rest_framework.response import Response
@@ -13,126 +9,122 @@ import requests
 from django.core.exceptions import ObjectDoesNotExist
 from users.models import User, UserProfile
 from users.serializers import UserProfileSerializer
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import TokenError
-from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import BasePermission
 from rest_framework_simplejwt.tokens import AccessToken
+from backend.read_cache import cachedRead
 from backend.settings import SIMPLE_JWT
+from users.authentication import blacklistUserTokens, revokeAccessToken
+from users.google import InvalidGoogleToken, fetchUserInfo, verifyIdToken
 
 
 
 class IsAccessToken(BasePermission):
     """
     Custom permission to only allow access if the token is an access token.
+    The token was already verified by AccessTokenAuthentication, this only checks what it left in request.auth.
     """
 
     def has_permission(self, request, view):
-        # Extract the token from the request header
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            token = auth_header.split(" ")[1]
-            try:
-                # Try to decode it as an access token
-                AccessToken(token)
-                return True
-            except TokenError:
-                raise AuthenticationFailed("Only access tokens are accepted.")
-        raise AuthenticationFailed("Invalid token format or missing Authorization header.")
-
-
-class GoogleLoginView(SocialLoginView):
-    adapter_class = GoogleOAuth2Adapter
-    callback_url = settings.GOOGLE_OAUTH_CALLBACK_URL
-    client_class = OAuth2Client
-
-    def post(self, request, *args, **kwargs):
-        # Call the parent method to handle the token exchange with Google
-        response = super().post(request, *args, **kwargs)
+        if isinstance(request.auth, AccessToken):
+            return True
+        raise AuthenticationFailed("Only access tokens are accepted.")
 
-        # Get access token from request data
-        access_token = request.data.get("access_token")
-        expires_in = SIMPLE_JWT.get('ACCESS_TOKEN_LIFETIME').total_seconds()
-        # Fetch user data from Google using the access token
-        google_user_data = self.get_google_user_info(access_token)
 
-        # Extract the email from the Google user data
-        email = google_user_data.get('email')
+class GoogleLoginView(APIView):
+    """
+    Logs in with a Google ID token ("id_token"), verified locally against Google's cached signing keys. Clients that
+    only have an OAuth access token ("access_token") are looked up on Google's userinfo endpoint instead.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
 
-        # Check if a user with this email already exists
+    def post(self, request, *args, **kwargs):
+        expires_in = SIMPLE_JWT.get('ACCESS_TOKEN_LIFETIME').total_seconds()
         try:
-            user = User.objects.get(email=email)
-            print(f"User {email} found, logging in.")
-            
-            # Ensure the user has a profile, create one if it doesn't exist
-            # Ensure the user has a profile, create one if it doesn't exist
-            profile, created = UserProfile.objects.get_or_create(user=user)
-            health_data = profile.health_data
-
-            # Check if any key fields in health_data are populated
-            if health_data and all([
-                health_data.dob, 
-                health_data.gender, 
-                health_data.height, 
-                health_data.weight, 
-                health_data.favourite_workout_type, 
-                health_data.workout_experience
-            ]):
-                # If all essential health data fields are populated, set is_new to False
-                if profile.is_new:
-                    profile.is_new = False
-                    profile.save()
-                    print(f"User {email} is has been registered; 'is_new' set to False.")
+            if request.data.get("id_token"):
+                google_user_data = verifyIdToken(request.data["id_token"])
+            elif request.data.get("access_token"):
+                google_user_data = self.get_google_user_info(request.data["access_token"])
             else:
-                print(f"User {email} is marked as new; health data is incomplete.")
+                return Response({"error": "id_token or access_token is required."}, status=status.HTTP_400_BAD_REQUEST)
+        except InvalidGoogleToken as e:
+            print(f"[ERROR]: Google login rejected: {str(e)}")
+            return Response({"error": "Invalid Google token."}, status=status.HTTP_401_UNAUTHORIZED)
+        except requests.RequestException as e:
+            print(f"[ERROR]:{str(e)}")
+            return Response({"error": "Google login is unavailable, try again later."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        # The user, their profile and the outstanding refresh token are written together or not at all
+        with transaction.atomic():
+            user = self.get_or_create_user(google_user_data)
+            refresh = RefreshToken.for_user(user)
+
+        return Response({"access": str(refresh.access_token), "refresh": str(refresh), "expires": expires_in}, status=status.HTTP_200_OK)
+
+    def get_or_create_user(self, google_user_data):
+        email = google_user_data.get('email')
 
-        except ObjectDoesNotExist:
-            # No existing user found, create a new user
-            user = User.objects.create_user(
-                username=email,
-                email=email,
-                first_name=google_user_data.get('given_name'),
-                last_name=google_user_data.get('family_name'),
-                password=None  # No password needed since we are using social login (Google
-
-            )
-            # Create a profile for the new user, checking if it already exists to avoid duplicate issues
-            UserProfile.objects.get_or_create(user=user)
+        # Check if a user with this email already exists, with its profile and health data in the same query
+        user = User.objects.select_related('profile__health_data').filter(email=email).order_by('id').first()
+        if user is None:
+            # No existing user found, create a new user. Creating the user also creates its profile and health data
+            user, _ = User.objects.get_or_create(username=email, defaults={
+                'email': email,
+                'first_name': google_user_data.get('given_name') or '',
+                'last_name': google_user_data.get('family_name') or '',
+                'password': make_password(None),  # No password needed since we are using social login (Google)
+            })
             print(f"New user {email} created and logged in.")
+            return user
 
-        # Generate JWT tokens (access and refresh) for the user
-        refresh = RefreshToken.for_user(user)
-        tokens = {
-            'refresh': str(refresh),
-            'access': str(refresh.access_token),
-        }
-
-
-        return Response({"access": tokens['access'], "refresh": tokens['refresh'],"expires": expires_in}, status=status.HTTP_200_OK)
+        print(f"User {email} found, logging in.")
+        # Ensure the user has a profile, create one if it doesn't exist
+        try:
+            profile = user.profile
+        except UserProfile.DoesNotExist:
+            profile = UserProfile.objects.create(user=user)
+        health_data = getattr(profile, 'health_data', None)
+
+        # Check if any key fields in health_data are populated
+        if health_data and all([
+            health_data.dob,
+            health_data.gender,
+            health_data.height,
+            health_data.weight,
+            health_data.favourite_workout_type,
+            health_data.workout_experience
+        ]):
+            # If all essential health data fields are populated, set is_new to False
+            if profile.is_new:
+                profile.is_new = False
+                profile.save(update_fields=['is_new'])
+                print(f"User {email} is has been registered; 'is_new' set to False.")
+        else:
+            print(f"User {email} is marked as new; health data is incomplete.")
+        return user
 
     def get_google_user_info(self, access_token):
         """
         This method fetches the user information from Google using the access token.
         """
-        response = requests.get(
-            'https://www.googleapis.com/oauth2/v3/userinfo',
-            headers={'Authorization': f'Bearer {access_token}'}
-        )
-        return response.json()
-      
+        return fetchUserInfo(access_token)
 
 
 class UserProfileView(APIView):
     permission_classes = [IsAuthenticated, IsAccessToken] # Ensures only authenticated users using access token can access this API
 
     def get(self, request):
-        # Fetch the user's profile
+        # Fetch the user's profile, served from the read cache until the user, profile or health data change
         try:
-            profile = request.user.profile
-            serializer = UserProfileSerializer(profile)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            data = cachedRead(request.user.id, 'profile', lambda: UserProfileSerializer(
+                UserProfile.objects.select_related('user', 'health_data').get(user=request.user)).data)
+            return Response(data, status=status.HTTP_200_OK)
         except UserProfile.DoesNotExist:
             return Response({"error": "Profile not found."}, status=status.HTTP_404_NOT_FOUND)
 
@@ -177,18 +169,13 @@ class UserLogoutView(APIView):
             refresh_token = request.data.get('refresh')
             token = RefreshToken(refresh_token)
 
-            # Try to fetch the token from OutstandingToken
-            try:
-                outstanding_token = OutstandingToken.objects.get(token=str(token))
-                # Check if the refresh token is already blacklisted
-                if BlacklistedToken.objects.filter(token=outstanding_token).exists():
-                    return Response({"detail": "Refresh token is already blacklisted."}, status=status.HTTP_400_BAD_REQUEST)
-            except OutstandingToken.DoesNotExist:
-                # If it's not in the OutstandingToken, blacklist it directly
-                pass
-
-            # Blacklist the token
+            # Look the token up by its indexed jti rather than comparing the whole token string
+            if BlacklistedToken.objects.filter(token__jti=token[api_settings.JTI_CLAIM]).exists():
+                return Response({"detail": "Refresh token is already blacklisted."}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Blacklist the token, and revoke the access token used for this request so it stops working right away
             token.blacklist()
+            revokeAccessToken(request.auth, request.user)
             return Response({"detail": "Successfully logged out."}, status=status.HTTP_200_OK)
 
         except TokenError:
@@ -197,6 +184,15 @@ class UserLogoutView(APIView):
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class UserLogoutAllView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    def post(self, request):
+        # Blacklists every refresh token of the user, so no session can get a new access token
+        sessions = blacklistUserTokens(request.user)
+        revokeAccessToken(request.auth, request.user)
+        return Response({"detail": f"Logged out of {sessions} sessions."}, status=status.HTTP_200_OK)
+
 
 def index(request):
     return render(request, 'users/')
\ No newline at end of file
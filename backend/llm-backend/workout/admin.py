@@ -1,3 +1,20 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import LlmUsageDaily
+
+
+# Daily llm usage totals, heaviest days first
+class LlmUsageDailyAdmin(admin.ModelAdmin):
+    list_display = ('day', 'user_id', 'endpoint', 'model_version', 'calls', 'errors', 'prompt_tokens', 'response_tokens')
+    list_filter = ('day', 'endpoint', 'model_version')
+    search_fields = ('user_id',)
+    ordering = ('-day', '-prompt_tokens')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(LlmUsageDaily, LlmUsageDailyAdmin)
@@ -0,0 +1,186 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException, PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from users.views import IsAccessToken
+from .idempotency import idempotentAsync
+from .llm_connection import LlmConnection
+from .llm_cache import requestAllowsCache
+from .llm_usage import requestEndpoint
+from .throttling import LlmThrottle
+from .streaming import eventStreamResponse, workoutEventStreamAsync
+from .recommendations import createRecommendationAsync
+from .handlers import (WorkoutPatch, createPlan, finishCreateWorkout, foundRecommendation, generateWithinAsync,
+                       recommendationResponse, saveWorkout, startCreateWorkout, validWorkout)
+
+
+'''
+Async versions of the llm backed workout endpoints. These are meant to be served through backend/asgi.py so that
+requests waiting on Gemini do not hold a worker thread each. DRF's APIView is sync only, so authentication and the
+access token check are run here before dispatching to the async handler. The handlers share everything but the llm
+call with the sync views through handlers.py, their DRF Responses are rendered here.
+'''
+class AsyncAPIView(View):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authenticated like the DRF views, so csrf does not apply
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user, request.auth = await sync_to_async(self.authenticate)(request)
+            if request.user is None:
+                return JsonResponse({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
+            for permission_class in self.permission_classes:
+                permission = permission_class()
+                if not permission.has_permission(request, self):
+                    raise PermissionDenied(getattr(permission, 'message', None))
+            request.data = json.loads(request.body) if request.body else {}
+        except APIException as e:
+            return self.exceptionResponse(e)
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON body."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            response = await super().dispatch(request, *args, **kwargs)
+        except APIException as e:
+            return self.exceptionResponse(e)
+        return self.render(response) if isinstance(response, Response) else response
+
+    '''Renders a DRF Response as APIView would with the JSON renderer'''
+    def render(self, response):
+        rendered = HttpResponse(JSONRenderer().render(response.data), status=response.status_code, content_type='application/json')
+        for name, value in response.items():
+            if name.lower() != 'content-type':
+                rendered[name] = value
+        return rendered
+
+    '''DRF exceptions as DRF would send them, throttled requests get their Retry-After'''
+    def exceptionResponse(self, e):
+        data = e.detail if isinstance(e.detail, (list, dict)) else {"detail": e.detail}
+        headers = {"Retry-After": str(e.wait)} if getattr(e, 'wait', None) is not None else None
+        return self.render(Response(data, status=e.status_code, headers=headers))
+
+    '''Runs the configured DRF authentication classes, returns the user and the validated token or (None, None)'''
+    def authenticate(self, request):
+        for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+            user_auth = authenticator().authenticate(request)
+            if user_auth is not None:
+                return user_auth
+        return None, None
+
+
+class AsyncCreateWorkoutView(AsyncAPIView):
+
+    '''Create Workout'''
+    @idempotentAsync
+    async def post(self, request):
+        serializer, response = await sync_to_async(startCreateWorkout)(request)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        workout, failed = await generateWithinAsync(LlmThrottle(request.user, 'workout'), 'Workout',
+                                                    lambda: llm.requestWorkoutAsync(serializer))
+        if failed is not None:
+            return failed
+        return await sync_to_async(finishCreateWorkout)(request, serializer, workout)
+
+
+class AsyncWorkoutPlanView(AsyncAPIView):
+
+    '''Create several workouts at once, the plan's generations run concurrently in a thread pool like the sync view'''
+    @idempotentAsync
+    async def post(self, request):
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        return await sync_to_async(createPlan)(request, llm)
+
+
+class AsyncCreateWorkoutStreamView(AsyncAPIView):
+
+    '''Create Workout, streaming the llm response as Server-Sent Events'''
+    async def post(self, request):
+        serializer, response = await sync_to_async(validWorkout)(request)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        save = lambda text: saveWorkout(request, serializer, text)
+        stream = workoutEventStreamAsync(llm.requestWorkoutStreamAsync(serializer), save)
+
+        # Taken once nothing is left to fail before the stream releases it
+        throttle = LlmThrottle(request.user, 'workout')
+        await sync_to_async(throttle.acquire)()
+        return eventStreamResponse(throttle.releaseAfterAsync(stream))
+
+
+class AsyncWorkoutStreamView(AsyncAPIView):
+
+    '''Patch Workout, streaming the revised workout as Server-Sent Events'''
+    async def patch(self, request, id):
+        workout_patch = WorkoutPatch(request, id)
+        response = await sync_to_async(workout_patch.start)(require_changes=True)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(user = request.user, endpoint = requestEndpoint(request))
+        chat_history = await sync_to_async(workout_patch.chatHistory)()
+        stream = workoutEventStreamAsync(llm.changeWorkoutStreamAsync(chat_history), workout_patch.save)
+
+        # Taken once nothing is left to fail before the stream releases it
+        throttle = LlmThrottle(request.user, 'change')
+        await sync_to_async(throttle.acquire)()
+        return eventStreamResponse(throttle.releaseAfterAsync(stream))
+
+
+class AsyncWorkoutView(AsyncAPIView):
+
+    '''Patch Workout'''
+    @idempotentAsync
+    async def patch(self, request, id):
+        workout_patch = WorkoutPatch(request, id)
+        response = await sync_to_async(workout_patch.start)()
+        if response is not None:
+            return response
+        if not workout_patch.changesWorkout():
+            return await sync_to_async(workout_patch.finish)()
+
+        llm = LlmConnection(user = request.user, endpoint = requestEndpoint(request))
+        chat_history = await sync_to_async(workout_patch.chatHistory)()
+        new_workout, failed = await generateWithinAsync(LlmThrottle(request.user, 'change'), 'Workout',
+                                                        lambda: llm.changeWorkoutAsync(chat_history))
+        if failed is not None:
+            return failed
+        return await sync_to_async(workout_patch.finish)(new_workout)
+
+
+class AsyncWorkoutRecommendation(AsyncAPIView):
+
+    async def get(self, request):
+        #Search for recos from today
+        day = timezone.localdate()
+        response = await sync_to_async(foundRecommendation)(request, day)
+        if response is not None:
+            return response
+
+        #If not reco for today, create one
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        # Rate limited once it is known this request generates it, not while waiting on another one that does
+        throttle = LlmThrottle(request.user, 'recommendation')
+        recommendation, failed = await generateWithinAsync(None, 'Recommendation',
+                                                           lambda: createRecommendationAsync(request.user, day, llm, throttle))
+        if failed is not None:
+            return failed
+        return await sync_to_async(recommendationResponse)(recommendation)
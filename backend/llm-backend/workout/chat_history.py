@@ -0,0 +1,83 @@
+from django.conf import settings
+
+from workout.models import Workout
+from .llm_config import history_request, history_summary, history_summary_separator, workout_keys
+from .llm_metrics import estimateTokens
+from .prompts import fieldLines
+
+
+'''
+Chat history sent with a workout change, kept within a token budget however many times the workout was revised. It
+holds the parameters the workout was created with, the latest generated workout and the most recent change requests.
+Older change requests are condensed into a summary that is stored on the workout, each one is folded in only once.
+The summary is only written by saveSummary, in the transaction that saves the revision it was built for.
+'''
+class ChatHistory():
+
+    def __init__(self, workout, history, max_tokens=None, recent_changes=None):
+        self.workout = workout
+        self.history = history
+        self.max_tokens = max_tokens or settings.REVISION_HISTORY['MAX_TOKENS']
+        self.recent_changes = settings.REVISION_HISTORY['RECENT_CHANGES'] if recent_changes is None else recent_changes
+        # (summary, seq) built for this change and not saved yet
+        self.new_summary = None
+
+    '''(seq, text) of the saved change requests in history'''
+    def savedChanges(self):
+        return [(seq, text) for seq, kind, text in self.history.revisions if kind == 'change']
+
+    '''
+    Returns the history for a change with the new change requests, which are always sent. Folds change requests
+    that dropped out of the recent ones into the summary, to be saved with saveSummary.
+    '''
+    def build(self, changes):
+        saved = self.savedChanges()
+        split = max(len(saved) - max(self.recent_changes - len(changes), 0), 0)
+        recent = [text for seq, text in saved[split:]]
+        self.summarize(saved[:split])
+
+        request = history_request + fieldLines(workout_keys, lambda key: getattr(self.workout, key))
+        summary = self.workout.history_summary or None
+        latest = self.history.workouts[-1:]
+
+        # Recent change requests take the budget before the summary, the oldest of them are dropped first
+        budget = self.max_tokens - sum(estimateTokens(part) for part in [request] + latest + changes)
+        while recent and estimateTokens(''.join(recent)) > budget:
+            recent = recent[1:]
+        budget -= estimateTokens(''.join(recent))
+        if summary is not None:
+            summary = self.trim(summary, budget - estimateTokens(history_summary))
+
+        turns = [{"role": "user", "parts": [request] + ([history_summary + summary] if summary else []) + recent + changes}]
+        if latest:
+            turns.append({"role": "model", "parts": latest})
+        return turns
+
+    '''Folds saved change requests that are no longer sent in full into the stored summary'''
+    def summarize(self, older):
+        new = [(seq, text) for seq, text in older if seq > self.workout.history_summary_seq]
+        if not new:
+            return
+        texts = ([self.workout.history_summary] if self.workout.history_summary else []) + [' '.join(text.split()) for seq, text in new]
+        # The summary gets at most half of the budget, the oldest requests are dropped first
+        summary = self.trim(history_summary_separator.join(texts), self.max_tokens // 2)
+        seq = new[-1][0]
+        self.new_summary = (summary, seq)
+        # So a later save of the instance keeps them
+        self.workout.history_summary = summary
+        self.workout.history_summary_seq = seq
+
+    '''Stores the summary build made, call it in the transaction that saves the change'''
+    def saveSummary(self):
+        if self.new_summary is not None:
+            summary, seq = self.new_summary
+            Workout.objects.filter(id=self.workout.id).update(history_summary=summary, history_summary_seq=seq)
+            self.new_summary = None
+
+    '''Cuts text from the front at a separator until it fits in tokens, None if nothing fits'''
+    def trim(self, text, tokens):
+        if tokens <= 0:
+            return None
+        while estimateTokens(text) > tokens and history_summary_separator in text:
+            text = text.split(history_summary_separator, 1)[1]
+        return text if estimateTokens(text) <= tokens else None
@@ -0,0 +1,182 @@
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.response import Response
+
+from workout.models import Workout, WorkoutJob
+from workout.serializers import WorkoutSerializer, RecommendationSerializer, WorkoutJobSerializer
+from .chat_history import ChatHistory
+from .jobs import requestPrefersAsync
+from .llm_resilience import LlmUnavailable
+from .plans import WorkoutPlanSerializer, generatePlan
+from .recommendations import findRecommendation, noHistoryRecommendation
+from .revisions import RevisionConflict, changeHistory, createWorkout
+from .throttling import LlmThrottle
+
+
+'''
+Request handling shared by the llm backed views (views.py) and their async variants (async_views.py). Everything but
+the llm call lives here, so both validate, rate limit, save and answer a request the same way. Handlers return DRF
+Responses, which AsyncAPIView renders like APIView does.
+'''
+
+
+'''Logs a failed generation, the client gets a 500'''
+def generationFailed(e, what):
+    print(f"[ERROR]:{str(e)}" )
+    if hasattr(e, 'code'):
+        print(f"[ERROR CODE]: {e.code}")
+    return Response({"error": f"{what} Generation Failed"}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+'''
+Runs generate within the user's rate limit (throttle), over it is a 429 raised before the llm is called. throttle is
+None when generate charges the rate limit itself. Returns (result, None), or (None, response) when the generation
+failed. An unavailable llm is raised on and sent as a 503 with Retry-After.
+'''
+def generateWithin(throttle, what, generate):
+    with throttle or nullcontext():
+        try:
+            return generate(), None
+        except LlmUnavailable:
+            raise
+        except Exception as e:
+            return None, generationFailed(e, what)
+
+
+async def generateWithinAsync(throttle, what, generate):
+    if throttle is not None:
+        await sync_to_async(throttle.acquire)()
+    try:
+        return await generate(), None
+    except LlmUnavailable:
+        raise
+    except Exception as e:
+        return None, generationFailed(e, what)
+    finally:
+        if throttle is not None:
+            await sync_to_async(throttle.release)()
+
+
+'''Validates a workout to create, returns (serializer, None) or (None, 400 response)'''
+def validWorkout(request):
+    serializer = WorkoutSerializer(data=request.data)
+    if not serializer.is_valid():
+        return None, Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    return serializer, None
+
+
+'''Saves a created workout with its generated text, returns its data'''
+def saveWorkout(request, serializer, text):
+    createWorkout(serializer, text, user=request.user)
+    return serializer.data
+
+
+'''
+Checks a create workout request. Returns (serializer, None) when the workout is to be generated now, or (None, response)
+when it is invalid or queued for a worker with Prefer: respond-async.
+'''
+def startCreateWorkout(request):
+    serializer, response = validWorkout(request)
+    if response is not None or not requestPrefersAsync(request):
+        return serializer, response
+
+    # Opt in background generation, the workout is filled in by a worker
+    with transaction.atomic():
+        # Queued and running jobs count against the user's rate limit like requests generating right now
+        LlmThrottle(request.user, 'workout').acquireJob()
+        workout = serializer.save(user=request.user, generation_status='pending')
+        job = WorkoutJob.objects.create(workout=workout)
+    data = WorkoutJobSerializer(job).data
+    data['status_url'] = reverse('workout-job', args=[job.id])
+    return None, Response(data, status=status.HTTP_202_ACCEPTED, headers={"Location": data['status_url']})
+
+
+def finishCreateWorkout(request, serializer, text):
+    return Response(saveWorkout(request, serializer, text), status=status.HTTP_201_CREATED)
+
+
+'''
+A patch of one of the user's workouts. start looks it up and validates the body, and for change requests reads the
+history they are sent with. The views then generate the revised workout from chatHistory and save it.
+'''
+class WorkoutPatch():
+
+    def __init__(self, request, id):
+        self.request = request
+        self.id = id
+        self.history = None
+
+    '''Returns the response to send instead when the patch cannot go ahead, None otherwise'''
+    def start(self, require_changes=False):
+        try:
+            self.workout = Workout.objects.select_related('user').get(user=self.request.user, id=self.id)
+        except Workout.DoesNotExist:
+            return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        self.serializer = WorkoutSerializer(self.workout, data=self.request.data, partial=True)
+        if not self.serializer.is_valid():
+            return Response(self.serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if require_changes and not self.changesWorkout():
+            return Response({"error": "llm_suggested_changes is required to stream a revision."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if self.changesWorkout():
+            #Send the change requests with the workout history, the new ones are saved as a revision
+            print("[INFO]: Changing workout. Generating history")
+            # Only what the prompt sends, the response reads the full history
+            self.history = changeHistory(self.workout)
+            self.changes = self.serializer.validated_data.get("llm_suggested_changes")
+        return None
+
+    # Only contacts the llm if sending suggested changes
+    def changesWorkout(self):
+        return "llm_suggested_changes" in self.request.data
+
+    def chatHistory(self):
+        self.chat_history = ChatHistory(self.workout, self.history)
+        return self.chat_history.build(self.changes)
+
+    '''Saves the patch and the revised workout if there is one, raises RevisionConflict. Returns the workout's data'''
+    def save(self, text=None):
+        with transaction.atomic():
+            if self.history is not None:
+                self.history.append(self.changes, text)
+                self.chat_history.saveSummary()
+            self.serializer.save()
+        return self.serializer.data
+
+    def finish(self, text=None):
+        try:
+            data = self.save(text)
+        except RevisionConflict:
+            return Response({"error": "Workout was changed by another request."}, status=status.HTTP_409_CONFLICT)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+'''Today's recommendation if one was made, usually precomputed by python manage.py precompute_recommendations'''
+def foundRecommendation(request, day):
+    recommendation = findRecommendation(request.user, day)
+    return None if recommendation is None else recommendationResponse(recommendation)
+
+
+'''A recommendation, or the one for users with no workouts yet when there is None'''
+def recommendationResponse(recommendation):
+    if recommendation is None:
+        recommendation = noHistoryRecommendation()
+    return Response(RecommendationSerializer(recommendation).data, status=status.HTTP_200_OK)
+
+
+'''Creates several workouts at once, e.g. a week of them, generated concurrently. 207 when some of them failed'''
+def createPlan(request, llm):
+    serializer = WorkoutPlanSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # Every workout of the plan counts against the user's rate limit
+    results = generatePlan(request.user, serializer.validated_data['workouts'], llm, LlmThrottle(request.user, 'plan'))
+
+    created = all(result['status'] == status.HTTP_201_CREATED for result in results)
+    return Response({"results": results}, status=status.HTTP_201_CREATED if created else status.HTTP_207_MULTI_STATUS)
@@ -0,0 +1,148 @@
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from workout.models import IdempotencyRecord
+from .llm_singleflight import AdvisoryLock
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Response headers replayed along with the body
+STORED_HEADERS = ('Location',)
+# Retry-After of a retry that gave up waiting on the original request
+IN_PROGRESS_WAIT = 5
+
+
+'''sha256 of what makes two requests the same request: method, path and body'''
+def requestFingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method}|{request.path}|{body}'.encode('utf-8')).hexdigest()
+
+
+'''Serializes the requests of a user sent with the same key across threads and processes'''
+def idempotencyLock(user, key):
+    lock_key = hashlib.sha256(f'idempotency|{user.id}|{key}'.encode('utf-8')).hexdigest()
+    return AdvisoryLock(lock_key, settings.IDEMPOTENCY['WAIT_TIMEOUT'])
+
+
+'''Final answers are kept, server errors and rate limits are not so the client can try the same key again'''
+def isStorable(response):
+    return response.status_code < 500 and response.status_code != status.HTTP_429_TOO_MANY_REQUESTS
+
+
+def replay(record):
+    headers = dict(record.headers)
+    headers[REPLAYED_HEADER] = 'true'
+    return Response(record.body, status=record.status_code, headers=headers)
+
+
+def storeResponse(user, key, fingerprint, response):
+    now = timezone.now()
+    IdempotencyRecord.objects.filter(user=user, expires__lte=now).exclude(key=key).delete()
+    IdempotencyRecord.objects.update_or_create(user=user, key=key, defaults={
+        'fingerprint': fingerprint,
+        'status_code': response.status_code,
+        'body': response.data,
+        'headers': {name: response[name] for name in STORED_HEADERS if response.has_header(name)},
+        'expires': now + timedelta(seconds=settings.IDEMPOTENCY['TTL']),
+    })
+
+
+'''
+Takes the lock of a request's Idempotency-Key. Returns (lock, None) when the request is to run, holding the lock until
+it has, or (None, response) to send instead: the stored response of the first request with the key, or an error.
+'''
+def beginIdempotent(request, key):
+    if len(key) > IdempotencyRecord._meta.get_field('key').max_length:
+        return None, Response({"error": f"{IDEMPOTENCY_HEADER} is too long."}, status=status.HTTP_400_BAD_REQUEST)
+
+    lock = idempotencyLock(request.user, key)
+    if not lock.acquire():
+        return None, Response({"error": f"A request with this {IDEMPOTENCY_HEADER} is still being processed."},
+                              status=status.HTTP_409_CONFLICT, headers={"Retry-After": str(IN_PROGRESS_WAIT)})
+    try:
+        record = IdempotencyRecord.objects.filter(user=request.user, key=key, expires__gt=timezone.now()).first()
+    except BaseException:
+        lock.release()
+        raise
+    if record is None:
+        return lock, None
+
+    lock.release()
+    if record.fingerprint != requestFingerprint(request):
+        return None, Response({"error": f"{IDEMPOTENCY_HEADER} was already used for a different request."},
+                              status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    print("[INFO]: Replaying idempotent response")
+    return None, replay(record)
+
+
+'''Stores the response of a request that ran under beginIdempotent and releases its lock'''
+def finishIdempotent(request, key, lock, response):
+    try:
+        if response is not None and isStorable(response):
+            storeResponse(request.user, key, requestFingerprint(request), response)
+    finally:
+        lock.release()
+
+
+def idempotencyKey(request):
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    return key if key and settings.IDEMPOTENCY['ENABLED'] else None
+
+
+'''
+Runs handler once per Idempotency-Key of a user. The response of the first request is stored for TTL seconds and sent
+again, with Idempotent-Replayed: true, to every retry of it. A retry arriving while the first request is still running
+waits for it (up to WAIT_TIMEOUT seconds, then a 409 with Retry-After) instead of generating a second workout. A key
+sent again with a different request is a 422. Requests without the header run as usual.
+'''
+def idempotentResponse(request, handler):
+    key = idempotencyKey(request)
+    if key is None:
+        return handler()
+    lock, response = beginIdempotent(request, key)
+    if lock is None:
+        return response
+    try:
+        response = handler()
+    finally:
+        finishIdempotent(request, key, lock, response)
+    return response
+
+
+'''idempotentResponse for an async handler, the database work runs in the request's thread like other sync code'''
+async def idempotentResponseAsync(request, handler):
+    key = idempotencyKey(request)
+    if key is None:
+        return await handler()
+    lock, response = await sync_to_async(beginIdempotent)(request, key)
+    if lock is None:
+        return response
+    try:
+        response = await handler()
+    finally:
+        await sync_to_async(finishIdempotent)(request, key, lock, response)
+    return response
+
+
+'''Makes a view method idempotent under the Idempotency-Key header, see idempotentResponse'''
+def idempotent(method):
+    @functools.wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        return idempotentResponse(request, lambda: method(view, request, *args, **kwargs))
+    return wrapper
+
+
+def idempotentAsync(method):
+    @functools.wraps(method)
+    async def wrapper(view, request, *args, **kwargs):
+        return await idempotentResponseAsync(request, lambda: method(view, request, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,116 @@
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from backend.read_cache import invalidateUser
+from workout.models import Workout, WorkoutJob
+from .llm_config import workout_keys
+from .llm_connection import LlmConnection
+from .llm_usage import usage_ledger
+from .revisions import addFirstWorkout
+
+
+'''Clients opt in to background generation with the Prefer: respond-async header (RFC 7240)'''
+def requestPrefersAsync(request):
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+'''Claims the oldest runnable job, skipping rows other workers have locked'''
+def claimJob():
+    now = timezone.now()
+    with transaction.atomic():
+        job = (WorkoutJob.objects.select_for_update(skip_locked=True)
+               .filter(Q(status='queued', run_after__lte=now) | Q(status='running', lease_expires__lt=now))
+               .order_by('run_after', 'id')
+               .first())
+        if job is None:
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        job.lease_expires = now + timedelta(seconds=settings.WORKOUT_JOBS['LEASE_SECONDS'])
+        job.save(update_fields=['status', 'attempts', 'lease_expires', 'updated'])
+    return job
+
+
+'''Generates the workout for a claimed job and records the outcome on both the job and the workout'''
+def runJob(job):
+    workout = Workout.objects.select_related('user').get(id=job.workout_id)
+    try:
+        llm = LlmConnection(user=workout.user, endpoint='run_workout_worker')
+        text = llm.requestWorkoutFromData({key: getattr(workout, key) for key in workout_keys})
+
+    except Exception as e:
+        print(f"[ERROR]: Workout job {job.id} failed: {str(e)}")
+        with transaction.atomic():
+            job.error = str(e)
+            job.lease_expires = None
+            if job.attempts < settings.WORKOUT_JOBS['MAX_ATTEMPTS']:
+                # Exponential backoff before the job is claimed again
+                job.status = 'queued'
+                job.run_after = timezone.now() + timedelta(seconds=settings.WORKOUT_JOBS['RETRY_DELAY'] * 2 ** (job.attempts - 1))
+            else:
+                job.status = 'failed'
+                Workout.objects.filter(id=workout.id).update(generation_status='failed')
+                invalidateUser(workout.user_id)
+            job.save()
+        return job
+
+    with transaction.atomic():
+        Workout.objects.filter(id=workout.id).update(generation_status='complete')
+        # A job whose lease expired may have been finished by another worker as well, the first workout is kept
+        addFirstWorkout(workout, text, ignore_conflicts=True)
+        job.status = 'complete'
+        job.error = None
+        job.lease_expires = None
+        job.save()
+    return job
+
+
+'''Claims and runs a single job, returns None when there is nothing to do'''
+def runNextJob():
+    job = claimJob()
+    if job is not None:
+        runJob(job)
+        # Workers serve no requests, so they write the usage ledger themselves
+        usage_ledger.flushIfDue()
+    return job
+
+
+'''Pool of threads that keep claiming and running workout jobs until stopped'''
+class WorkoutWorker():
+
+    def __init__(self, threads, poll_interval):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def work(self):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                if runNextJob() is None:
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            connection.close()
+
+    def run(self):
+        workers = [threading.Thread(target=self.work, name=f"workout-worker-{i}", daemon=True) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(timeout=1)
+        except KeyboardInterrupt:
+            print("[INFO]: Stopping workout workers")
+            self.stop()
+            for worker in workers:
+                worker.join()
+            usage_ledger.flush()
+
+    def stop(self):
+        self.stopping.set()
@@ -0,0 +1,186 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from backend.metrics import Counter, Gauge, Histogram
+from .llm_resilience import LlmUnavailable
+
+
+llm_admission_in_flight = Gauge('llm_admission_in_flight', "LLM calls running in this process")
+llm_admission_queue_depth = Gauge('llm_admission_queue_depth', "LLM calls waiting for a slot in this process")
+llm_admission_wait = Histogram('llm_admission_wait_seconds', "Time LLM calls waited for a slot, admitted or not", ['outcome'])
+llm_admission_shed = Counter('llm_admission_shed_total', "LLM calls turned away with a 503, because the queue was full or the wait too long", ['reason'])
+
+
+'''Too many llm calls are running or waiting in this process, sent as a 503 with Retry-After'''
+class LlmOverloaded(LlmUnavailable):
+    default_detail = "Too many workouts are being generated right now, try again shortly."
+
+
+class Waiter():
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+'''
+Process wide limit on llm calls in flight. Up to max_concurrent calls run at once, up to max_queue more wait for a
+slot in arrival order and a call is turned away with LlmOverloaded when the queue is full or once it has waited
+max_wait seconds, so requests fail fast instead of piling up on worker threads while Gemini is slow. Sync callers
+block their thread, async callers wait on the event loop. A released slot is handed straight to the oldest waiter.
+'''
+class AdmissionController():
+    # Weight of the latest call in the moving average of how long calls hold a slot, used for Retry-After
+    smoothing = 0.2
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.running = 0
+        self.waiters = deque()
+        self.hold_seconds = 1.0
+        self.lock = threading.Lock()
+
+    '''Takes a free slot or queues waiter, returns whether the slot was taken. None when the queue is full'''
+    def enter(self, waiter):
+        with self.lock:
+            if self.running < self.max_concurrent and not self.waiters:
+                self.running += 1
+                self.updateGauges()
+                return True
+            if len(self.waiters) >= self.max_queue:
+                return None
+            self.waiters.append(waiter)
+            self.updateGauges()
+            return False
+
+    '''Stops waiting, returns True when the slot was granted in the meantime'''
+    def abandon(self, waiter):
+        with self.lock:
+            if waiter.granted:
+                return True
+            self.waiters.remove(waiter)
+            self.updateGauges()
+            return False
+
+    def release(self, held):
+        with self.lock:
+            self.hold_seconds += self.smoothing * (held - self.hold_seconds)
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.running -= 1
+            self.updateGauges()
+
+    def shed(self, reason, start):
+        llm_admission_shed.inc(reason=reason)
+        llm_admission_wait.observe(time.monotonic() - start, outcome='shed')
+        with self.lock:
+            retry_after = self.retryAfter()
+        raise LlmOverloaded(wait=retry_after)
+
+    '''Seconds until a slot is likely free for a new call, from the calls ahead of it and how long calls take'''
+    def retryAfter(self):
+        return max(1, math.ceil(self.hold_seconds * (len(self.waiters) + 1) / max(self.max_concurrent, 1)))
+
+    def updateGauges(self):
+        llm_admission_in_flight.set(self.running)
+        llm_admission_queue_depth.set(len(self.waiters))
+
+    def acquire(self):
+        start = time.monotonic()
+        event = threading.Event()
+        waiter = Waiter(event.set)
+        entered = self.enter(waiter)
+        if entered is None:
+            self.shed('queue_full', start)
+        if not entered and not event.wait(self.max_wait) and not self.abandon(waiter):
+            self.shed('wait_timeout', start)
+        llm_admission_wait.observe(time.monotonic() - start, outcome='admitted')
+
+    async def acquireAsync(self):
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        # Slots are released from any thread
+        waiter = Waiter(lambda: loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True)))
+        entered = self.enter(waiter)
+        if entered is None:
+            self.shed('queue_full', start)
+        if not entered:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self.abandon(waiter):
+                    self.shed('wait_timeout', start)
+            except asyncio.CancelledError:
+                # The request went away while waiting, hand back a slot granted in the meantime
+                if self.abandon(waiter):
+                    self.release(self.hold_seconds)
+                raise
+        llm_admission_wait.observe(time.monotonic() - start, outcome='admitted')
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def slotAsync(self):
+        await self.acquireAsync()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    '''Holds a slot while the stream is read, it is taken when the first chunk is asked for'''
+    def admitStream(self, chunks):
+        with self.slot():
+            yield from chunks
+
+    async def admitStreamAsync(self, chunks):
+        async with self.slotAsync():
+            async for chunk in chunks:
+                yield chunk
+
+
+'''Unlimited when admission control is turned off'''
+class NoAdmission():
+
+    @contextmanager
+    def slot(self):
+        yield
+
+    @asynccontextmanager
+    async def slotAsync(self):
+        yield
+
+    def admitStream(self, chunks):
+        return chunks
+
+    def admitStreamAsync(self, chunks):
+        return chunks
+
+
+def createAdmissionController():
+    config = settings.LLM_ADMISSION
+    if not config['ENABLED']:
+        return NoAdmission()
+    return AdmissionController(config['MAX_CONCURRENT'], config['MAX_QUEUE'], config['MAX_WAIT'])
+
+
+admission = createAdmissionController()
@@ -0,0 +1,227 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from workout.models import LlmResponseCache
+from .llm_resilience import LlmUnavailable
+from .llm_singleflight import SingleFlight, AdvisoryLock
+
+
+# Retry-After of a request that gave up waiting on another process generating the same response
+PENDING_WAIT = 5
+
+
+'''Another process is still generating the same response, sent as a 503 with Retry-After instead of generating it twice'''
+class LlmResponsePending(LlmUnavailable):
+    default_detail = "An identical request is still being generated, try again shortly."
+
+
+'''Keeps the most recently used responses in process memory'''
+class LocalCacheBackend():
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            response, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return response
+
+    def set(self, key, model_version, response, ttl):
+        with self.lock:
+            self.entries[key] = (response, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+'''Shares responses between processes through the LlmResponseCache table'''
+class DatabaseCacheBackend():
+    # Expired and overflow rows are trimmed every N writes instead of on every write
+    cull_frequency = 50
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.writes = 0
+
+    def get(self, key):
+        return LlmResponseCache.objects.filter(key=key, expires__gt=timezone.now()).values_list('response', flat=True).first()
+
+    def set(self, key, model_version, response, ttl):
+        LlmResponseCache.objects.update_or_create(key=key, defaults={
+            'model_version': model_version,
+            'response': response,
+            'expires': timezone.now() + timedelta(seconds=ttl),
+        })
+        self.writes += 1
+        if self.writes % self.cull_frequency == 0:
+            self.cull()
+
+    def cull(self):
+        LlmResponseCache.objects.filter(expires__lte=timezone.now()).delete()
+        overflow = LlmResponseCache.objects.order_by('-expires').values_list('key', flat=True)[self.max_entries:]
+        LlmResponseCache.objects.filter(key__in=list(overflow)).delete()
+
+    def clear(self):
+        LlmResponseCache.objects.all().delete()
+
+
+'''Content addressed cache for llm responses, keyed by the normalized prompt and the model version'''
+class LlmCache():
+    backends = {
+        'local': LocalCacheBackend,
+        'database': DatabaseCacheBackend,
+    }
+
+    def __init__(self, backend, ttl, advisory_lock=False, lock_timeout=30):
+        self.backend = backend
+        self.ttl = ttl
+        self.flight = SingleFlight()
+        # Also coalesce across processes, only useful with the database backend
+        self.advisory_lock = advisory_lock
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromSettings(cls):
+        config = settings.LLM_CACHE
+        backend = None if config['BACKEND'] == 'none' else cls.backends[config['BACKEND']](config['MAX_ENTRIES'])
+        return cls(backend, config['TTL'], config['ADVISORY_LOCK'], config['LOCK_TIMEOUT'])
+
+    '''Whitespace differences do not change what the model is asked'''
+    def normalizePrompt(self, prompt):
+        lines = [re.sub(r'\s+', ' ', line).strip() for line in prompt.strip().splitlines()]
+        return '\n'.join(line for line in lines if line)
+
+    def makeKey(self, prompt, model_version):
+        normalized = model_version + '\n' + self.normalizePrompt(prompt)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        response = self.backend.get(key)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def set(self, key, model_version, response):
+        if self.backend is not None:
+            self.backend.set(key, model_version, response, self.ttl)
+
+    '''
+    Returns the cached response for the prompt, or calls generate and caches its result. Concurrent misses for the same
+    key are coalesced so only one of them calls generate. Bypassing skips the lookup but still refreshes the entry
+    '''
+    def getOrGenerate(self, prompt, model_version, generate, bypass=False):
+        key = self.makeKey(prompt, model_version)
+        if not bypass:
+            response = self.get(key)
+            if response is not None:
+                print("[INFO]: LLM cache hit")
+                return response
+        return self.flight.do(key, lambda: self.generateAndStore(key, model_version, generate, bypass))
+
+    '''
+    With the advisory lock, a caller that gets it checks the shared cache before generating. One that gave up waiting
+    for it checks the cache once more and raises LlmResponsePending rather than generating the response a second time
+    '''
+    def generateAndStore(self, key, model_version, generate, bypass):
+        if not self.advisory_lock:
+            response = generate()
+            self.set(key, model_version, response)
+            return response
+
+        with AdvisoryLock(key, self.lock_timeout) as lock:
+            # Another process may have generated it while this one waited for the lock
+            response = self.storedResponse(key, bypass, lock)
+            if response is None:
+                response = generate()
+                self.set(key, model_version, response)
+            return response
+
+    '''The response another process stored for key, raises LlmResponsePending if it gave up waiting for lock'''
+    def storedResponse(self, key, bypass, lock):
+        response = None
+        if (not bypass or not lock.acquired) and self.backend is not None:
+            response = self.backend.get(key)
+        if response is None and not lock.acquired:
+            raise LlmResponsePending(wait=PENDING_WAIT)
+        return response
+
+    '''Async version of getOrGenerate, generate is a coroutine function'''
+    async def getOrGenerateAsync(self, prompt, model_version, generate, bypass=False):
+        key = self.makeKey(prompt, model_version)
+        if not bypass:
+            response = await sync_to_async(self.get)(key)
+            if response is not None:
+                print("[INFO]: LLM cache hit")
+                return response
+        return await self.flight.doAsync(key, lambda: self.generateAndStoreAsync(key, model_version, generate, bypass))
+
+    async def generateAndStoreAsync(self, key, model_version, generate, bypass):
+        if not self.advisory_lock:
+            response = await generate()
+            await sync_to_async(self.set)(key, model_version, response)
+            return response
+
+        lock = AdvisoryLock(key, self.lock_timeout)
+        await sync_to_async(lock.acquire)()
+        try:
+            response = await sync_to_async(self.storedResponse)(key, bypass, lock)
+            if response is None:
+                response = await generate()
+                await sync_to_async(self.set)(key, model_version, response)
+            return response
+        finally:
+            await sync_to_async(lock.release)()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+
+_llm_cache = None
+
+def getLlmCache():
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LlmCache.fromSettings()
+    return _llm_cache
+
+
+'''Clients can skip the cache for a single request by sending Cache-Control: no-cache'''
+def requestAllowsCache(request):
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
@@ -1,3 +1,5 @@
+from string import Template
+
 #Prompt formatting
 prompt_start = "Create a workout using the following parameters:\n"
 prompt_end = """Return your response in the following json format where each exericise is a seperate json object in the contents list. Each exercise has a "name", the "type" of workout, and "info" about the amount of reps/sets/duration to do it in.\n
@@ -13,6 +15,18 @@ Format: {"recommendation": "", "parameters": {"length":"", "workout_type":"", "t
  """
 
 
+#Precompiled prompts, $workout and $health are the "key: value" lines for workout_keys and health_keys
+field_line = "{key}: {value}\n"
+workout_prompt = Template(prompt_start + "${workout}${health}" + prompt_end)
+reco_prompt = Template(reco_start + "${workouts}\n" + reco_end)
+
+
+#Workout change history formatting
+history_request = "The workout was first created with these parameters:\n"
+history_summary = "Earlier change requests, oldest first: "
+history_summary_separator = "; "
+
+
 #Keys for user data
 workout_keys = ["length",
                 "difficulty",
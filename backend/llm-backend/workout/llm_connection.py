@@ -0,0 +1,176 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+from .llm_config import *
+from .llm_admission import admission
+from .llm_cache import getLlmCache
+from .llm_output import checkWorkout
+from .llm_metrics import observeLlm, observeLlmAsync, observeLlmStream, observeLlmStreamAsync
+from .llm_resilience import getLlmProvider
+from .llm_usage import usageContext
+from .prompts import PromptBuilder
+
+
+''' Used to connect and query llm'''
+class LlmConnection():
+
+    def __init__(self, use_cache = True, user = None, endpoint = None):
+        # Gemini or the local fake, selected by settings.LLM_PROVIDER
+        self.provider = getLlmProvider()
+        self.model_version = self.provider.model_version
+        self.use_cache = use_cache
+        # Workout prompts include the health data of this user
+        self.prompts = PromptBuilder(user)
+        # Calls are written to the usage ledger under this user and endpoint
+        self.usage = usageContext(user, endpoint, self.model_version)
+        return
+
+    '''Request a workout from the llm'''
+    def requestWorkout(self, serializer):
+        return self.requestWorkoutFromData(serializer.validated_data, method = 'requestWorkout')
+
+    '''
+    Request a workout from the llm for workout fields that are already saved, used by background jobs. method is
+    the name its call is recorded under in the llm metrics and usage ledger
+    '''
+    def requestWorkoutFromData(self, workout_data, method = 'requestWorkoutFromData'):
+        print("[INFO]: Connecting to LLM")
+        prompt = self.generatePrompt(workout_data)
+        return self.generateCached(prompt, method, validate = checkWorkout)
+
+    '''
+    Requests a workout for each of workouts_data, up to concurrency at a time, so the whole batch takes about as long
+    as its slowest workout. Returns the workout or the exception raised for it, in order. Prompts are built before the
+    calls are sent and every call runs in a copy of the caller's context, so it is counted against the request.
+    '''
+    def requestWorkouts(self, workouts_data, concurrency):
+        print(f"[INFO]: Connecting to LLM for {len(workouts_data)} workouts")
+        prompts = [self.generatePrompt(workout_data) for workout_data in workouts_data]
+        if not prompts:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prompts))), thread_name_prefix='llm-batch') as pool:
+            futures = [pool.submit(contextvars.copy_context().run, self.requestBatchWorkout, prompt) for prompt in prompts]
+            return [future.result() for future in futures]
+
+    def requestBatchWorkout(self, prompt):
+        try:
+            return self.generateCached(prompt, 'requestWorkouts', validate = checkWorkout)
+        except Exception as e:
+            return e
+        finally:
+            # Pool threads would otherwise each leave a connection open
+            connection.close()
+
+    '''Request a workout from the llm without blocking the event loop'''
+    async def requestWorkoutAsync(self, serializer):
+        print("[INFO]: Connecting to LLM (async)")
+        prompt = await sync_to_async(self.generatePrompt)(serializer.validated_data)
+        return await self.generateCachedAsync(prompt, 'requestWorkoutAsync', validate = checkWorkout)
+
+    '''
+    Sends a single prompt, reusing the response of an identical earlier prompt when possible. validate raises for
+    responses in the wrong format so they are never cached. method is the public method the call is recorded under.
+    '''
+    def generateCached(self, prompt, method, validate = None):
+        validate = validate or (lambda text: text)
+        return getLlmCache().getOrGenerate(prompt, self.model_version, lambda: validate(self.generate(prompt, method)), bypass = not self.use_cache)
+
+    async def generateCachedAsync(self, prompt, method, validate = None):
+        validate = validate or (lambda text: text)
+
+        async def generate():
+            return validate(await self.generateAsync(prompt, method))
+        return await getLlmCache().getOrGenerateAsync(prompt, self.model_version, generate, bypass = not self.use_cache)
+
+    '''Calls wait for one of the process wide llm slots, see workout.llm_admission'''
+    def generate(self, prompt, method):
+        with admission.slot():
+            return observeLlm(method, prompt, lambda: self.provider.generate(prompt), self.usage)
+
+    async def generateAsync(self, prompt, method):
+        async with admission.slotAsync():
+            return await observeLlmAsync(method, prompt, lambda: self.provider.generateAsync(prompt), self.usage)
+
+    '''Request a workout from the llm, yielding the text as it is generated'''
+    def requestWorkoutStream(self, serializer):
+        print("[INFO]: Streaming from LLM")
+        prompt = self.generatePrompt(serializer.validated_data)
+        return self.generateStream(prompt, 'requestWorkoutStream')
+
+    async def requestWorkoutStreamAsync(self, serializer):
+        print("[INFO]: Streaming from LLM (async)")
+        prompt = await sync_to_async(self.generatePrompt)(serializer.validated_data)
+        async for chunk in self.generateStreamAsync(prompt, 'requestWorkoutStreamAsync'):
+            yield chunk
+
+    '''Streams the response text in chunks, a cached response is sent as a single chunk'''
+    def generateStream(self, prompt, method):
+        cache = getLlmCache()
+        key = cache.makeKey(prompt, self.model_version)
+        if self.use_cache:
+            response = cache.get(key)
+            if response is not None:
+                yield response
+                return
+        text = []
+        for chunk in admission.admitStream(observeLlmStream(method, prompt, self.provider.generateStream(prompt), self.usage)):
+            text.append(chunk)
+            yield chunk
+        cache.set(key, self.model_version, checkWorkout(''.join(text)))
+
+    async def generateStreamAsync(self, prompt, method):
+        cache = getLlmCache()
+        key = cache.makeKey(prompt, self.model_version)
+        if self.use_cache:
+            response = await sync_to_async(cache.get)(key)
+            if response is not None:
+                yield response
+                return
+        text = []
+        async for chunk in admission.admitStreamAsync(observeLlmStreamAsync(method, prompt, self.provider.generateStreamAsync(prompt), self.usage)):
+            text.append(chunk)
+            yield chunk
+        await sync_to_async(cache.set)(key, self.model_version, checkWorkout(''.join(text)))
+
+    '''Make changes to the current llm workout, history is built by workout.chat_history.ChatHistory'''
+    def changeWorkout(self, history):
+        print("[INFO]: Sending workout history to LLM")
+        with admission.slot():
+            return checkWorkout(observeLlm('changeWorkout', str(history) + prompt_end, lambda: self.provider.chat(history, prompt_end), self.usage))
+
+    '''Make changes to the current llm workout without blocking the event loop'''
+    async def changeWorkoutAsync(self, history):
+        print("[INFO]: Sending workout history to LLM (async)")
+        async with admission.slotAsync():
+            return checkWorkout(await observeLlmAsync('changeWorkoutAsync', str(history) + prompt_end, lambda: self.provider.chatAsync(history, prompt_end), self.usage))
+
+    '''Make changes to the current llm workout, yielding the text as it is generated'''
+    def changeWorkoutStream(self, history):
+        print("[INFO]: Streaming workout history to LLM")
+        return admission.admitStream(observeLlmStream('changeWorkoutStream', str(history) + prompt_end, self.provider.chatStream(history, prompt_end), self.usage))
+
+    def changeWorkoutStreamAsync(self, history):
+        print("[INFO]: Streaming workout history to LLM (async)")
+        return admission.admitStreamAsync(observeLlmStreamAsync('changeWorkoutStreamAsync', str(history) + prompt_end, self.provider.chatStreamAsync(history, prompt_end), self.usage))
+
+    '''Generates llm prompts'''
+    def generatePrompt(self, workout_data):
+        print("[INFO]: Creating Prompt")
+        return self.prompts.workoutPrompt(workout_data)
+
+    '''Generates the recommendation prompt for the last N workouts'''
+    def generateRecommendationPrompt(self, workout_list):
+        return self.prompts.recommendationPrompt(workout_list)
+
+    def generateRecommendation(self, workout_list):
+        print("[INFO]: Creating Recommendation")
+        prompt = self.generateRecommendationPrompt(workout_list)
+        return self.generateCached(prompt, 'generateRecommendation')
+
+    '''Generates a recommendation without blocking the event loop'''
+    async def generateRecommendationAsync(self, workout_list):
+        print("[INFO]: Creating Recommendation (async)")
+        prompt = self.generateRecommendationPrompt(workout_list)
+        return await self.generateCachedAsync(prompt, 'generateRecommendationAsync')
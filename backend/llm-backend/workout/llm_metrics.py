@@ -0,0 +1,122 @@
+import asyncio
+import math
+import time
+from contextvars import ContextVar
+
+from backend.metrics import Counter, Histogram, currentRequestStats
+from .llm_usage import usage_ledger
+
+
+llm_call_duration = Histogram('llm_call_duration_seconds', "Time spent waiting on the LLM per LlmConnection method", ['method'])
+llm_calls = Counter('llm_calls_total', "LLM calls per LlmConnection method and outcome (ok, cancelled or the error code)", ['method', 'outcome'])
+llm_tokens = Counter('llm_tokens_total', "Prompt and response tokens per LlmConnection method, as reported by the model or estimated", ['method', 'kind'])
+llm_prompt_tokens = Histogram('llm_prompt_tokens', "Estimated tokens of each prompt built, per kind of prompt", ['kind'],
+                              buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
+
+'''Rough token count, Gemini averages about 4 characters per token for English text'''
+def estimateTokens(text):
+    return math.ceil(len(text) / 4)
+
+
+# Token counts of the last call as reported by the provider, read by recordLlmCall
+_reported_usage = ContextVar('reported_llm_usage', default=None)
+
+
+'''Called by providers whose responses include token counts, these replace the estimate for the call'''
+def reportUsage(prompt_tokens, response_tokens):
+    _reported_usage.set((prompt_tokens, response_tokens))
+
+
+'''Token counts reported in this context since the last call, cleared once read'''
+def takeReportedUsage():
+    reported = _reported_usage.get()
+    _reported_usage.set(None)
+    return reported
+
+
+'''HTTP status for google api errors (503 for an overloaded model), otherwise the exception name'''
+def errorCode(e):
+    code = getattr(e, 'code', None)
+    return str(code) if isinstance(code, int) else type(e).__name__
+
+
+'''
+Records a finished call. usage is the user, endpoint and model version of the LlmConnection, the call is written to
+the usage ledger when it is given.
+'''
+def recordLlmCall(method, prompt, seconds, response=None, outcome='ok', usage=None):
+    reported = takeReportedUsage()
+    if reported is not None:
+        prompt_tokens, response_tokens = reported
+    else:
+        prompt_tokens = estimateTokens(prompt)
+        response_tokens = estimateTokens(response) if response is not None else 0
+
+    llm_call_duration.observe(seconds, method=method)
+    llm_calls.inc(method=method, outcome=outcome)
+    llm_tokens.inc(prompt_tokens, method=method, kind='prompt')
+    if response is not None:
+        llm_tokens.inc(response_tokens, method=method, kind='response')
+    stats = currentRequestStats()
+    if stats is not None:
+        stats.llm_seconds += seconds
+    if usage is not None:
+        usage_ledger.record(method=method, outcome=outcome, prompt_tokens=prompt_tokens, response_tokens=response_tokens,
+                            latency_ms=round(seconds * 1000), **usage)
+
+
+'''Runs a provider call, recording its latency, outcome and tokens'''
+def observeLlm(method, prompt, call, usage=None):
+    start = time.perf_counter()
+    try:
+        response = call()
+    except Exception as e:
+        recordLlmCall(method, prompt, time.perf_counter() - start, outcome=errorCode(e), usage=usage)
+        raise
+    recordLlmCall(method, prompt, time.perf_counter() - start, response, usage=usage)
+    return response
+
+
+async def observeLlmAsync(method, prompt, call, usage=None):
+    start = time.perf_counter()
+    try:
+        response = await call()
+    except Exception as e:
+        recordLlmCall(method, prompt, time.perf_counter() - start, outcome=errorCode(e), usage=usage)
+        raise
+    recordLlmCall(method, prompt, time.perf_counter() - start, response, usage=usage)
+    return response
+
+
+'''Passes stream chunks through, recording the call once the stream ends'''
+def observeLlmStream(method, prompt, chunks, usage=None):
+    start = time.perf_counter()
+    text = []
+    try:
+        for chunk in chunks:
+            text.append(chunk)
+            yield chunk
+    except GeneratorExit:
+        recordLlmCall(method, prompt, time.perf_counter() - start, ''.join(text), outcome='cancelled', usage=usage)
+        raise
+    except Exception as e:
+        recordLlmCall(method, prompt, time.perf_counter() - start, outcome=errorCode(e), usage=usage)
+        raise
+    recordLlmCall(method, prompt, time.perf_counter() - start, ''.join(text), usage=usage)
+
+
+async def observeLlmStreamAsync(method, prompt, chunks, usage=None):
+    start = time.perf_counter()
+    text = []
+    try:
+        async for chunk in chunks:
+            text.append(chunk)
+            yield chunk
+    except (GeneratorExit, asyncio.CancelledError):
+        recordLlmCall(method, prompt, time.perf_counter() - start, ''.join(text), outcome='cancelled', usage=usage)
+        raise
+    except Exception as e:
+        recordLlmCall(method, prompt, time.perf_counter() - start, outcome=errorCode(e), usage=usage)
+        raise
+    recordLlmCall(method, prompt, time.perf_counter() - start, ''.join(text), usage=usage)
@@ -0,0 +1,51 @@
+import json
+import re
+
+
+'''The llm returned something that is not a workout in the format asked for in llm_config.prompt_end'''
+class InvalidWorkout(ValueError):
+    pass
+
+
+'''Gemini sometimes wraps json in a markdown code block when json mode is not available'''
+def stripCodeFence(text):
+    match = re.fullmatch(r'\s*```(?:json)?\s*(.*?)\s*```\s*', text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+'''
+Validates a generated workout and returns it as {"exercises": [{"name": "", "type": "", "info": ""}]}. The prompt
+misspells "exericse", the correct spelling is accepted as well.
+'''
+def parseWorkout(text):
+    try:
+        data = json.loads(stripCodeFence(text))
+    except (TypeError, ValueError):
+        raise InvalidWorkout("Workout is not valid json")
+
+    items = data.get('workout') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise InvalidWorkout("Workout has no exercises")
+
+    exercises = []
+    for item in items:
+        exercise = (item.get('exericse') or item.get('exercise')) if isinstance(item, dict) else None
+        if not isinstance(exercise, dict) or not str(exercise.get('name') or '').strip():
+            raise InvalidWorkout("Workout contains an exercise without a name")
+        exercises.append({
+            'name': str(exercise['name']).strip(),
+            'type': str(exercise.get('type') or '').strip(),
+            'info': str(exercise.get('info') or '').strip(),
+        })
+    return {'exercises': exercises}
+
+
+'''Returns the text unchanged if it is a valid workout, used to keep invalid responses out of the llm cache'''
+def checkWorkout(text):
+    parseWorkout(text)
+    return text
+
+
+'''Exercise names are matched case and whitespace insensitively'''
+def normalizeExerciseName(name):
+    return ' '.join(name.lower().split())
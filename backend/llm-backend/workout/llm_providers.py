@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import google.generativeai as genai
+from django.conf import settings
+from google.api_core import exceptions as google_exceptions
+
+from .llm_config import reco_start
+from .llm_metrics import reportUsage
+
+
+'''
+Interface LlmConnection uses to talk to a model. Every call takes a prompt (or a chat history and a message) and
+returns the response text, the stream variants yield the text in chunks. A provider missing any of them cannot be
+created.
+'''
+class LlmProvider(ABC):
+    model_version = None
+
+    @abstractmethod
+    def generate(self, prompt):
+        pass
+
+    @abstractmethod
+    async def generateAsync(self, prompt):
+        pass
+
+    @abstractmethod
+    def generateStream(self, prompt):
+        pass
+
+    @abstractmethod
+    def generateStreamAsync(self, prompt):
+        pass
+
+    @abstractmethod
+    def chat(self, history, message):
+        pass
+
+    @abstractmethod
+    async def chatAsync(self, history, message):
+        pass
+
+    @abstractmethod
+    def chatStream(self, history, message):
+        pass
+
+    @abstractmethod
+    def chatStreamAsync(self, history, message):
+        pass
+
+
+'''Gemini answered without any text, e.g. the prompt or the response was blocked'''
+class LlmEmptyResponse(Exception):
+    pass
+
+
+'''Google Gemini through google.generativeai'''
+class GeminiProvider(LlmProvider):
+
+    def __init__(self, api_key, model_version, timeout=None):
+        genai.configure(api_key = api_key)
+        self.model_version = model_version
+        # Every prompt asks for json, json mode makes Gemini return it without markdown around it
+        self.model = genai.GenerativeModel(model_version, generation_config = {"response_mime_type": "application/json"})
+        # Seconds before the SDK gives up on a request
+        self.request_options = {"timeout": timeout} if timeout else None
+
+    '''Text of a response, reporting its token counts for the usage ledger'''
+    def responseText(self, response):
+        self.reportUsage(response)
+        if not response.candidates:
+            feedback = getattr(response, 'prompt_feedback', None)
+            raise LlmEmptyResponse(f"No candidates, block reason {getattr(feedback, 'block_reason', None)}")
+        candidate = response.candidates[0]
+        if candidate.content is None or not candidate.content.parts:
+            raise LlmEmptyResponse(f"Empty candidate, finish reason {getattr(candidate, 'finish_reason', None)}")
+        return candidate.content.parts[0].text
+
+    def reportUsage(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None and usage.prompt_token_count:
+            reportUsage(usage.prompt_token_count, usage.candidates_token_count)
+
+    '''Streamed chunks carry the running token counts, the last chunk has the totals'''
+    def streamText(self, chunks):
+        chunk = None
+        for chunk in chunks:
+            yield chunk.text
+        if chunk is not None:
+            self.reportUsage(chunk)
+
+    async def streamTextAsync(self, chunks):
+        chunk = None
+        async for chunk in chunks:
+            yield chunk.text
+        if chunk is not None:
+            self.reportUsage(chunk)
+
+    def generate(self, prompt):
+        return self.responseText(self.model.generate_content(prompt, request_options = self.request_options))
+
+    async def generateAsync(self, prompt):
+        return self.responseText(await self.model.generate_content_async(prompt, request_options = self.request_options))
+
+    def generateStream(self, prompt):
+        yield from self.streamText(self.model.generate_content(prompt, stream = True, request_options = self.request_options))
+
+    async def generateStreamAsync(self, prompt):
+        async for text in self.streamTextAsync(await self.model.generate_content_async(prompt, stream = True, request_options = self.request_options)):
+            yield text
+
+    def chat(self, history, message):
+        return self.responseText(self.model.start_chat(history = history).send_message(message, request_options = self.request_options))
+
+    async def chatAsync(self, history, message):
+        return self.responseText(await self.model.start_chat(history = history).send_message_async(message, request_options = self.request_options))
+
+    def chatStream(self, history, message):
+        yield from self.streamText(self.model.start_chat(history = history).send_message(message, stream = True, request_options = self.request_options))
+
+    async def chatStreamAsync(self, history, message):
+        async for text in self.streamTextAsync(await self.model.start_chat(history = history).send_message_async(message, stream = True, request_options = self.request_options)):
+            yield text
+
+
+'''
+Local stand in for Gemini used for load testing without quota or network. Responses are schema valid workout or
+recommendation json chosen deterministically from the prompt, latency follows the configured distribution and a
+configurable fraction of calls fail the way an overloaded Gemini does.
+'''
+class FakeProvider(LlmProvider):
+    model_version = 'fake'
+    stream_chunks = 8
+    exercises = [
+        ("Push Ups", "Strength", "3 sets of 12 reps"),
+        ("Goblet Squat", "Strength", "4 sets of 10 reps"),
+        ("Romanian Deadlift", "Strength", "3 sets of 8 reps"),
+        ("Plank", "Core", "3 sets of 45 seconds"),
+        ("Jump Rope", "Cardio", "5 rounds of 1 minute"),
+        ("Walking Lunges", "Strength", "3 sets of 20 steps"),
+        ("Bent Over Row", "Strength", "4 sets of 10 reps"),
+        ("Mountain Climbers", "Cardio", "4 sets of 30 seconds"),
+        ("Downward Dog", "Mobility", "5 breaths, 3 rounds"),
+        ("Rowing Machine", "Cardio", "10 minutes steady pace"),
+    ]
+    recommendations = [
+        ("Your legs called, they feel neglected. Squat day it is.", "Resistance Training", "Legs"),
+        ("Enough lifting, your heart wants some attention too.", "Cardio", "Full Body"),
+        ("Stretch it out before you snap like a dry spaghetti noodle.", "Yoga", "Full Body"),
+        ("Time to find out if those abs exist.", "Circuits", "Core"),
+    ]
+
+    def __init__(self, latency_distribution='constant', latency_mean=0.0, latency_spread=0.0, error_rate=0.0, seed=0):
+        self.latency_distribution = latency_distribution
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.lock = threading.Lock()
+
+    '''Seconds the next call takes, and whether it fails'''
+    def nextCall(self):
+        with self.lock:
+            if self.latency_distribution == 'uniform':
+                latency = self.random.uniform(self.latency_mean - self.latency_spread, self.latency_mean + self.latency_spread)
+            elif self.latency_distribution == 'lognormal':
+                # latency_spread is sigma of the underlying normal, latency_mean the median
+                latency = self.latency_mean * self.random.lognormvariate(0, self.latency_spread)
+            else:
+                latency = self.latency_mean
+            fails = self.random.random() < self.error_rate
+        return max(latency, 0.0), fails
+
+    def respond(self, prompt):
+        rng = random.Random(f"{self.seed}:{hashlib.sha256(str(prompt).encode('utf-8')).hexdigest()}")
+        if str(prompt).startswith(reco_start):
+            recommendation, workout_type, target_area = rng.choice(self.recommendations)
+            return json.dumps({"recommendation": recommendation, "parameters": {
+                "length": str(rng.choice([30, 45, 60])), "workout_type": workout_type, "target_area": target_area}})
+        return json.dumps({"workout": [{"exericse": {"name": name, "type": kind, "info": info}}
+                                       for name, kind, info in rng.sample(self.exercises, rng.randint(4, 6))]})
+
+    def chunks(self, text):
+        size = max(1, -(-len(text) // self.stream_chunks))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def fail(self):
+        raise google_exceptions.ServiceUnavailable("Fake provider error")
+
+    def generate(self, prompt):
+        latency, fails = self.nextCall()
+        time.sleep(latency)
+        if fails:
+            self.fail()
+        return self.respond(prompt)
+
+    async def generateAsync(self, prompt):
+        latency, fails = self.nextCall()
+        await asyncio.sleep(latency)
+        if fails:
+            self.fail()
+        return self.respond(prompt)
+
+    def generateStream(self, prompt):
+        latency, fails = self.nextCall()
+        chunks = self.chunks(self.respond(prompt))
+        for i, chunk in enumerate(chunks):
+            time.sleep(latency / len(chunks))
+            if fails and i == len(chunks) // 2:
+                self.fail()
+            yield chunk
+
+    async def generateStreamAsync(self, prompt):
+        latency, fails = self.nextCall()
+        chunks = self.chunks(self.respond(prompt))
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(latency / len(chunks))
+            if fails and i == len(chunks) // 2:
+                self.fail()
+            yield chunk
+
+    '''Revisions answer with a workout based on the whole history'''
+    def chat(self, history, message):
+        return self.generate(json.dumps(history) + message)
+
+    async def chatAsync(self, history, message):
+        return await self.generateAsync(json.dumps(history) + message)
+
+    def chatStream(self, history, message):
+        return self.generateStream(json.dumps(history) + message)
+
+    def chatStreamAsync(self, history, message):
+        return self.generateStreamAsync(json.dumps(history) + message)
+
+
+def createLlmProvider():
+    if settings.LLM_PROVIDER == 'fake':
+        config = settings.LLM_FAKE
+        return FakeProvider(config['LATENCY_DISTRIBUTION'], config['LATENCY_MEAN'], config['LATENCY_SPREAD'],
+                            config['ERROR_RATE'], config['SEED'])
+    return GeminiProvider(settings.API_KEY, settings.MODEL_VERSION, settings.LLM_RESILIENCE['TIMEOUT'])
+
@@ -0,0 +1,362 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from google.api_core import exceptions as google_exceptions
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from backend.metrics import Counter, Gauge
+from .llm_metrics import errorCode, reportUsage, takeReportedUsage
+from .llm_providers import LlmProvider, createLlmProvider
+
+
+llm_attempt_timeouts = Counter('llm_attempt_timeouts_total', "LLM attempts abandoned at their deadline per provider method", ['method'])
+llm_retries = Counter('llm_retries_total', "LLM attempts retried per provider method and error", ['method', 'reason'])
+llm_hedges = Counter('llm_hedges_total', "Hedged LLM requests sent, and won when the hedge answered first", ['method', 'outcome'])
+llm_circuit_state = Gauge('llm_circuit_state', "LLM circuit breaker state: 0 closed, 1 half open, 2 open")
+llm_circuit_transitions = Counter('llm_circuit_transitions_total', "LLM circuit breaker state changes per new state", ['state'])
+llm_circuit_rejections = Counter('llm_circuit_rejections_total', "LLM calls failed fast by the open circuit breaker")
+
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+# Upstream errors worth another attempt: overloaded, rate limited, failing or slow
+RETRYABLE_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+'''The llm could not answer in time or is failing, sent as a 503 (with Retry-After when known) instead of a 500'''
+class LlmUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Workout generation is temporarily unavailable, try again later."
+    default_code = 'llm_unavailable'
+    code = 503
+
+    def __init__(self, detail=None, wait=None):
+        super().__init__(detail)
+        self.wait = wait
+
+
+class LlmTimeout(LlmUnavailable):
+    default_detail = "Workout generation timed out, try again later."
+    code = 504
+
+
+class CircuitOpen(LlmUnavailable):
+    pass
+
+
+def isRetryable(e):
+    return isinstance(e, RETRYABLE_ERRORS) or isinstance(e, LlmTimeout)
+
+
+'''
+Fails calls fast once the llm keeps failing. After failure_threshold failed attempts in a row the circuit opens and
+calls raise CircuitOpen for reset_seconds, then a single trial call is let through (half open). Its success closes the
+circuit, its failure opens it again. Per process.
+'''
+class CircuitBreaker():
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+        llm_circuit_state.set(CIRCUIT_STATES['closed'])
+
+    def setState(self, state):
+        self.state = state
+        llm_circuit_state.set(CIRCUIT_STATES[state])
+        llm_circuit_transitions.inc(state=state)
+        print(f"[INFO]: LLM circuit breaker {state.replace('_', ' ')}")
+
+    '''Raises CircuitOpen unless a call may go through now'''
+    def before(self):
+        with self.lock:
+            if self.state == 'open':
+                remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    llm_circuit_rejections.inc()
+                    raise CircuitOpen(wait=math.ceil(remaining))
+                self.setState('half_open')
+                self.trial_running = True
+                return
+            if self.state == 'half_open':
+                if self.trial_running:
+                    llm_circuit_rejections.inc()
+                    raise CircuitOpen(wait=1)
+                self.trial_running = True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_running = False
+            if self.state != 'closed':
+                self.setState('closed')
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.setState('open')
+
+
+'''Runs call in a pool thread, returning the token counts it reported as well since those are kept per thread'''
+def callReportingUsage(call):
+    result = call()
+    return result, takeReportedUsage()
+
+
+async def awaitReportingUsage(call):
+    result = await call()
+    return result, takeReportedUsage()
+
+
+'''
+Wraps another provider with a deadline per attempt, retries of upstream errors with jittered exponential backoff, a
+circuit breaker and optionally a hedged second request when the first is slow. Streams are retried only until the
+first chunk arrives and are not hedged, their deadline is left to the provider. Errors that are not worth retrying
+(a rejected prompt, an empty response) are raised straight away.
+'''
+class ResilientProvider(LlmProvider):
+
+    def __init__(self, provider, timeout, max_attempts, backoff_base, backoff_max, breaker, hedge_delay=0.0, pool_size=32):
+        self.provider = provider
+        self.timeout = timeout
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.hedge_delay = hedge_delay
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='llm-call')
+        self.random = random.Random()
+
+    @property
+    def model_version(self):
+        return self.provider.model_version
+
+    '''Full jitter: a random wait up to the exponential backoff of the attempt'''
+    def backoff(self, attempt):
+        return self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    '''Records the outcome of an attempt, returns the seconds to wait before the next one or raises'''
+    def failedAttempt(self, method, attempt, e):
+        if isinstance(e, CircuitOpen):
+            raise e
+        if not isRetryable(e):
+            # The llm answered, it just did not like the request
+            self.breaker.success()
+            raise e
+        self.breaker.failure()
+        if attempt >= self.max_attempts:
+            if isinstance(e, LlmUnavailable):
+                raise e
+            raise LlmUnavailable() from e
+        llm_retries.inc(method=method, reason=errorCode(e))
+        print(f"[INFO]: Retrying {method} after {errorCode(e)}, attempt {attempt + 1} of {self.max_attempts}")
+        return self.backoff(attempt)
+
+    def withRetries(self, method, call):
+        attempt = 1
+        while True:
+            self.breaker.before()
+            try:
+                result = self.hedged(method, call)
+            except Exception as e:
+                time.sleep(self.failedAttempt(method, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    async def withRetriesAsync(self, method, call):
+        attempt = 1
+        while True:
+            self.breaker.before()
+            try:
+                result = await self.hedgedAsync(method, call)
+            except Exception as e:
+                await asyncio.sleep(self.failedAttempt(method, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    '''One attempt within the deadline, a second identical request is sent if the first is slower than hedge_delay'''
+    def hedged(self, method, call):
+        deadline = time.monotonic() + self.timeout
+        first = self.pool.submit(callReportingUsage, call)
+        pending = {first}
+        hedged = not self.hedge_delay
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining if hedged else min(remaining, self.hedge_delay), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return self.answer(method, future is not first, future.result())
+                error = future.exception()
+            if not done and not hedged:
+                hedged = True
+                llm_hedges.inc(method=method, outcome='sent')
+                pending.add(self.pool.submit(callReportingUsage, call))
+        if error is not None and not pending:
+            raise error
+        # Threads cannot be stopped, the provider's own timeout ends the request
+        for future in pending:
+            future.cancel()
+        llm_attempt_timeouts.inc(method=method)
+        raise LlmTimeout()
+
+    async def hedgedAsync(self, method, call):
+        deadline = time.monotonic() + self.timeout
+        first = asyncio.ensure_future(awaitReportingUsage(call))
+        pending = {first}
+        hedged = not self.hedge_delay
+        error = None
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining if hedged else min(remaining, self.hedge_delay),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return self.answer(method, task is not first, task.result())
+                    error = task.exception()
+                if not done and not hedged:
+                    hedged = True
+                    llm_hedges.inc(method=method, outcome='sent')
+                    pending.add(asyncio.ensure_future(awaitReportingUsage(call)))
+        finally:
+            for task in pending:
+                task.cancel()
+        if error is not None and not pending:
+            raise error
+        llm_attempt_timeouts.inc(method=method)
+        raise LlmTimeout()
+
+    def answer(self, method, hedge_won, result):
+        if hedge_won:
+            llm_hedges.inc(method=method, outcome='won')
+        text, usage = result
+        if usage is not None:
+            reportUsage(*usage)
+        return text
+
+    def retryStream(self, method, start):
+        attempt = 1
+        while True:
+            self.breaker.before()
+            chunks = iter(start())
+            try:
+                first = next(chunks)
+            except StopIteration:
+                self.breaker.success()
+                return
+            except Exception as e:
+                time.sleep(self.failedAttempt(method, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.success()
+            break
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            if isRetryable(e):
+                self.breaker.failure()
+            raise
+
+    async def retryStreamAsync(self, method, start):
+        attempt = 1
+        while True:
+            self.breaker.before()
+            chunks = start().__aiter__()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                self.breaker.success()
+                return
+            except Exception as e:
+                await asyncio.sleep(self.failedAttempt(method, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.success()
+            break
+        yield first
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            if isRetryable(e):
+                self.breaker.failure()
+            raise
+
+    def generate(self, prompt):
+        return self.withRetries('generate', lambda: self.provider.generate(prompt))
+
+    async def generateAsync(self, prompt):
+        return await self.withRetriesAsync('generateAsync', lambda: self.provider.generateAsync(prompt))
+
+    def generateStream(self, prompt):
+        return self.retryStream('generateStream', lambda: self.provider.generateStream(prompt))
+
+    def generateStreamAsync(self, prompt):
+        return self.retryStreamAsync('generateStreamAsync', lambda: self.provider.generateStreamAsync(prompt))
+
+    def chat(self, history, message):
+        return self.withRetries('chat', lambda: self.provider.chat(history, message))
+
+    async def chatAsync(self, history, message):
+        return await self.withRetriesAsync('chatAsync', lambda: self.provider.chatAsync(history, message))
+
+    def chatStream(self, history, message):
+        return self.retryStream('chatStream', lambda: self.provider.chatStream(history, message))
+
+    def chatStreamAsync(self, history, message):
+        return self.retryStreamAsync('chatStreamAsync', lambda: self.provider.chatStreamAsync(history, message))
+
+
+'''The provider selected by settings.LLM_PROVIDER behind the resilience settings'''
+def createResilientProvider():
+    config = settings.LLM_RESILIENCE
+    provider = createLlmProvider()
+    if not config['ENABLED']:
+        return provider
+    breaker = CircuitBreaker(config['BREAKER_FAILURES'], config['BREAKER_RESET'])
+    return ResilientProvider(provider, config['TIMEOUT'], config['MAX_ATTEMPTS'], config['BACKOFF_BASE'], config['BACKOFF_MAX'],
+                             breaker, config['HEDGE_DELAY'], config['POOL_SIZE'])
+
+
+_llm_provider = None
+
+'''The provider shared by every LlmConnection in the process'''
+def getLlmProvider():
+    global _llm_provider
+    if _llm_provider is None:
+        _llm_provider = createResilientProvider()
+    return _llm_provider
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+from django.db import connection
+
+
+'''A call that other requests with the same key can wait on'''
+class InFlightCall():
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # The leader stopped without a result or an error (e.g. it was interrupted), a waiter takes over
+        self.abandoned = False
+        # (loop, future) of the async waiters, woken from whichever thread the leader finishes on
+        self.waiters = []
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+'''
+Coalesces concurrent calls with the same key in this process, sync and async callers alike. The first caller (the
+leader) runs the function, every caller that arrives while it is running waits and gets the same result or has the
+same error raised. Sync waiters block on an event and async ones await a future, so an async request can wait on a sync
+one and the other way round. When the leader goes away without either, for example an async request cancelled
+because its client disconnected, the waiters call again and one of them becomes the leader.
+'''
+class SingleFlight():
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = InFlightCall()
+
+            if leader:
+                break
+            print("[INFO]: Waiting on in-flight LLM request")
+            call.done.wait()
+            if not call.abandoned:
+                return call.outcome()
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            self.finish(key, call)
+        return call.result
+
+    '''Async version of do, fn is a coroutine function'''
+    async def doAsync(self, key, fn):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = InFlightCall()
+                else:
+                    future = loop.create_future()
+                    call.waiters.append((loop, future))
+
+            if leader:
+                break
+            print("[INFO]: Waiting on in-flight LLM request")
+            await future
+            if not call.abandoned:
+                return call.outcome()
+
+        try:
+            call.result = await fn()
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            # Cancelled, the waiters call again
+            call.abandoned = True
+            raise
+        finally:
+            self.finish(key, call)
+        return call.result
+
+    def finish(self, key, call):
+        with self.lock:
+            del self.calls[key]
+            call.done.set()
+            waiters, call.waiters = call.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(wake, future)
+            except RuntimeError:
+                # The waiter's loop is closed, nothing is left waiting on it
+                pass
+
+
+'''
+Cross process coalescing using a Postgres session level advisory lock on the cache key. The lock only serializes
+the callers, so the leader has to store its result somewhere shared (the database cache backend) for the other
+processes to pick it up when they get the lock. Errors are not shared between processes.
+'''
+class AdvisoryLock():
+    poll_interval = 0.05
+
+    def __init__(self, key, timeout):
+        # Advisory locks take a signed bigint, use the first 64 bits of the hex digest
+        self.lock_id = int(key[:16], 16) - 2 ** 63
+        self.timeout = timeout
+        self.acquired = False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with connection.cursor() as cursor:
+            while True:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_id])
+                if cursor.fetchone()[0]:
+                    self.acquired = True
+                    return True
+                if time.monotonic() >= deadline:
+                    # Give up waiting rather than tie up the request, the caller decides what to do without the lock
+                    return False
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        if self.acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [self.lock_id])
+            self.acquired = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,135 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from rest_framework import serializers
+
+from workout.models import LlmUsage, LlmUsageDaily
+
+
+'''
+Buffer of LlmUsage rows. Calls are recorded in memory and written with one bulk insert once BATCH_SIZE calls are
+buffered or FLUSH_INTERVAL seconds have passed, checked after each request so the insert never runs inside an llm call
+or on the event loop. Rows still buffered when a process is killed are lost.
+'''
+class UsageLedger():
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or settings.LLM_USAGE['BATCH_SIZE']
+        self.flush_interval = flush_interval if flush_interval is not None else settings.LLM_USAGE['FLUSH_INTERVAL']
+        self.rows = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, **fields):
+        if not settings.LLM_USAGE['ENABLED']:
+            return
+        row = LlmUsage(**fields)
+        with self.lock:
+            self.rows.append(row)
+
+    def isDue(self):
+        with self.lock:
+            return len(self.rows) >= self.batch_size or (self.rows and time.monotonic() - self.last_flush >= self.flush_interval)
+
+    '''Writes the buffered rows, returns how many were written'''
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            self.last_flush = time.monotonic()
+        if not rows:
+            return 0
+        try:
+            LlmUsage.objects.bulk_create(rows, batch_size=self.batch_size)
+        except Exception as e:
+            print(f"[ERROR]: Dropped {len(rows)} llm usage rows: {str(e)}")
+            return 0
+        return len(rows)
+
+    def flushIfDue(self):
+        if self.isDue():
+            self.flush()
+
+    def clear(self):
+        with self.lock:
+            self.rows = []
+
+
+usage_ledger = UsageLedger()
+
+
+def flush_usage_ledger(sender, **kwargs):
+    usage_ledger.flushIfDue()
+
+
+request_finished.connect(flush_usage_ledger)
+
+
+'''Where an LlmConnection records its calls, endpoint is the url name of the view or the command making them'''
+def usageContext(user, endpoint, model_version):
+    return {'user_id': user.id if user is not None else None, 'endpoint': endpoint or '', 'model_version': model_version or ''}
+
+
+'''Url name of the view handling request, used as the ledger endpoint'''
+def requestEndpoint(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.url_name if match is not None else ''
+
+
+ROLLUP_SQL = f'''
+INSERT INTO {LlmUsageDaily._meta.db_table} (day, user_id, endpoint, model_version, calls, errors, prompt_tokens, response_tokens, latency_ms)
+SELECT (created AT TIME ZONE %s)::date, user_id, endpoint, model_version, count(*),
+       count(*) FILTER (WHERE outcome NOT IN ('ok', 'cancelled')), sum(prompt_tokens), sum(response_tokens), sum(latency_ms)
+FROM {LlmUsage._meta.db_table}
+WHERE created >= %s AND created < %s
+GROUP BY 1, 2, 3, 4
+'''
+
+
+'''Start of day in the server timezone'''
+def dayStart(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+'''
+Rebuilds the daily totals of first_day to last_day inclusive from the ledger, so a day can be rolled up again as often
+as needed while it is still filling. Returns the number of daily rows written.
+'''
+def rollupUsage(first_day, last_day):
+    with transaction.atomic():
+        LlmUsageDaily.objects.filter(day__gte=first_day, day__lte=last_day).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(ROLLUP_SQL, [settings.TIME_ZONE, dayStart(first_day), dayStart(last_day + timedelta(days=1))])
+            return cursor.rowcount
+
+
+'''Query parameters of the top consumers view'''
+class TopConsumersQuerySerializer(serializers.Serializer):
+    days = serializers.IntegerField(default=7, min_value=1, max_value=366)
+    limit = serializers.IntegerField(default=20, min_value=1, max_value=100)
+
+
+'''Users with the most tokens over the last days days (today included), from the daily rollup'''
+def topConsumers(days, limit):
+    since = timezone.localdate() - timedelta(days=days - 1)
+    rows = (LlmUsageDaily.objects.filter(day__gte=since)
+            .values('user_id', 'user__username')
+            .annotate(total_calls=Sum('calls'), total_errors=Sum('errors'), total_prompt_tokens=Sum('prompt_tokens'),
+                      total_response_tokens=Sum('response_tokens'), total_latency_ms=Sum('latency_ms'))
+            .annotate(total_tokens=F('total_prompt_tokens') + F('total_response_tokens'))
+            .order_by('-total_tokens', 'user_id')[:limit])
+    return [{
+        'user_id': row['user_id'],
+        'username': row['user__username'],
+        'calls': row['total_calls'],
+        'errors': row['total_errors'],
+        'prompt_tokens': row['total_prompt_tokens'],
+        'response_tokens': row['total_response_tokens'],
+        'total_tokens': row['total_tokens'],
+        'average_latency_ms': round(row['total_latency_ms'] / row['total_calls']) if row['total_calls'] else 0,
+    } for row in rows]
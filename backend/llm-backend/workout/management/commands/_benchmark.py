@@ -0,0 +1,40 @@
+import math
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from django.conf import settings
+from django.db import connection, connections
+from django.test import override_settings
+
+from workout.llm_providers import FakeProvider
+
+
+'''Helpers shared by the benchmark commands, not a command itself'''
+
+
+'''Runs the block against a throwaway copy of the database so real data is never touched'''
+@contextmanager
+def benchmarkDatabase():
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+'''Answers every LLM call with the fake provider instead of Gemini'''
+def fakeLlm(latency, **options):
+    return patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider(latency_mean=latency, **options))
+
+
+'''Lifts the llm rate limits, benchmark users send far more requests than any real user may'''
+def noThrottling():
+    return override_settings(LLM_THROTTLE={**settings.LLM_THROTTLE, 'ENABLED': False})
+
+
+'''Nearest rank percentile of an already sorted list'''
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
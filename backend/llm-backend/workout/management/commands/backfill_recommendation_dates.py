@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+
+# Dates are taken in the server timezone, the same day timezone.localdate() gives the API
+DELETE_DUPLICATES = """
+    DELETE FROM workout_recommendation old
+    USING workout_recommendation other
+    WHERE old.for_date IS NULL
+      AND other.user_id = old.user_id
+      AND other.id <> old.id
+      AND COALESCE(other.for_date, (other.created AT TIME ZONE %(tz)s)::date) = (old.created AT TIME ZONE %(tz)s)::date
+      AND (other.for_date IS NOT NULL OR other.created > old.created OR (other.created = old.created AND other.id > old.id))
+"""
+
+SET_DATES = """
+    UPDATE workout_recommendation
+    SET for_date = (created AT TIME ZONE %(tz)s)::date
+    WHERE for_date IS NULL
+"""
+
+
+class Command(BaseCommand):
+    help = ("Dates recommendations created before the for_date column existed. When a user has several recommendations "
+            "for the same day, created by requests racing each other, only the latest is kept")
+
+    def handle(self, *args, **options):
+        params = {'tz': settings.TIME_ZONE}
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(DELETE_DUPLICATES, params)
+            deleted = cursor.rowcount
+            cursor.execute(SET_DATES, params)
+            dated = cursor.rowcount
+        self.stdout.write(f"Done, dated {dated} recommendations and deleted {deleted} duplicates")
@@ -0,0 +1,177 @@
+import json
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import HealthData
+from workout.models import Workout, WorkoutRevision
+from workout.llm_providers import FakeProvider
+from workout.revisions import revisionRows
+from ._benchmark import benchmarkDatabase, fakeLlm, noThrottling, percentile
+
+
+WORKOUT_TYPES = ['Resistance Training', 'Cardio', 'Circuits', 'Crossfit', 'Yoga']
+DIFFICULTIES = ['Easy', 'Medium', 'Hard']
+
+
+'''Each endpoint is a function of (client, seeded user, request number) that sends one request'''
+ENDPOINTS = {
+    'create': lambda client, user, i: client.post(reverse('create-workout'), {
+        'length': 45,
+        'difficulty': DIFFICULTIES[i % len(DIFFICULTIES)],
+        'workout_type': WORKOUT_TYPES[i % len(WORKOUT_TYPES)],
+        'equipment_access': 'Full Gym',
+        # Distinct prompts so the LLM cache does not hide generation latency
+        'other_workout_considerations': f"benchmark request {i}",
+    }, content_type='application/json'),
+    'list': lambda client, user, i: client.get(reverse('workout-list')),
+    'detail': lambda client, user, i: client.get(reverse('specific-workout', args=[user['workouts'][i % len(user['workouts'])]])),
+    'recommendation': lambda client, user, i: client.get(reverse('recommendation')),
+    'profile': lambda client, user, i: client.get(reverse('user_profile')),
+}
+
+
+class Command(BaseCommand):
+    help = ("Seeds a throwaway database with users and workout history, then drives every API endpoint at fixed "
+            "concurrency levels with the fake LLM provider and reports latency percentiles, throughput and SQL "
+            "queries per request")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help="Number of seeded users")
+        parser.add_argument('--history-sizes', default='0,10,100,500', help="Workout history sizes, assigned to users round robin")
+        parser.add_argument('--concurrency', default='1,8,32', help="Comma separated concurrency levels")
+        parser.add_argument('--requests', type=int, default=200, help="Requests per endpoint and concurrency level")
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help="Comma separated subset of " + ', '.join(ENDPOINTS))
+        parser.add_argument('--llm-latency', type=float, default=0.2, help="Fake LLM latency in seconds")
+        parser.add_argument('--output', default='benchmark_results.json', help="Where to write the machine readable results")
+
+    def handle(self, *args, **options):
+        history_sizes = [int(size) for size in options['history_sizes'].split(',')]
+        concurrency_levels = [int(level) for level in options['concurrency'].split(',')]
+        endpoints = options['endpoints'].split(',')
+
+        results = []
+        # Request numbers keep counting across runs so create never repeats a prompt
+        self.sent = 0
+        with benchmarkDatabase(), fakeLlm(options['llm_latency']), noThrottling():
+            users = self.seed(options['users'], history_sizes)
+            for endpoint in endpoints:
+                # Users without history would only measure 404s on the detail endpoint
+                endpoint_users = [user for user in users if user['workouts']] if endpoint == 'detail' else users
+                for concurrency in concurrency_levels:
+                    result = self.run(endpoint, concurrency, options['requests'], endpoint_users)
+                    results.append(result)
+                    self.report(result)
+
+        with open(options['output'], 'w') as f:
+            json.dump({'meta': self.meta(options), 'results': results}, f, indent=2)
+        self.stdout.write(f"Results written to {options['output']}")
+
+    '''Creates users with filled in health data and the given number of past workouts each'''
+    def seed(self, user_count, history_sizes):
+        provider = FakeProvider()
+        users = []
+        for n in range(user_count):
+            user = User.objects.create_user(username=f'benchmark{n}', email=f'benchmark{n}@example.com', password=None)
+            HealthData.objects.filter(profile__user=user).update(
+                dob=date(1990, 1, 1), gender='Female', height=1.7, weight=65, favourite_workout_type='Cardio',
+                workout_experience='Intermediate', fitness_goal='Run a 10k', injuries='None')
+
+            workouts = Workout.objects.bulk_create([
+                Workout(
+                    user=user,
+                    length=45,
+                    difficulty=DIFFICULTIES[i % len(DIFFICULTIES)],
+                    workout_type=WORKOUT_TYPES[i % len(WORKOUT_TYPES)],
+                    equipment_access='Full Gym',
+                )
+                for i in range(history_sizes[n % len(history_sizes)])
+            ], batch_size=500)
+            revisions = []
+            for i, workout in enumerate(workouts):
+                history = [('workout', provider.respond(f'{n}:{i}:0'))]
+                # Roughly a third of workouts went through a revision
+                if i % 3 == 0:
+                    history += [('change', 'Swap the cardio for something lower impact'), ('workout', provider.respond(f'{n}:{i}:1'))]
+                revisions += revisionRows(workout, 0, history)
+            WorkoutRevision.objects.bulk_create(revisions, batch_size=1000)
+            users.append({
+                'token': str(RefreshToken.for_user(user).access_token),
+                'workouts': [workout.id for workout in workouts],
+            })
+        return users
+
+    '''Sends the requests from a pool of `concurrency` threads and summarizes them'''
+    def run(self, endpoint, concurrency, count, users):
+        send_request = ENDPOINTS[endpoint]
+
+        def send(i):
+            user = users[i % len(users)]
+            client = Client(headers={'Authorization': 'Bearer ' + user['token']})
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = send_request(client, user, i)
+                    elapsed = time.perf_counter() - start
+            finally:
+                # The test client skips the per request connection cleanup the server does, close it here so every
+                # request connects like it would with CONN_MAX_AGE = 0
+                connection.close()
+            return elapsed, len(queries), response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(send, range(self.sent, self.sent + count)))
+        seconds = time.perf_counter() - start
+        self.sent += count
+
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+        queries = [query_count for _, query_count, _ in samples]
+        return {
+            'endpoint': endpoint,
+            'concurrency': concurrency,
+            'requests': count,
+            'errors': len([code for _, _, code in samples if code >= 400]),
+            'requests_per_second': count / seconds,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'mean': sum(latencies) / len(latencies),
+            },
+            'queries_per_request': {
+                'mean': sum(queries) / len(queries),
+                'max': max(queries),
+            },
+        }
+
+    def report(self, result):
+        latency = result['latency_ms']
+        self.stdout.write(
+            f"{result['endpoint']:<15} c={result['concurrency']:<4} {result['requests_per_second']:8.1f} req/s  "
+            f"p50 {latency['p50']:7.1f}ms  p95 {latency['p95']:7.1f}ms  p99 {latency['p99']:7.1f}ms  "
+            f"{result['queries_per_request']['mean']:5.1f} queries/req  {result['errors']} errors")
+
+    def meta(self, options):
+        try:
+            revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            revision = None
+        return {
+            'timestamp': timezone.now().isoformat(),
+            'git_revision': revision,
+            'users': options['users'],
+            'history_sizes': options['history_sizes'],
+            'requests': options['requests'],
+            'llm_latency': options['llm_latency'],
+        }
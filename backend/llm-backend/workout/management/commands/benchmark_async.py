@@ -0,0 +1,92 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from ._benchmark import benchmarkDatabase, fakeLlm, noThrottling
+
+
+WORKOUT_DATA = {
+    'length': 60,
+    'difficulty': 'Easy',
+    'workout_type': 'Resistance Training',
+    'target_area': 'Chest',
+    'equipment_access': 'Full Gym'
+}
+
+
+'''Every request gets a distinct prompt so the LLM cache and request coalescing do not hide the model latency'''
+def workoutData(i):
+    return dict(WORKOUT_DATA, other_workout_considerations=f"benchmark request {i}")
+
+
+class Command(BaseCommand):
+    help = "Compares concurrent throughput of the sync (WSGI) and async (ASGI) workout creation paths using the fake LLM provider"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Number of workout creation requests per path")
+        parser.add_argument('--latency', type=float, default=0.5, help="Simulated Gemini latency in seconds")
+        parser.add_argument('--workers', type=int, default=8, help="Worker threads available to the sync path")
+        parser.add_argument('--output', help="Optional path to write the results as json")
+
+    def handle(self, *args, **options):
+        with benchmarkDatabase():
+            user = User.objects.create_user(username='benchmark', email='benchmark@example.com', password=None)
+            headers = {'Authorization': 'Bearer ' + str(RefreshToken.for_user(user).access_token)}
+
+            with fakeLlm(options['latency']), noThrottling():
+                results = [
+                    self.runSync(options['requests'], options['workers'], headers),
+                    asyncio.run(self.runAsync(options['requests'], headers)),
+                ]
+
+        for result in results:
+            self.stdout.write(f"{result['path']:<6} {result['requests']} requests in {result['seconds']:.2f}s "
+                              f"-> {result['requests_per_second']:.1f} req/s ({result['errors']} errors)")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'latency': options['latency'], 'workers': options['workers'], 'results': results}, f, indent=2)
+
+    '''Sends the requests through the WSGI handler from a fixed size thread pool, like a sync worker pool'''
+    def runSync(self, count, workers, headers):
+        url = reverse('create-workout')
+
+        def send(i):
+            try:
+                return Client(headers=headers).post(url, workoutData(i), content_type='application/json').status_code
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            codes = list(pool.map(send, range(count)))
+        return self.summarize('sync', codes, time.perf_counter() - start)
+
+    '''Sends every request at once through the ASGI handler'''
+    async def runAsync(self, count, headers):
+        url = reverse('async-create-workout')
+        client = AsyncClient()
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.post(url, workoutData(i), content_type='application/json', headers=headers) for i in range(count, 2 * count)
+        ])
+        await sync_to_async(connections.close_all)()
+        return self.summarize('async', [response.status_code for response in responses], time.perf_counter() - start)
+
+    def summarize(self, path, codes, seconds):
+        return {
+            'path': path,
+            'requests': len(codes),
+            'seconds': seconds,
+            'requests_per_second': len(codes) / seconds,
+            'errors': len([code for code in codes if code != 201]),
+        }
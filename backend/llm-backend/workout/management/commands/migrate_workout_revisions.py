@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from workout.models import Workout, WorkoutRevision
+from workout.revisions import legacyRevisions, projectExercises, revisionRows
+
+
+class Command(BaseCommand):
+    help = ("Moves the history of existing workouts from the llm_suggested_changes and llm_suggested_workout arrays "
+            "into WorkoutRevision rows. Safe to run while the API is serving and to run again after an interruption")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Workouts moved per transaction")
+
+    def handle(self, *args, **options):
+        last_id = 0
+        moved = 0
+        while True:
+            with transaction.atomic():
+                # Locked so the arrays are not cleared under a revision being moved by the API at the same time
+                workouts = list(Workout.objects.select_for_update()
+                                .filter(Q(llm_suggested_workout__len__gt=0) | Q(llm_suggested_changes__len__gt=0), id__gt=last_id)
+                                .only('id', 'llm_suggested_changes', 'llm_suggested_workout')
+                                .order_by('id')[:options['batch_size']])
+                if not workouts:
+                    break
+
+                # Workouts that already have revisions were moved by the API, their arrays are just cleared
+                revised = set(WorkoutRevision.objects.filter(workout__in=workouts).values_list('workout_id', flat=True).distinct())
+                rows = {workout: revisionRows(workout, 0, revisions, legacy=len(revisions))
+                        for workout in workouts if workout.id not in revised
+                        for revisions in [legacyRevisions(workout)]}
+                WorkoutRevision.objects.bulk_create([row for workout_rows in rows.values() for row in workout_rows], batch_size=1000)
+                for workout, workout_rows in rows.items():
+                    latest = [row.structured for row in workout_rows if row.kind == 'workout']
+                    projectExercises(workout, latest[-1] if latest else None)
+                Workout.objects.filter(id__in=[workout.id for workout in workouts]).update(llm_suggested_changes=[], llm_suggested_workout=[])
+
+            last_id = workouts[-1].id
+            moved += len(workouts)
+            self.stdout.write(f"Moved {moved} workouts")
+
+        self.stdout.write(f"Done, moved the history of {moved} workouts")
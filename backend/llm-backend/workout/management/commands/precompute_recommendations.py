@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from workout.llm_connection import LlmConnection
+from workout.llm_usage import usage_ledger
+from workout.models import RecommendationRun, Workout
+from workout.recommendations import createRecommendation, findRecommendation
+
+
+class Command(BaseCommand):
+    help = ("Creates today's recommendation for every user who completed a workout in the last --days days, so the "
+            "recommendation endpoint only has to look it up. Meant to run off peak, e.g. from cron shortly after "
+            "midnight. An interrupted run continues from its checkpoint when started again")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="Users with a workout in this many days are precomputed")
+        parser.add_argument('--concurrency', type=int, default=4, help="Recommendations generated at the same time")
+        parser.add_argument('--chunk-size', type=int, default=100, help="Users between checkpoints")
+        parser.add_argument('--restart', action='store_true', help="Ignore today's checkpoint and start from the first user")
+
+    def handle(self, *args, **options):
+        day = timezone.localdate()
+        run, _ = RecommendationRun.objects.get_or_create(for_date=day)
+        if options['restart']:
+            run.last_user_id = 0
+            run.finished = None
+        elif run.last_user_id:
+            self.stdout.write(f"Resuming after user {run.last_user_id}")
+
+        active_users = (Workout.objects.filter(created__gte=timezone.now() - timedelta(days=options['days']), generation_status='complete')
+                        .values_list('user_id', flat=True).distinct().order_by('user_id'))
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            while True:
+                user_ids = list(active_users.filter(user_id__gt=run.last_user_id)[:options['chunk_size']])
+                if not user_ids:
+                    break
+                users = User.objects.filter(id__in=user_ids).order_by('id')
+                results = list(pool.map(lambda user: self.precompute(user, day), users))
+
+                run.last_user_id = user_ids[-1]
+                run.created_count += results.count('created')
+                run.failed_count += results.count('failed')
+                run.save()
+                usage_ledger.flush()
+                self.stdout.write(f"Processed users up to {run.last_user_id}: {run.created_count} created, {run.failed_count} failed")
+
+        run.finished = timezone.now()
+        run.save()
+        self.stdout.write(f"Done, {run.created_count} recommendations created, {run.failed_count} failed")
+
+    '''Failed users are not retried here, their recommendation is generated on their first request instead'''
+    def precompute(self, user, day):
+        try:
+            if findRecommendation(user, day) is not None:
+                return 'skipped'
+            llm = LlmConnection(user=user, endpoint='precompute_recommendations')
+            return 'created' if createRecommendation(user, day, llm) is not None else 'skipped'
+        except Exception as e:
+            print(f"[ERROR]: Recommendation for user {user.id} failed: {str(e)}")
+            return 'failed'
+        finally:
+            connection.close()
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from workout.llm_usage import dayStart, rollupUsage
+from workout.models import LlmUsage
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the per user per day llm usage totals of the last --days days from the usage ledger, then deletes "
+            "ledger rows older than LLM_USAGE RETENTION_DAYS. Safe to run again for the same days, e.g. hourly from cron "
+            "so today's totals stay current")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2, help="Days rolled up, counting back from today")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Ledger rows deleted per transaction")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        written = rollupUsage(today - timedelta(days=options['days'] - 1), today)
+
+        # Days before the retention period were rolled up by earlier runs
+        cutoff = dayStart(today - timedelta(days=settings.LLM_USAGE['RETENTION_DAYS']))
+        expired = LlmUsage.objects.filter(created__lt=cutoff)
+        deleted = 0
+        while True:
+            ids = list(expired.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                LlmUsage.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+        self.stdout.write(f"Done, wrote {written} daily usage rows and deleted {deleted} ledger rows")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from workout.jobs import WorkoutWorker, runNextJob
+from workout.llm_usage import usage_ledger
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of workers that generate workouts queued with Prefer: respond-async"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help="Number of jobs generated concurrently")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Run queued jobs until the queue is empty, then exit")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            count = 0
+            while runNextJob() is not None:
+                count += 1
+            usage_ledger.flush()
+            self.stdout.write(f"Ran {count} workout jobs")
+            return
+
+        self.stdout.write(f"Starting {options['threads']} workout workers")
+        WorkoutWorker(options['threads'], options['poll_interval']).run()
@@ -1,12 +1,32 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from backend.read_cache import invalidateUser
 
 '''Workout model parameter choices'''
 DIFFICULTIES = [('Easy', 'Easy'), 
                ('Medium', 'Medium'), 
                ('Hard', 'Hard')]
 
+'''Workout generation status choices, pending workouts are waiting on a WorkoutJob'''
+GENERATION_STATUSES = [('pending', 'Pending'),
+                       ('complete', 'Complete'),
+                       ('failed', 'Failed')]
+
+'''Revisions are either feedback sent to the llm or a workout it generated'''
+REVISION_KINDS = [('change', 'Change Request'),
+                  ('workout', 'Workout')]
+
+JOB_STATUSES = [('queued', 'Queued'),
+                ('running', 'Running'),
+                ('complete', 'Complete'),
+                ('failed', 'Failed')]
+
 class Workout(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created = models.DateTimeField('Date Created', auto_now_add=True, blank=False, null=False)
@@ -26,24 +46,205 @@ class Workout(models.Model):
     other_workout_considerations = models.TextField('Other Workout Considerations', blank=True, null=True)
     
     '''LLM generated fields'''
-    # Feedback sent to llm for workout revisions, not sent in first interaction with llm
+    # Superseded by WorkoutRevision and no longer written. Kept until python manage.py migrate_workout_revisions
+    # has moved the history of existing workouts across
     llm_suggested_changes = ArrayField(models.TextField(), default=list, blank=True, null=True)
-    # LLM generated workouts that have not been accepted by the user
     llm_suggested_workout = ArrayField(models.TextField(), default=list, blank=True, null=True)
+    generation_status = models.CharField('Generation Status', choices=GENERATION_STATUSES, max_length=20, default='complete')
     
     '''Feedback fields'''
     workout_rating = models.IntegerField('Workout Rating', choices=[(i, str(i)) for i in range(6)], blank=True, null=True)
     workout_comments = models.TextField('Workout Feedback', blank=True, null=True)
     actual_length = models.IntegerField('Final Length of Workout (minutes)', blank=True, null=True)
+
+    # Change requests older than the ones sent to the llm in full, condensed by workout.chat_history
+    history_summary = models.TextField('Change History Summary', blank=True, default='')
+    # Change revisions up to this seq are in history_summary
+    history_summary_seq = models.IntegerField('Change History Summary Seq', default=0)
     
 
+    class Meta:
+        # Keyset pagination of the history list and its filters, see workout.pagination
+        indexes = [
+            models.Index(fields=['user', '-created', '-id'], name='workout_user_created_idx'),
+            models.Index(fields=['user', 'workout_type', '-created'], name='workout_user_type_idx'),
+            models.Index(fields=['user', 'difficulty', '-created'], name='workout_user_difficulty_idx'),
+        ]
+
     def __str__(self):
         return f"Workout {self.id} by {self.user.username} on {self.created.strftime('%Y-%m-%d %H:%M')}"
+
+
+# Revisions are bulk inserted without signals, workout.revisions invalidates for those itself
+@receiver([post_save, post_delete], sender=Workout)
+def invalidate_workout_cache(sender, instance, **kwargs):
+    invalidateUser(instance.user_id)
+
     
+class WorkoutRevision(models.Model):
+    '''
+    Append only history of a workout. The first generated workout is seq 1, each revision adds the change requests
+    followed by the workout generated for them.
+    '''
+    workout = models.ForeignKey(Workout, on_delete=models.CASCADE, related_name='revisions')
+    seq = models.PositiveIntegerField('Sequence')
+    kind = models.CharField('Kind', choices=REVISION_KINDS, max_length=20)
+    text = models.TextField('Text')
+    # Generated workouts parsed by workout.llm_output.parseWorkout, null for change requests
+    structured = models.JSONField('Structured Workout', blank=True, null=True)
+    created = models.DateTimeField('Date Created', auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        constraints = [
+            models.UniqueConstraint(fields=['workout', 'seq'], name='workoutrevision_seq_unique'),
+        ]
+
+
+class Exercise(models.Model):
+    '''Exercises seen in generated workouts, one row per name ignoring case and whitespace'''
+    name = models.CharField('Name', max_length=200)
+    normalized_name = models.CharField('Normalized Name', max_length=200, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class WorkoutExercise(models.Model):
+    '''Exercises of the latest generated workout of each workout, for "which workouts contained X" queries'''
+    workout = models.ForeignKey(Workout, on_delete=models.CASCADE, related_name='workout_exercises')
+    exercise = models.ForeignKey(Exercise, on_delete=models.CASCADE, related_name='workout_exercises')
+    position = models.PositiveIntegerField('Position')
+    type = models.CharField('Type', max_length=100, blank=True)
+    info = models.TextField('Info', blank=True)
+
+    class Meta:
+        ordering = ['position']
+        indexes = [
+            models.Index(fields=['exercise', 'workout'], name='workoutexercise_exercise_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['workout', 'position'], name='workoutexercise_position_unique'),
+        ]
+
+
 class Recommendation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created = models.DateTimeField('Date Created', auto_now_add=True, blank=False, null=False)
     recommendation = models.TextField('Daily Recommendation', blank = True, null = False)
+    # Set on every new row, rows from before the column existed are dated by backfill_recommendation_dates
+    for_date = models.DateField('For Date', blank=True, null=True)
 
-    
+    class Meta:
+        constraints = [
+            # One recommendation per user per day, also the index the daily lookup probes
+            models.UniqueConstraint(fields=['user', 'for_date'], name='recommendation_user_date_unique'),
+        ]
+
+
+class RecommendationRun(models.Model):
+    '''Checkpoint of python manage.py precompute_recommendations, users are processed in id order'''
+    for_date = models.DateField('For Date', unique=True)
+    last_user_id = models.BigIntegerField('Last Processed User', default=0)
+    created_count = models.IntegerField('Recommendations Created', default=0)
+    failed_count = models.IntegerField('Failures', default=0)
+    started = models.DateTimeField('Started', auto_now_add=True)
+    finished = models.DateTimeField('Finished', blank=True, null=True)
+
+
+class WorkoutJob(models.Model):
+    '''Background generation of a workout, claimed by workers with SELECT ... FOR UPDATE SKIP LOCKED'''
+    workout = models.OneToOneField(Workout, on_delete=models.CASCADE, related_name='job')
+    status = models.CharField('Status', choices=JOB_STATUSES, max_length=20, default='queued')
+    attempts = models.IntegerField('Attempts', default=0)
+    error = models.TextField('Last Error', blank=True, null=True)
+    created = models.DateTimeField('Date Created', auto_now_add=True)
+    updated = models.DateTimeField('Date Updated', auto_now=True)
+    # Jobs are not claimed before this time, used to back off retries
+    run_after = models.DateTimeField('Run After', default=timezone.now)
+    # A running job whose worker died is claimed again once its lease expires
+    lease_expires = models.DateTimeField('Lease Expires', blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='workoutjob_claim_idx', condition=models.Q(status__in=['queued', 'running'])),
+        ]
+
+
+class LlmResponseCache(models.Model):
+    # sha256 of the model version and normalized prompt, see workout.llm_cache
+    key = models.CharField('Prompt Hash', max_length=64, primary_key=True)
+    model_version = models.CharField('Model Version', max_length=100)
+    response = models.TextField('LLM Response')
+    created = models.DateTimeField('Date Created', auto_now_add=True)
+    expires = models.DateTimeField('Expires', db_index=True)
+
+
+class LlmUsage(models.Model):
+    '''
+    Ledger of llm calls, written in batches by workout.llm_usage. Users are not a foreign key constraint so the ledger
+    keeps the usage of deleted users and inserts never wait on the user table.
+    '''
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True, related_name='+')
+    created = models.DateTimeField('Date Created', default=timezone.now, db_index=True)
+    # Url name of the view, or the command, that made the call
+    endpoint = models.CharField('Endpoint', max_length=100, blank=True)
+    method = models.CharField('LlmConnection Method', max_length=50)
+    model_version = models.CharField('Model Version', max_length=100, blank=True)
+    # ok, cancelled or the error code, see workout.llm_metrics.errorCode
+    outcome = models.CharField('Outcome', max_length=50)
+    prompt_tokens = models.IntegerField('Prompt Tokens', default=0)
+    response_tokens = models.IntegerField('Response Tokens', default=0)
+    latency_ms = models.IntegerField('Latency (ms)', default=0)
+
+
+class LlmUsageDaily(models.Model):
+    '''Per user per day totals of LlmUsage, rebuilt by python manage.py rollup_llm_usage'''
+    day = models.DateField('Day')
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True, related_name='+')
+    endpoint = models.CharField('Endpoint', max_length=100, blank=True)
+    model_version = models.CharField('Model Version', max_length=100, blank=True)
+    calls = models.IntegerField('Calls', default=0)
+    errors = models.IntegerField('Errors', default=0)
+    prompt_tokens = models.BigIntegerField('Prompt Tokens', default=0)
+    response_tokens = models.BigIntegerField('Response Tokens', default=0)
+    latency_ms = models.BigIntegerField('Total Latency (ms)', default=0)
+
+    class Meta:
+        verbose_name_plural = 'llm usage daily'
+        indexes = [
+            models.Index(fields=['day', 'user'], name='llmusagedaily_day_user_idx'),
+        ]
+
+
+class RateLimitBucket(models.Model):
+    '''Token bucket of one user on one llm endpoint, refilled and drawn from in a single upsert by workout.throttling'''
+    key = models.CharField('Key', max_length=100, primary_key=True)
+    tokens = models.FloatField('Tokens')
+    updated = models.DateTimeField('Updated')
+    # Whether the last request was let through
+    allowed = models.BooleanField('Allowed', default=True)
+
+
+class GenerationLease(models.Model):
+    '''An llm generation in flight, counted against the user's concurrency cap until released or expired'''
+    key = models.CharField('Key', max_length=100, db_index=True)
+    expires = models.DateTimeField('Expires')
+
+
+class IdempotencyRecord(models.Model):
+    '''Response to a request sent with an Idempotency-Key header, replayed to retries of it until it expires'''
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField('Idempotency Key', max_length=255)
+    # sha256 of the method, path and body, a key reused for another request is rejected
+    fingerprint = models.CharField('Request Fingerprint', max_length=64)
+    status_code = models.IntegerField('Response Status')
+    body = models.JSONField('Response Body', encoder=DjangoJSONEncoder, blank=True, null=True)
+    headers = models.JSONField('Response Headers', default=dict, blank=True)
+    created = models.DateTimeField('Date Created', auto_now_add=True)
+    expires = models.DateTimeField('Expires')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotencyrecord_user_key_uniq'),
+        ]
@@ -0,0 +1,103 @@
+import base64
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.utils.urls import replace_query_param
+
+from workout.models import DIFFICULTIES, WorkoutExercise
+from .llm_output import normalizeExerciseName
+
+
+'''Columns loaded for ?view=summary, the llm arrays and free text fields are left out'''
+SUMMARY_FIELDS = [
+    'id',
+    'user__email',
+    'created',
+    'length',
+    'difficulty',
+    'workout_type',
+    'target_area',
+    'equipment_access',
+    'generation_status',
+    'workout_rating',
+    'actual_length'
+]
+
+
+'''Query parameters accepted by the workout list'''
+class WorkoutListQuerySerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(required=False, min_value=1)
+    view = serializers.ChoiceField(choices=['full', 'summary'], default='full')
+    workout_type = serializers.CharField(required=False)
+    difficulty = serializers.ChoiceField(choices=DIFFICULTIES, required=False)
+    # Inclusive dates in the server timezone
+    created_after = serializers.DateField(required=False)
+    created_before = serializers.DateField(required=False)
+    # Workouts whose latest generated workout contains this exercise
+    exercise = serializers.CharField(required=False)
+
+    def validate_cursor(self, value):
+        try:
+            return decodeCursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Invalid cursor.")
+
+    def validate_page_size(self, value):
+        return min(value, settings.WORKOUT_LIST['MAX_PAGE_SIZE'])
+
+
+'''Cursors are the (created, id) of the last workout on the previous page'''
+def encodeCursor(workout):
+    return base64.urlsafe_b64encode(f"{workout.created.isoformat()}|{workout.id}".encode()).decode()
+
+
+def decodeCursor(cursor):
+    created, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created), int(id)
+
+
+def startOfDay(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+'''Applies the filters in params (validated by WorkoutListQuerySerializer), newest first'''
+def filterWorkouts(queryset, params):
+    if 'workout_type' in params:
+        queryset = queryset.filter(workout_type=params['workout_type'])
+    if 'difficulty' in params:
+        queryset = queryset.filter(difficulty=params['difficulty'])
+    # Ranges on created itself rather than created__date so the (user, created) indexes are used
+    if 'created_after' in params:
+        queryset = queryset.filter(created__gte=startOfDay(params['created_after']))
+    if 'created_before' in params:
+        queryset = queryset.filter(created__lt=startOfDay(params['created_before'] + timedelta(days=1)))
+    if 'exercise' in params:
+        queryset = queryset.filter(Exists(WorkoutExercise.objects.filter(
+            workout=OuterRef('pk'), exercise__normalized_name=normalizeExerciseName(params['exercise']))))
+    if params['view'] == 'summary':
+        queryset = queryset.select_related('user').only(*SUMMARY_FIELDS)
+    else:
+        queryset = queryset.select_related('user').prefetch_related('revisions')
+    return queryset.order_by('-created', '-id')
+
+
+'''
+Keyset pagination, the page after the cursor is read straight off the (user, created, id) index however deep it is.
+Returns the page and the url of the next one, None on the last page.
+'''
+def paginateWorkouts(queryset, params, request):
+    page_size = params.get('page_size', settings.WORKOUT_LIST['PAGE_SIZE'])
+    if 'cursor' in params:
+        created, id = params['cursor']
+        queryset = queryset.filter(Q(created__lte=created) & (Q(created__lt=created) | Q(id__lt=id)))
+
+    # One extra row tells us whether there is a next page without a count query
+    page = list(queryset[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, replace_query_param(request.build_absolute_uri(), 'cursor', encodeCursor(page[-1]))
@@ -0,0 +1,70 @@
+from django.conf import settings
+from rest_framework import serializers, status
+
+from workout.models import Workout
+from workout.serializers import WorkoutSerializer
+from .llm_resilience import LlmUnavailable
+from .revisions import createWorkouts
+
+
+'''Body of the plan endpoint, a list of create workout bodies checked one by one by generatePlan'''
+class WorkoutPlanSerializer(serializers.Serializer):
+    workouts = serializers.ListField(child=serializers.DictField(), allow_empty=False)
+
+    def validate_workouts(self, value):
+        if len(value) > settings.WORKOUT_PLAN['MAX_WORKOUTS']:
+            raise serializers.ValidationError(f"A plan has at most {settings.WORKOUT_PLAN['MAX_WORKOUTS']} workouts.")
+        return value
+
+
+'''Error result of a workout the llm could not generate, its error is logged'''
+def failedResult(e):
+    print(f"[ERROR]:{str(e)}")
+    if isinstance(e, LlmUnavailable):
+        return {"status": e.status_code, "error": str(e.detail)}
+    return {"status": status.HTTP_500_INTERNAL_SERVER_ERROR, "error": "Workout Generation Failed"}
+
+
+'''
+Validates and generates every workout of a plan, the generations running concurrently through llm. Each valid workout
+takes a token from throttle and as many run at once as the user may have generations in flight (up to CONCURRENCY),
+so a plan is rate limited like the same workouts created one by one, a plan over the limit is a 429. Workouts that
+were generated are saved together, one that is invalid or fails does not stop the others. Returns a result per
+workout in the order they were sent, {"status": 201, "workout": {...}} or {"status": ..., "errors"/"error": ...}.
+Raises the llm error when every workout failed because the llm is unavailable, so the client gets a 503 with
+Retry-After.
+'''
+def generatePlan(user, workouts, llm, throttle):
+    results = [None] * len(workouts)
+    valid = []
+    for i, data in enumerate(workouts):
+        serializer = WorkoutSerializer(data=data)
+        if serializer.is_valid():
+            valid.append((i, serializer.validated_data))
+        else:
+            results[i] = {"status": status.HTTP_400_BAD_REQUEST, "errors": serializer.errors}
+
+    texts = []
+    if valid:
+        throttle.acquire(cost=len(valid), slots=min(len(valid), settings.WORKOUT_PLAN['CONCURRENCY']))
+        try:
+            texts = llm.requestWorkouts([data for _, data in valid], throttle.slots)
+        finally:
+            throttle.release()
+
+    generated = []
+    for (i, data), text in zip(valid, texts):
+        if isinstance(text, Exception):
+            results[i] = failedResult(text)
+        else:
+            fields = {key: value for key, value in data.items() if key != 'llm_suggested_changes'}
+            generated.append((i, Workout(user=user, **fields), text))
+
+    unavailable = [text for text in texts if isinstance(text, LlmUnavailable)]
+    if unavailable and len(unavailable) == len(workouts):
+        raise unavailable[0]
+
+    saved = createWorkouts([workout for _, workout, _ in generated], [text for _, _, text in generated])
+    for (i, _, _), workout in zip(generated, saved):
+        results[i] = {"status": status.HTTP_201_CREATED, "workout": WorkoutSerializer(workout).data}
+    return results
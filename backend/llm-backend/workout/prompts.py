@@ -0,0 +1,49 @@
+from backend.read_cache import HEALTH_SCOPE, cachedRead
+from users.models import HealthData, UserProfile
+from .llm_config import field_line, health_keys, reco_prompt, workout_keys, workout_prompt
+from .llm_metrics import estimateTokens, llm_prompt_tokens
+
+
+'''"key: value" lines in the order of keys, as the prompts have always listed them'''
+def fieldLines(keys, get):
+    return ''.join(field_line.format(key=key, value=get(key)) for key in keys)
+
+
+'''The user's health data in one query, an empty one for users without any so every key is still listed'''
+def loadHealthData(user_id):
+    profile = UserProfile.objects.select_related('health_data').filter(user_id=user_id).first()
+    return getattr(profile, 'health_data', None) or HealthData()
+
+
+'''
+Builds the prompts for one user. The health part of the workout prompt is the same for every workout the user creates,
+so it is kept in the read cache under the health scope, which only their profile and health data invalidate.
+'''
+class PromptBuilder():
+
+    def __init__(self, user=None):
+        self.user_id = user.id if user is not None else None
+
+    def healthFragment(self):
+        if self.user_id is None:
+            return fieldLines(health_keys, lambda key: None)
+        return cachedRead(self.user_id, 'prompt-health', self.buildHealthFragment, HEALTH_SCOPE)
+
+    def buildHealthFragment(self):
+        health_data = loadHealthData(self.user_id)
+        return fieldLines(health_keys, lambda key: getattr(health_data, key))
+
+    def workoutPrompt(self, workout_data):
+        prompt = workout_prompt.substitute(workout=fieldLines(workout_keys, workout_data.get), health=self.healthFragment())
+        return reportTokens('workout', prompt)
+
+    def recommendationPrompt(self, workout_list):
+        return reportTokens('recommendation', reco_prompt.substitute(workouts=str(workout_list)))
+
+
+'''Logs and records the estimated size of a prompt before it is sent'''
+def reportTokens(kind, prompt):
+    tokens = estimateTokens(prompt)
+    llm_prompt_tokens.observe(tokens, kind=kind)
+    print(f"[INFO]: {kind.capitalize()} prompt is about {tokens} tokens")
+    return prompt
@@ -0,0 +1,94 @@
+import hashlib
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+
+from workout.models import Recommendation, Workout
+from .llm_resilience import LlmUnavailable
+from .llm_singleflight import AdvisoryLock
+from .revisions import latestWorkouts
+
+
+'''Number of recent workouts a recommendation is based on'''
+WORKOUT_HISTORY_MAX = 3
+# Longest a request waits on another one generating the same recommendation, and its Retry-After once it gave up
+LOCK_WAIT = 5
+PENDING_WAIT = 5
+NO_HISTORY_MSG = '{"recommendation": "Try creating a workout to get started!", "parameters": {"length":"", "workout_type":"", "target_area":""}}'
+
+
+'''The user's recommendation for the given day, None if there is none yet. A single probe of the (user, for_date) index'''
+def findRecommendation(user, day):
+    return Recommendation.objects.select_related('user').filter(user=user, for_date=day).first()
+
+
+'''Another request is still generating the recommendation, sent as a 503 with Retry-After'''
+class RecommendationPending(LlmUnavailable):
+    default_detail = "Your recommendation is still being generated, try again shortly."
+
+
+'''
+Serializes generation of a user's recommendation for a day across threads and processes. Waiters only hold on for
+LOCK_WAIT seconds, a slow generation is not worth a request and a database connection each for its whole length
+'''
+def recommendationLock(user, day):
+    key = hashlib.sha256(f'recommendation|{user.id}|{day.isoformat()}'.encode('utf-8')).hexdigest()
+    return AdvisoryLock(key, LOCK_WAIT)
+
+
+'''Latest generated workout of each of the user's last WORKOUT_HISTORY_MAX workouts'''
+def recommendationWorkouts(user):
+    return latestWorkouts(list(Workout.objects.filter(user=user, generation_status='complete').order_by('-id')[:WORKOUT_HISTORY_MAX]))
+
+
+'''
+Generates and saves the user's recommendation for the day, None if they have no workouts to base it on. Concurrent
+first requests of the day wait for the one generating it, so the llm is called once per user per day. A request that
+gives up waiting raises RecommendationPending rather than calling the llm as well. Only the request generating it is
+charged against the user's rate limit (throttle), requests of the user's other devices waiting on it are not.
+'''
+def createRecommendation(user, day, llm, throttle=None):
+    with recommendationLock(user, day) as lock:
+        # Another request may have generated it while this one waited for the lock
+        recommendation = findRecommendation(user, day)
+        if recommendation is not None:
+            return recommendation
+        if not lock.acquired:
+            raise RecommendationPending(wait=PENDING_WAIT)
+        workouts = recommendationWorkouts(user)
+        if not workouts:
+            return None
+        with throttle or nullcontext():
+            response = llm.generateRecommendation(workouts)
+        recommendation, _ = Recommendation.objects.get_or_create(user=user, for_date=day, defaults={'recommendation': response})
+        return recommendation
+
+
+async def createRecommendationAsync(user, day, llm, throttle=None):
+    lock = recommendationLock(user, day)
+    await sync_to_async(lock.acquire)()
+    try:
+        recommendation = await sync_to_async(findRecommendation)(user, day)
+        if recommendation is not None:
+            return recommendation
+        if not lock.acquired:
+            raise RecommendationPending(wait=PENDING_WAIT)
+        workouts = await sync_to_async(recommendationWorkouts)(user)
+        if not workouts:
+            return None
+        if throttle is not None:
+            await sync_to_async(throttle.acquire)()
+        try:
+            response = await llm.generateRecommendationAsync(workouts)
+        finally:
+            if throttle is not None:
+                await sync_to_async(throttle.release)()
+        recommendation, _ = await Recommendation.objects.aget_or_create(user=user, for_date=day, defaults={'recommendation': response})
+        return recommendation
+    finally:
+        await sync_to_async(lock.release)()
+
+
+'''A placeholder shown to users without workouts, it is not saved'''
+def noHistoryRecommendation():
+    return Recommendation(recommendation=NO_HISTORY_MSG)
@@ -0,0 +1,182 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce
+
+from backend.read_cache import invalidateUser
+
+from workout.models import Exercise, Workout, WorkoutExercise, WorkoutRevision
+from .llm_output import InvalidWorkout, normalizeExerciseName, parseWorkout
+
+
+'''Another request revised the workout between its history being read and the new revision being saved'''
+class RevisionConflict(Exception):
+    pass
+
+
+'''(kind, text) pairs for a workout whose history is still in the legacy arrays'''
+def legacyRevisions(workout):
+    workouts = list(workout.llm_suggested_workout or [])
+    changes = list(workout.llm_suggested_changes or [])
+    revisions = [('workout', text) for text in workouts[:1]]
+    for i, change in enumerate(changes):
+        revisions.append(('change', change))
+        if i + 1 < len(workouts):
+            revisions.append(('workout', workouts[i + 1]))
+    revisions += [('workout', text) for text in workouts[len(changes) + 1:]]
+    return revisions
+
+
+'''Structured form of a workout generated before responses were validated, None if it does not parse'''
+def parseLegacyWorkout(text):
+    try:
+        return parseWorkout(text)
+    except InvalidWorkout:
+        return None
+
+
+'''
+Builds revision rows numbered after last_seq. New workouts must be valid, legacy ones are stored without a structured
+form when they do not parse.
+'''
+def revisionRows(workout, last_seq, revisions, legacy=0):
+    return [
+        WorkoutRevision(workout=workout, seq=last_seq + i + 1, kind=kind, text=text,
+                        structured=None if kind != 'workout' else parseLegacyWorkout(text) if i < legacy else parseWorkout(text))
+        for i, (kind, text) in enumerate(revisions)
+    ]
+
+
+'''Replaces the indexed exercises of a workout with those of its latest generated workout'''
+def projectExercises(workout, structured):
+    WorkoutExercise.objects.filter(workout=workout).delete()
+    indexExercises([(workout, structured)])
+
+
+'''Indexes the exercises of (workout, structured) pairs with nothing indexed yet, one insert per table for all of them'''
+def indexExercises(workouts):
+    exercises = [(workout, position, exercise) for workout, structured in workouts if structured
+                 for position, exercise in enumerate(structured['exercises'])]
+    if not exercises:
+        return
+    names = {normalizeExerciseName(exercise['name'])[:200]: exercise['name'][:200] for _, _, exercise in exercises}
+    Exercise.objects.bulk_create([Exercise(name=name, normalized_name=key) for key, name in names.items()], ignore_conflicts=True)
+    ids = dict(Exercise.objects.filter(normalized_name__in=names).values_list('normalized_name', 'id'))
+    WorkoutExercise.objects.bulk_create([
+        WorkoutExercise(workout=workout, exercise_id=ids[normalizeExerciseName(exercise['name'])[:200]], position=position,
+                        type=exercise['type'][:100], info=exercise['info'])
+        for workout, position, exercise in exercises
+    ])
+
+
+'''
+Change requests and generated workouts of a workout, read once and extended with append. Built from the given revision
+rows, ordered by seq, or from all of the workout's. Workouts that have not been moved by migrate_workout_revisions are
+read from the legacy arrays and moved with their next revision.
+'''
+class RevisionHistory():
+
+    def __init__(self, workout, rows=None):
+        self.workout = workout
+        rows = list(workout.revisions.all()) if rows is None else rows
+        self.last_seq = max((row.seq for row in rows), default=0)
+        self.legacy = [] if rows else legacyRevisions(workout)
+        # (seq, kind, text), legacy revisions are numbered as they will be saved
+        self.revisions = [(row.seq, row.kind, row.text) for row in rows] + \
+            [(seq, kind, text) for seq, (kind, text) in enumerate(self.legacy, start=1)]
+        structured = [row.structured for row in rows if row.kind == 'workout']
+        self.structured = structured[-1] if structured else None
+        if self.legacy and self.workouts:
+            self.structured = parseLegacyWorkout(self.workouts[-1])
+
+    @property
+    def changes(self):
+        return [text for seq, kind, text in self.revisions if kind == 'change']
+
+    @property
+    def workouts(self):
+        return [text for seq, kind, text in self.revisions if kind == 'workout']
+
+    '''
+    Saves the change requests and the workout generated for them with a single INSERT, and indexes the exercises of
+    the new workout. Raises InvalidWorkout if the workout is not in the expected format.
+    '''
+    def append(self, changes, text):
+        revisions = self.legacy + [('change', change) for change in changes] + [('workout', text)]
+        rows = revisionRows(self.workout, self.last_seq, revisions, legacy=len(self.legacy))
+        try:
+            with transaction.atomic():
+                WorkoutRevision.objects.bulk_create(rows)
+                projectExercises(self.workout, rows[-1].structured)
+                invalidateUser(self.workout.user_id)
+                if self.legacy:
+                    Workout.objects.filter(id=self.workout.id).update(llm_suggested_changes=[], llm_suggested_workout=[])
+                    # So a later save of the instance does not write them back
+                    self.workout.llm_suggested_changes = []
+                    self.workout.llm_suggested_workout = []
+        except IntegrityError:
+            # (workout, seq) is unique, so a concurrent revision makes this insert fail instead of interleaving
+            raise RevisionConflict()
+        self.revisions = self.revisions[:len(self.revisions) - len(self.legacy)] + [(row.seq, row.kind, row.text) for row in rows]
+        self.last_seq += len(revisions)
+        self.legacy = []
+        self.structured = rows[-1].structured
+
+
+'''
+History of a workout with only what a change needs: the latest generated workout, the change requests not yet folded
+into the workout's summary and at least the last recent_changes of them. Read with one query however many times the
+workout was revised, the older revisions are left in the database.
+'''
+def changeHistory(workout, recent_changes=None):
+    if recent_changes is None:
+        recent_changes = settings.REVISION_HISTORY['RECENT_CHANGES']
+    revisions = WorkoutRevision.objects.filter(workout=workout)
+    latest = revisions.filter(kind='workout').order_by('-seq').values('seq')[:1]
+    changes = Q(seq__gt=workout.history_summary_seq)
+    if recent_changes > 0:
+        oldest_recent = revisions.filter(kind='change').order_by('-seq').values('seq')[recent_changes - 1:recent_changes]
+        changes |= Q(seq__gte=Coalesce(Subquery(oldest_recent), 0))
+    return RevisionHistory(workout, list(revisions.filter(Q(kind='change') & changes | Q(seq=Subquery(latest))).order_by('seq')))
+
+
+'''Saves the first generated workout of a workout and indexes its exercises'''
+def addFirstWorkout(workout, text, ignore_conflicts=False):
+    rows = revisionRows(workout, 0, [('workout', text)])
+    with transaction.atomic():
+        WorkoutRevision.objects.bulk_create(rows, ignore_conflicts=ignore_conflicts)
+        projectExercises(workout, rows[0].structured)
+        invalidateUser(workout.user_id)
+
+
+'''Saves a new workout together with its first generated workout'''
+def createWorkout(serializer, text, **kwargs):
+    with transaction.atomic():
+        workout = serializer.save(**kwargs)
+        addFirstWorkout(workout, text)
+    return workout
+
+
+'''
+Saves new workouts together with their first generated workouts (texts, in the same order) with one bulk insert per
+table, returns the saved workouts with their revisions prefetched. Bulk inserts send no signals, so the user's read
+cache is invalidated here.
+'''
+def createWorkouts(workouts, texts):
+    with transaction.atomic():
+        workouts = Workout.objects.bulk_create(workouts)
+        rows = [revisionRows(workout, 0, [('workout', text)])[0] for workout, text in zip(workouts, texts)]
+        WorkoutRevision.objects.bulk_create(rows)
+        indexExercises([(workout, row.structured) for workout, row in zip(workouts, rows)])
+        for user_id in {workout.user_id for workout in workouts}:
+            invalidateUser(user_id)
+    prefetch_related_objects(workouts, 'revisions')
+    return workouts
+
+
+'''Most recent generated workout of each of the given workouts, with one query for all of them'''
+def latestWorkouts(workouts):
+    latest = dict(WorkoutRevision.objects.filter(workout__in=[workout.id for workout in workouts], kind='workout')
+                  .order_by('workout_id', '-seq').distinct('workout_id').values_list('workout_id', 'text'))
+    texts = [latest.get(workout.id) or (workout.llm_suggested_workout or [None])[-1] for workout in workouts]
+    return [text for text in texts if text is not None]
@@ -1,8 +1,14 @@
 from rest_framework import serializers
-from workout.models import Workout, Recommendation
+from workout.models import Workout, Recommendation, WorkoutJob
+from workout.revisions import RevisionHistory
 
 class WorkoutSerializer(serializers.ModelSerializer):
     user = serializers.EmailField(source='user.email', read_only=True)
+    # New change requests on a patch, the full history is read from WorkoutRevision
+    llm_suggested_changes = serializers.ListField(child=serializers.CharField(), required=False)
+    llm_suggested_workout = serializers.ListField(child=serializers.CharField(), read_only=True)
+    # Latest generated workout as {"exercises": [{"name": "", "type": "", "info": ""}]}
+    structured_workout = serializers.JSONField(read_only=True, default=None)
     
     class Meta:
         model = Workout
@@ -20,11 +26,50 @@ class WorkoutSerializer(serializers.ModelSerializer):
             'other_workout_considerations',
             'llm_suggested_changes',
             'llm_suggested_workout',
+            'structured_workout',
+            'generation_status',
             'workout_rating',
             'workout_comments',
             'actual_length'
         ]
-        read_only_fields = ['id', 'user', 'created']
+        read_only_fields = ['id', 'user', 'created', 'generation_status']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        history = RevisionHistory(instance)
+        data['llm_suggested_changes'] = history.changes
+        data['llm_suggested_workout'] = history.workouts
+        data['structured_workout'] = history.structured
+        return data
+
+    # Change requests are saved as revisions by the views, never to the legacy arrays
+    def create(self, validated_data):
+        validated_data.pop('llm_suggested_changes', None)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        validated_data.pop('llm_suggested_changes', None)
+        return super().update(instance, validated_data)
+
+'''Workout without the llm arrays and free text fields, used by the history list'''
+class WorkoutSummarySerializer(serializers.ModelSerializer):
+    user = serializers.EmailField(source='user.email', read_only=True)
+
+    class Meta:
+        model = Workout
+        fields = [
+            'id',
+            'user',
+            'created',
+            'length',
+            'difficulty',
+            'workout_type',
+            'target_area',
+            'equipment_access',
+            'generation_status',
+            'workout_rating',
+            'actual_length'
+        ]
     
 class RecommendationSerializer(serializers.ModelSerializer):
     user = serializers.EmailField(source='user.email', read_only=True)
@@ -36,4 +81,20 @@ class RecommendationSerializer(serializers.ModelSerializer):
             'user',
             'created',
             'recommendation'
-        ]
\ No newline at end of file
+        ]
+
+class WorkoutJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source='id', read_only=True)
+    workout_id = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = WorkoutJob
+        fields = [
+            'job_id',
+            'workout_id',
+            'status',
+            'attempts',
+            'error',
+            'created',
+            'updated'
+        ]
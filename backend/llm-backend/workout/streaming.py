@@ -0,0 +1,85 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+
+from .llm_output import InvalidWorkout
+from .llm_resilience import LlmUnavailable
+from .revisions import RevisionConflict
+
+
+'''Formats a Server-Sent Event, data is json encoded so chunks containing newlines stay on one data line'''
+def sseEvent(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+'''
+The llm is overloaded or failing. The stream has already started with a 200, so the Retry-After a plain request would
+get is sent in the event
+'''
+def unavailableEvent(e):
+    print(f"[ERROR]:{str(e.detail)}" )
+    return sseEvent('error', {"error": str(e.detail), "retry_after": e.wait})
+
+
+'''
+Forwards llm chunks as "chunk" events. Once the stream completes the full text is passed to save, and the saved
+workout is sent as a final "done" event. If generation fails an "error" event is sent instead and nothing is saved.
+'''
+def workoutEventStream(chunks, save):
+    text = []
+    try:
+        for chunk in chunks:
+            text.append(chunk)
+            yield sseEvent('chunk', chunk)
+    except LlmUnavailable as e:
+        yield unavailableEvent(e)
+        return
+    except Exception as e:
+        print(f"[ERROR]:{str(e)}" )
+        yield sseEvent('error', {"error": "Workout Generation Failed"})
+        return
+    try:
+        data = save(''.join(text))
+    except InvalidWorkout as e:
+        print(f"[ERROR]:{str(e)}" )
+        yield sseEvent('error', {"error": "Workout Generation Failed"})
+        return
+    except RevisionConflict:
+        yield sseEvent('error', {"error": "Workout was changed by another request."})
+        return
+    yield sseEvent('done', data)
+
+
+'''Async version of workoutEventStream, save is a sync function that is run in a thread'''
+async def workoutEventStreamAsync(chunks, save):
+    text = []
+    try:
+        async for chunk in chunks:
+            text.append(chunk)
+            yield sseEvent('chunk', chunk)
+    except LlmUnavailable as e:
+        yield unavailableEvent(e)
+        return
+    except Exception as e:
+        print(f"[ERROR]:{str(e)}" )
+        yield sseEvent('error', {"error": "Workout Generation Failed"})
+        return
+    try:
+        data = await sync_to_async(save)(''.join(text))
+    except InvalidWorkout as e:
+        print(f"[ERROR]:{str(e)}" )
+        yield sseEvent('error', {"error": "Workout Generation Failed"})
+        return
+    except RevisionConflict:
+        yield sseEvent('error', {"error": "Workout was changed by another request."})
+        return
+    yield sseEvent('done', data)
+
+
+def eventStreamResponse(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
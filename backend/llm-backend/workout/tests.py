@@ -1,17 +1,58 @@
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from users.models import HealthData
 from users.models import UserProfile
-from llm.views import LlmPromptView
-from unittest.mock import patch
+from workout.async_views import AsyncAPIView, AsyncCreateWorkoutView
+from workout.llm_connection import LlmConnection
+from workout.llm_providers import FakeProvider, GeminiProvider, LlmEmptyResponse, LlmProvider
+from workout.llm_admission import AdmissionController, LlmOverloaded, llm_admission_shed
+from workout.llm_resilience import CircuitBreaker, CircuitOpen, LlmTimeout, LlmUnavailable, ResilientProvider, llm_hedges, llm_retries
+from google.api_core import exceptions as google_exceptions
+from workout.llm_config import history_summary, prompt_end, reco_start, reco_end
+from workout.llm_cache import LlmCache, LlmResponsePending, LocalCacheBackend, DatabaseCacheBackend, getLlmCache
+from workout.llm_singleflight import AdvisoryLock, SingleFlight
+from workout.throttling import LlmThrottle
+from asgiref.sync import sync_to_async
+from workout.jobs import runNextJob
+from workout.models import Exercise, GenerationLease, IdempotencyRecord, LlmUsage, LlmUsageDaily, Recommendation, RecommendationRun, Workout, WorkoutJob, WorkoutRevision
+from workout.revisions import RevisionConflict, RevisionHistory, addFirstWorkout, changeHistory
+from workout.recommendations import RecommendationPending, createRecommendation
+from workout.llm_output import InvalidWorkout, parseWorkout
+from django.core.management import call_command
+from django.db import close_old_connections, connection
+from django.test.utils import CaptureQueriesContext
+from django.core.signals import request_finished
+from io import StringIO
+from workout.llm_metrics import estimateTokens, llm_calls, llm_prompt_tokens, llm_tokens, reportUsage
+from workout.llm_usage import usage_ledger
+from workout.chat_history import ChatHistory
+from backend.metrics import Histogram, MetricsRegistry, http_request_db_queries
+from unittest.mock import AsyncMock, Mock, patch
+import json
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from django.utils import timezone
+from django.test import override_settings
+from django.conf import settings
 
 
 User = get_user_model()
 
+'''A generated workout in the format asked for in llm_config.prompt_end'''
+def sampleWorkout(name='Push Ups'):
+    return json.dumps({"workout": [{"exericse": {"name": name, "type": "Strength", "info": "3 sets of 12 reps"}}]})
+
+SAMPLE_WORKOUT = sampleWorkout()
+
 class CreatePromptTest(APITestCase):
     def setUp(self):
         # Create a user and associated UserProfile
@@ -39,7 +80,7 @@ class CreatePromptTest(APITestCase):
         )
 
         # Confirm data has saved correctly
-        self.view = LlmPromptView()
+        self.view = LlmConnection(user=self.user)
 
     def test_create_prompt(self):
         # Simulated data
@@ -52,13 +93,47 @@ class CreatePromptTest(APITestCase):
         }
         
         
-        prompt_text = self.view.createPrompt(ser_obj_data)        
+        prompt_text = self.view.generatePrompt(ser_obj_data)
         # print("[TEST] Final prompt text:\n", prompt_text)
         self.assertIn("length: 60", prompt_text)
         self.assertIn("difficulty: Easy", prompt_text)
         self.assertIn("workout_type: Resistance Training", prompt_text)
         self.assertIn("target_area: Chest", prompt_text)
         self.assertIn("equipment_access: Full Gym", prompt_text)
+        self.assertIn("gender: Male", prompt_text)
+        self.assertTrue(prompt_text.endswith(prompt_end))
+
+    def test_prompt_uses_requesting_users_health_data(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='testpassword')
+        HealthData.objects.filter(profile__user=other).update(gender='Female', fitness_goal='Run a marathon')
+
+        prompt_text = LlmConnection(user=other).generatePrompt({'length': 30})
+        self.assertIn("gender: Female", prompt_text)
+        self.assertIn("fitness_goal: Run a marathon", prompt_text)
+        self.assertNotIn("Build muscle", prompt_text)
+
+    def test_health_fragment_memoized_until_changed(self):
+        self.view.generatePrompt({'length': 30})
+        with self.assertNumQueries(0):
+            self.view.generatePrompt({'length': 45})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.health_data.fitness_goal = 'Get flexible'
+            self.health_data.save()
+        self.assertIn("fitness_goal: Get flexible", self.view.generatePrompt({'length': 30}))
+
+    def test_health_fragment_kept_when_workouts_change(self):
+        self.view.generatePrompt({'length': 30})
+        with self.captureOnCommitCallbacks(execute=True):
+            workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+            addFirstWorkout(workout, sampleWorkout())
+        with self.assertNumQueries(0):
+            self.view.generatePrompt({'length': 45})
+
+    def test_prompt_tokens_reported(self):
+        before = llm_prompt_tokens.get(kind='workout')
+        self.view.generatePrompt({'length': 30})
+        self.assertEqual(llm_prompt_tokens.get(kind='workout')['count'], before['count'] + 1)
 
 
 class CreateWorkoutTest(APITestCase):
@@ -93,7 +168,7 @@ class CreateWorkoutTest(APITestCase):
     @patch('workout.views.LlmConnection.requestWorkout')
     def test_post_workout(self, mock_requestWorkout):
         # Mock the LLM response
-        mock_requestWorkout.return_value = 'Sample LLM Response'
+        mock_requestWorkout.return_value = SAMPLE_WORKOUT
 
         # Verify healthdata in the test
         health_data = HealthData.objects.filter(profile__user=self.user).first()
@@ -120,3 +195,1453 @@ class CreateWorkoutTest(APITestCase):
        
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         mock_requestWorkout.assert_called_once()
+
+    @patch('workout.async_views.LlmConnection.requestWorkoutAsync', new_callable=AsyncMock)
+    async def test_post_workout_async(self, mock_requestWorkoutAsync):
+        mock_requestWorkoutAsync.return_value = SAMPLE_WORKOUT
+
+        url = reverse('async-create-workout')
+        data = {
+            'length': 60,
+            'difficulty': 'Easy',
+            'workout_type': 'Resistance Training',
+            'target_area': 'Chest',
+            'equipment_access': 'Full Gym'
+        }
+        response = await self.async_client.post(url, data, content_type='application/json',
+                                                headers={'Authorization': 'Bearer ' + self.access_token})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['llm_suggested_workout'], [SAMPLE_WORKOUT])
+        mock_requestWorkoutAsync.assert_awaited_once()
+
+    async def test_post_workout_async_requires_token(self):
+        response = await self.async_client.post(reverse('async-create-workout'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class LlmCacheTest(APITestCase):
+    def test_gives_up_instead_of_generating_twice(self):
+        cache = LlmCache(LocalCacheBackend(max_entries=10), ttl=60, advisory_lock=True, lock_timeout=0.1)
+        key = cache.makeKey('prompt', 'model')
+        generate = Mock(return_value='Sample LLM Response')
+        held, done = threading.Event(), threading.Event()
+
+        def hold():
+            # Another process generating the same response
+            try:
+                with AdvisoryLock(key, 1):
+                    held.set()
+                    done.wait(5)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            holder = pool.submit(hold)
+            held.wait(5)
+            with self.assertRaises(LlmResponsePending) as raised:
+                cache.getOrGenerate('prompt', 'model', generate)
+            self.assertEqual(raised.exception.wait, 5)
+            # Once the other process stored it, even a request bypassing the cache gets it instead of waiting again
+            cache.set(key, 'model', 'Sample LLM Response')
+            self.assertEqual(cache.getOrGenerate('prompt', 'model', generate, bypass=True), 'Sample LLM Response')
+            done.set()
+            holder.result()
+        generate.assert_not_called()
+
+    def test_identical_prompt_is_served_from_cache(self):
+        cache = LlmCache(LocalCacheBackend(max_entries=10), ttl=60)
+        generate = Mock(return_value='Sample LLM Response')
+
+        first = cache.getOrGenerate('difficulty: Easy\nworkout_type: Cardio\n', 'gemini-1.5-flash', generate)
+        second = cache.getOrGenerate('  difficulty:  Easy\n\nworkout_type: Cardio', 'gemini-1.5-flash', generate)
+
+        self.assertEqual(first, second)
+        generate.assert_called_once()
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_model_version_and_bypass_skip_cache(self):
+        cache = LlmCache(LocalCacheBackend(max_entries=10), ttl=60)
+        generate = Mock(return_value='Sample LLM Response')
+
+        cache.getOrGenerate('prompt', 'gemini-1.5-flash', generate)
+        cache.getOrGenerate('prompt', 'gemini-1.5-pro', generate)
+        cache.getOrGenerate('prompt', 'gemini-1.5-flash', generate, bypass=True)
+        self.assertEqual(generate.call_count, 3)
+
+    def test_local_backend_evicts_least_recently_used(self):
+        backend = LocalCacheBackend(max_entries=2)
+        backend.set('a', 'model', 'A', ttl=60)
+        backend.set('b', 'model', 'B', ttl=60)
+        backend.get('a')
+        backend.set('c', 'model', 'C', ttl=60)
+
+        self.assertEqual(backend.get('a'), 'A')
+        self.assertIsNone(backend.get('b'))
+        backend.set('d', 'model', 'D', ttl=-1)
+        self.assertIsNone(backend.get('d'))
+
+    def test_database_backend(self):
+        cache = LlmCache(DatabaseCacheBackend(max_entries=10), ttl=60)
+        generate = Mock(return_value='Sample LLM Response')
+
+        cache.getOrGenerate('prompt', 'gemini-1.5-flash', generate)
+        self.assertEqual(cache.getOrGenerate('prompt', 'gemini-1.5-flash', generate), 'Sample LLM Response')
+        generate.assert_called_once()
+
+
+class SingleFlightTest(APITestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def generate():
+            calls.append(1)
+            release.wait(5)
+            return 'Sample LLM Response'
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            leader = pool.submit(flight.do, 'key', generate)
+            while 'key' not in flight.calls:
+                pass
+            waiters = [pool.submit(flight.do, 'key', generate) for _ in range(4)]
+            # Give the waiters time to join the in-flight call before the leader finishes
+            threading.Event().wait(0.1)
+            release.set()
+            results = [leader.result()] + [waiter.result() for waiter in waiters]
+
+        self.assertEqual(results, ['Sample LLM Response'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.calls, {})
+
+    async def test_concurrent_async_callers_share_error(self):
+        flight = SingleFlight()
+        generate = AsyncMock(side_effect=RuntimeError('Gemini unavailable'))
+
+        async def slow_generate():
+            await asyncio.sleep(0.01)
+            return await generate()
+
+        results = await asyncio.gather(*[flight.doAsync('key', slow_generate) for _ in range(5)], return_exceptions=True)
+
+        generate.assert_awaited_once()
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+    async def test_waiters_take_over_from_cancelled_leader(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'Sample LLM Response'
+
+        leader = asyncio.ensure_future(flight.doAsync('key', generate))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.doAsync('key', generate)) for _ in range(3)]
+        await asyncio.sleep(0)
+        # The leader's client disconnected
+        leader.cancel()
+
+        results = await asyncio.wait_for(asyncio.gather(*waiters), 5)
+        self.assertEqual(results, ['Sample LLM Response'] * 3)
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.calls, {})
+
+    def test_waiters_take_over_from_interrupted_leader(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def interrupted():
+            started.set()
+            release.wait(5)
+            raise KeyboardInterrupt()
+
+        def lead():
+            try:
+                flight.do('key', interrupted)
+            except KeyboardInterrupt:
+                pass
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            leader = pool.submit(lead)
+            started.wait(5)
+            waiter = pool.submit(flight.do, 'key', lambda: 'Sample LLM Response')
+            threading.Event().wait(0.1)
+            release.set()
+            leader.result()
+            self.assertEqual(waiter.result(timeout=5), 'Sample LLM Response')
+        self.assertEqual(flight.calls, {})
+
+    async def test_sync_and_async_callers_share_a_call(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def generate():
+            calls.append('async')
+            await asyncio.sleep(0.1)
+            return 'Sample LLM Response'
+
+        def generateSync():
+            calls.append('sync')
+            threading.Event().wait(0.1)
+            return 'Sample LLM Response'
+
+        # A sync request waits on an async one
+        leader = asyncio.ensure_future(flight.doAsync('key', generate))
+        await asyncio.sleep(0)
+        self.assertEqual(await sync_to_async(flight.do, thread_sensitive=False)('key', generateSync), 'Sample LLM Response')
+        self.assertEqual(await leader, 'Sample LLM Response')
+
+        # And an async request on a sync one
+        started = threading.Event()
+        leader = asyncio.ensure_future(sync_to_async(flight.do, thread_sensitive=False)('key', lambda: started.set() or generateSync()))
+        await sync_to_async(started.wait, thread_sensitive=False)(5)
+        self.assertEqual(await flight.doAsync('key', generate), 'Sample LLM Response')
+        await leader
+        self.assertEqual(calls, ['async', 'sync'])
+        self.assertEqual(flight.calls, {})
+
+
+class WorkoutJobTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        cls.data = {
+            'length': 60,
+            'difficulty': 'Easy',
+            'workout_type': 'Resistance Training',
+            'target_area': 'Chest',
+            'equipment_access': 'Full Gym'
+        }
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    @patch('workout.jobs.LlmConnection.requestWorkoutFromData')
+    def test_async_workout_generation(self, mock_requestWorkoutFromData):
+        mock_requestWorkoutFromData.return_value = SAMPLE_WORKOUT
+
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        mock_requestWorkoutFromData.assert_not_called()
+        self.assertEqual(Workout.objects.get(id=response.data['workout_id']).generation_status, 'pending')
+
+        status_url = response['Location']
+        self.assertEqual(self.client.get(status_url).data['status'], 'queued')
+
+        runNextJob()
+        response = self.client.get(status_url)
+        self.assertEqual(response.data['status'], 'complete')
+        self.assertEqual(response.data['workout']['llm_suggested_workout'], [SAMPLE_WORKOUT])
+        self.assertEqual(response.data['workout']['generation_status'], 'complete')
+        self.assertIsNone(runNextJob())
+
+    @patch('workout.jobs.LlmConnection.requestWorkoutFromData')
+    def test_failed_job_is_retried_then_failed(self, mock_requestWorkoutFromData):
+        mock_requestWorkoutFromData.side_effect = RuntimeError('Gemini unavailable')
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        job = WorkoutJob.objects.get(id=response.data['job_id'])
+
+        with self.settings(WORKOUT_JOBS={'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 0, 'LEASE_SECONDS': 60}):
+            self.assertEqual(runNextJob().status, 'queued')
+            self.assertEqual(runNextJob().status, 'failed')
+
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.workout.generation_status, 'failed')
+
+
+class WorkoutStreamTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.provider = FakeProvider()
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stream_create_workout(self):
+        data = {
+            'difficulty': 'Easy',
+            'workout_type': 'Resistance Training',
+            'equipment_access': 'Full Gym'
+        }
+        response = self.client.post(reverse('create-workout-stream'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(body.count('event: chunk'), FakeProvider.stream_chunks)
+        self.assertIn('event: done', body)
+        saved = RevisionHistory(Workout.objects.get(user=self.user)).workouts
+        self.assertIn('exericse', json.loads(saved[0])['workout'][0])
+
+    def test_stream_patch_workout(self):
+        workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None',
+                                         llm_suggested_workout=['first'])
+        response = self.client.patch(reverse('specific-workout-stream', args=[workout.id]),
+                                     {'llm_suggested_changes': ['More cardio']}, format='json')
+        body = b''.join(response.streaming_content).decode()
+
+        self.assertIn('event: done', body)
+        workout.refresh_from_db()
+        # The legacy history is moved to revisions along with the new one
+        self.assertEqual(workout.llm_suggested_workout, [])
+        history = RevisionHistory(workout)
+        self.assertEqual(history.changes, ['More cardio'])
+        self.assertEqual(len(history.workouts), 2)
+        self.assertEqual(history.workouts[0], 'first')
+
+    def test_stream_reports_provider_error(self):
+        self.provider.error_rate = 1
+        data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        response = self.client.post(reverse('create-workout-stream'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        body = b''.join(response.streaming_content).decode()
+
+        self.assertIn('event: error', body)
+        self.assertFalse(Workout.objects.filter(user=self.user).exists())
+
+
+class FakeProviderTest(APITestCase):
+    def test_responses_are_deterministic_and_schema_valid(self):
+        provider = FakeProvider(seed=1)
+        workout = provider.generate('Create a workout using the following parameters:\ndifficulty: Easy')
+        self.assertEqual(workout, FakeProvider(seed=1).generate('Create a workout using the following parameters:\ndifficulty: Easy'))
+        for item in json.loads(workout)['workout']:
+            self.assertEqual(set(item['exericse']), {'name', 'type', 'info'})
+
+        recommendation = json.loads(provider.generate(reco_start + str(['{}']) + '\n' + reco_end))
+        self.assertEqual(set(recommendation['parameters']), {'length', 'workout_type', 'target_area'})
+
+    def test_incomplete_provider_cannot_be_created(self):
+        class GenerateOnly(LlmProvider):
+            def generate(self, prompt):
+                return ''
+        with self.assertRaises(TypeError):
+            GenerateOnly()
+
+    def test_latency_and_error_rate(self):
+        provider = FakeProvider(latency_distribution='uniform', latency_mean=1.0, latency_spread=0.5, error_rate=0.25, seed=3)
+        calls = [provider.nextCall() for _ in range(400)]
+
+        self.assertTrue(all(0.5 <= latency <= 1.5 for latency, _ in calls))
+        self.assertAlmostEqual(len([fails for _, fails in calls if fails]) / 400, 0.25, delta=0.07)
+
+
+class MetricsTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_histogram_text_format(self):
+        histogram = Histogram('test_seconds', "Test histogram", ['view'], buckets=(0.1, 1), registry=MetricsRegistry())
+        histogram.observe(0.05, view='a')
+        histogram.observe(0.5, view='a')
+        histogram.observe(5, view='a')
+        text = histogram.render()
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{view="a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{view="a",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{view="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{view="a"} 3', text)
+
+    def test_request_and_query_metrics(self):
+        before = http_request_db_queries.get(view='workout-list')
+        response = self.client.get(reverse('workout-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        after = http_request_db_queries.get(view='workout-list')
+        self.assertEqual(after['count'], before['count'] + 1)
+        self.assertGreater(after['sum'], before['sum'])
+
+        text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_requests_total{view="workout-list",method="GET",status="200"}', text)
+        self.assertIn('http_request_duration_seconds_bucket{view="workout-list",method="GET"', text)
+
+    def test_llm_call_metrics(self):
+        llm = LlmConnection(use_cache=False)
+        llm.provider = FakeProvider()
+        llm.generateRecommendation([sampleWorkout()])
+        # Recorded under the public method, so workouts and recommendations are told apart
+        self.assertGreaterEqual(llm_calls.get(method='generateRecommendation', outcome='ok'), 1)
+        self.assertGreater(llm_tokens.get(method='generateRecommendation', kind='response'), 0)
+
+        before = llm_calls.get(method='generateRecommendation', outcome='503')
+        llm.provider = FakeProvider(error_rate=1.0)
+        with self.assertRaises(Exception):
+            llm.generateRecommendation([sampleWorkout()])
+        self.assertEqual(llm_calls.get(method='generateRecommendation', outcome='503'), before + 1)
+
+
+class LlmUsageTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='usageuser', email='usageuser@example.com', password='testpassword')
+        cls.admin = User.objects.create_user(username='usageadmin', email='usageadmin@example.com', password='testpassword', is_staff=True)
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        cls.admin_token = str(RefreshToken.for_user(cls.admin).access_token)
+
+    def setUp(self):
+        usage_ledger.clear()
+        self.addCleanup(usage_ledger.clear)
+
+    def test_calls_are_inserted_in_one_batch(self):
+        llm = LlmConnection(use_cache=False, user=self.user, endpoint='test')
+        llm.provider = FakeProvider()
+        llm.generate('prompt', 'test')
+        llm.generate('prompt', 'test')
+        llm.provider = FakeProvider(error_rate=1.0)
+        with self.assertRaises(Exception):
+            llm.generate('prompt', 'test')
+        self.assertFalse(LlmUsage.objects.filter(user=self.user).exists())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(usage_ledger.flush(), 3)
+        rows = list(LlmUsage.objects.filter(user=self.user).order_by('id'))
+        self.assertEqual([row.outcome for row in rows], ['ok', 'ok', '503'])
+        self.assertEqual({row.endpoint for row in rows}, {'test'})
+        self.assertEqual(rows[0].prompt_tokens, estimateTokens('prompt'))
+        self.assertGreater(rows[0].response_tokens, 0)
+        self.assertEqual(rows[2].response_tokens, 0)
+
+    def test_reported_tokens_replace_the_estimate(self):
+        provider = Mock(model_version='test')
+
+        def generate(prompt):
+            reportUsage(11, 22)
+            return 'response'
+        provider.generate.side_effect = generate
+        llm = LlmConnection(use_cache=False, user=self.user, endpoint='test')
+        llm.provider = provider
+        llm.generate('prompt', 'test')
+        usage_ledger.flush()
+
+        row = LlmUsage.objects.get(user=self.user)
+        self.assertEqual((row.prompt_tokens, row.response_tokens), (11, 22))
+
+    def test_view_records_its_endpoint(self):
+        getLlmCache().clear()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        with patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider()):
+            response = self.client.post(reverse('create-workout'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        usage_ledger.flush()
+
+        row = LlmUsage.objects.get(user=self.user)
+        self.assertEqual((row.endpoint, row.method, row.model_version), ('create-workout', 'requestWorkout', 'fake'))
+
+    def test_rollup_and_top_consumers(self):
+        now = timezone.now()
+        LlmUsage.objects.bulk_create(
+            [LlmUsage(user=self.user, created=now, endpoint='create-workout', method='generate', outcome='ok',
+                      prompt_tokens=100, response_tokens=50, latency_ms=200) for i in range(3)] +
+            [LlmUsage(user=self.admin, created=now, endpoint='recommendation', method='generate', outcome='503',
+                      prompt_tokens=10, latency_ms=100)])
+        call_command('rollup_llm_usage', stdout=StringIO())
+        call_command('rollup_llm_usage', stdout=StringIO())
+
+        daily = LlmUsageDaily.objects.get(user=self.user)
+        self.assertEqual((daily.day, daily.calls, daily.errors, daily.prompt_tokens, daily.response_tokens),
+                         (timezone.localdate(), 3, 0, 300, 150))
+        self.assertEqual(LlmUsageDaily.objects.get(user=self.admin).errors, 1)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.assertEqual(self.client.get(reverse('llm-usage-top')).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.admin_token)
+        response = self.client.get(reverse('llm-usage-top'), {'days': 1, 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        users = response.data['users']
+        self.assertEqual([user['username'] for user in users], ['usageuser', 'usageadmin'])
+        self.assertEqual((users[0]['calls'], users[0]['total_tokens'], users[0]['average_latency_ms']), (3, 450, 200))
+
+
+'''Throttle settings with these limits per tier or endpoint.tier, as BURST, PER_MINUTE, CONCURRENT'''
+def throttleSettings(**limits):
+    return override_settings(LLM_THROTTLE={**settings.LLM_THROTTLE, 'ENABLED': True, 'LIMITS': {
+        key.replace('__', '.'): {'BURST': burst, 'PER_MINUTE': per_minute, 'CONCURRENT': concurrent}
+        for key, (burst, per_minute, concurrent) in limits.items()}})
+
+
+class LlmThrottleTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='throttleuser', email='throttleuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        cls.data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def createWorkout(self):
+        return self.client.post(reverse('create-workout'), self.data, format='json', HTTP_CACHE_CONTROL='no-cache')
+
+    @throttleSettings(free=(2, 1, 5))
+    def test_token_bucket_returns_429_with_retry_after(self):
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_201_CREATED)
+        response = self.createWorkout()
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # One token a minute, the bucket is empty
+        self.assertTrue(55 <= int(response['Retry-After']) <= 60)
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 2)
+
+        # Buckets are per endpoint
+        response = self.client.get(reverse('recommendation'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @throttleSettings(free=(1, 1, 5), premium=(1, 1, 5), workout__premium=(3, 1, 5))
+    def test_limits_per_tier_and_endpoint(self):
+        UserProfile.objects.update_or_create(user=self.user, defaults={'tier': 'premium'})
+        for i in range(3):
+            self.assertEqual(self.createWorkout().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @throttleSettings(free=(10, 10, 1))
+    def test_concurrency_cap(self):
+        lease = GenerationLease.objects.create(key=f'user:{self.user.id}', expires=timezone.now() + timedelta(minutes=5))
+        response = self.createWorkout()
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '5')
+
+        # A lease left behind by a dead process stops counting once it expires
+        GenerationLease.objects.filter(id=lease.id).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_201_CREATED)
+        self.assertFalse(GenerationLease.objects.exists())
+
+    @throttleSettings(free=(10, 10, 1))
+    def test_lease_released_after_failed_generation_and_stream(self):
+        with patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider(error_rate=1.0)):
+            self.assertEqual(self.createWorkout().status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertFalse(GenerationLease.objects.exists())
+
+        response = self.client.post(reverse('create-workout-stream'), self.data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertTrue(GenerationLease.objects.exists())
+        b''.join(response.streaming_content)
+        self.assertFalse(GenerationLease.objects.exists())
+
+    @throttleSettings(free=(10, 10, 1))
+    def test_lease_released_when_client_leaves_before_stream(self):
+        response = self.client.post(reverse('create-workout-stream'), self.data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertTrue(GenerationLease.objects.exists())
+        # The server closes the response without reading a chunk. Without closing the test database connection
+        request_finished.disconnect(close_old_connections)
+        try:
+            response.close()
+        finally:
+            request_finished.connect(close_old_connections)
+        self.assertFalse(GenerationLease.objects.exists())
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_201_CREATED)
+
+    async def test_async_lease_released_when_client_leaves_before_stream(self):
+        throttle = LlmThrottle(self.user, 'workout')
+        await sync_to_async(throttle.acquire)()
+
+        closed = []
+
+        async def chunks():
+            try:
+                yield 'chunk'
+                yield 'more'
+            finally:
+                closed.append(True)
+        stream = throttle.releaseAfterAsync(chunks())
+        self.assertTrue(await GenerationLease.objects.aexists())
+        self.assertEqual(await stream.__anext__(), 'chunk')
+        await sync_to_async(stream.close)()
+        self.assertFalse(await GenerationLease.objects.aexists())
+        # The llm stream it reads from is stopped too
+        self.assertEqual(closed, [True])
+
+    @patch.object(LlmConnection, 'requestWorkoutStream', side_effect=ValueError('provider failed'))
+    def test_lease_released_when_stream_cannot_start(self, mock_requestWorkoutStream):
+        with self.assertRaises(ValueError):
+            self.client.post(reverse('create-workout-stream'), self.data, format='json')
+        self.assertFalse(GenerationLease.objects.exists())
+
+    @throttleSettings(free=(2, 1, 5))
+    def test_background_jobs_take_tokens(self):
+        for i in range(2):
+            response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(WorkoutJob.objects.filter(workout__user=self.user).count(), 2)
+
+    @throttleSettings(free=(10, 10, 1))
+    def test_background_jobs_count_as_in_flight(self):
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '5')
+        # Nor can the user generate right away while the job waits
+        self.assertEqual(self.createWorkout().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        runNextJob()
+        response = self.client.post(reverse('create-workout'), self.data, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+    @throttleSettings(free=(0, 0, 1))
+    async def test_async_view_returns_429(self):
+        response = await self.async_client.post(reverse('async-create-workout'), self.data, content_type='application/json',
+                                                headers={'Authorization': 'Bearer ' + self.access_token})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertFalse(await GenerationLease.objects.aexists())
+
+
+class LlmResilienceTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='resilienceuser', email='resilienceuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def resilient(self, provider, timeout=5, max_attempts=3, failures=5, reset=30, hedge_delay=0.0):
+        return ResilientProvider(provider, timeout, max_attempts, 0, 0, CircuitBreaker(failures, reset), hedge_delay, pool_size=4)
+
+    def test_retries_upstream_errors(self):
+        provider = Mock(model_version='test')
+        provider.generate.side_effect = [google_exceptions.ServiceUnavailable("overloaded"), 'response']
+        before = llm_retries.get(method='generate', reason='503')
+        self.assertEqual(self.resilient(provider).generate('prompt'), 'response')
+        self.assertEqual(provider.generate.call_count, 2)
+        self.assertEqual(llm_retries.get(method='generate', reason='503'), before + 1)
+
+        provider.generate.side_effect = google_exceptions.ServiceUnavailable("overloaded")
+        provider.generate.reset_mock()
+        with self.assertRaises(LlmUnavailable):
+            self.resilient(provider).generate('prompt')
+        self.assertEqual(provider.generate.call_count, 3)
+
+    def test_does_not_retry_rejected_requests(self):
+        provider = Mock(model_version='test')
+        provider.generate.side_effect = google_exceptions.InvalidArgument("bad prompt")
+        with self.assertRaises(google_exceptions.InvalidArgument):
+            self.resilient(provider).generate('prompt')
+        self.assertEqual(provider.generate.call_count, 1)
+
+    def test_attempt_deadline(self):
+        start = time.monotonic()
+        with self.assertRaises(LlmTimeout):
+            self.resilient(FakeProvider(latency_mean=0.5), timeout=0.05, max_attempts=2).generate('prompt')
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        provider = Mock(model_version='test')
+        provider.generate.side_effect = google_exceptions.ServiceUnavailable("overloaded")
+        resilient = self.resilient(provider, max_attempts=1, failures=2, reset=0.1)
+        for i in range(2):
+            with self.assertRaises(LlmUnavailable):
+                resilient.generate('prompt')
+        with self.assertRaises(CircuitOpen) as raised:
+            resilient.generate('prompt')
+        self.assertEqual(raised.exception.wait, 1)
+        self.assertEqual(provider.generate.call_count, 2)
+
+        # A trial call is let through once the circuit has been open for reset seconds
+        time.sleep(0.1)
+        provider.generate.side_effect = None
+        provider.generate.return_value = 'response'
+        self.assertEqual(resilient.generate('prompt'), 'response')
+        self.assertEqual(resilient.breaker.state, 'closed')
+
+    def test_hedged_request_answers_first(self):
+        calls = []
+
+        def generate(prompt):
+            calls.append(prompt)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return f'response {len(calls)}'
+        provider = Mock(model_version='test')
+        provider.generate.side_effect = generate
+        before = llm_hedges.get(method='generate', outcome='won')
+
+        start = time.monotonic()
+        self.assertEqual(self.resilient(provider, hedge_delay=0.05).generate('prompt'), 'response 2')
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(llm_hedges.get(method='generate', outcome='won'), before + 1)
+
+    async def test_async_retry_and_deadline(self):
+        provider = Mock(model_version='test')
+        provider.generateAsync = AsyncMock(side_effect=[google_exceptions.TooManyRequests("quota"), 'response'])
+        self.assertEqual(await self.resilient(provider).generateAsync('prompt'), 'response')
+
+        with self.assertRaises(LlmTimeout):
+            await self.resilient(FakeProvider(latency_mean=0.5), timeout=0.05, max_attempts=1).generateAsync('prompt')
+
+    def test_stream_retried_before_first_chunk(self):
+        provider = Mock(model_version='test')
+        attempts = []
+
+        def stream(prompt):
+            attempts.append(prompt)
+            if len(attempts) == 1:
+                raise google_exceptions.ServiceUnavailable("overloaded")
+            yield 'a'
+            yield 'b'
+        provider.generateStream.side_effect = stream
+        self.assertEqual(list(self.resilient(provider).generateStream('prompt')), ['a', 'b'])
+        self.assertEqual(len(attempts), 2)
+
+    def test_empty_gemini_response(self):
+        provider = GeminiProvider('test', 'gemini-test')
+        response = Mock(candidates=[], usage_metadata=None)
+        with self.assertRaises(LlmEmptyResponse):
+            provider.responseText(response)
+
+    def test_open_circuit_is_a_503_with_retry_after(self):
+        resilient = self.resilient(FakeProvider(), failures=1)
+        resilient.breaker.failure()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        with patch('workout.llm_connection.getLlmProvider', return_value=resilient):
+            response = self.client.post(reverse('create-workout'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+
+
+class LlmAdmissionTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='admissionuser', email='admissionuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def holdSlot(self, controller):
+        held, done = threading.Event(), threading.Event()
+
+        def hold():
+            with controller.slot():
+                held.set()
+                done.wait(5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait(5)
+        return done, thread
+
+    def test_queue_then_shed_when_full(self):
+        controller = AdmissionController(1, 1, 5)
+        done, holder = self.holdSlot(controller)
+
+        admitted = threading.Event()
+        def wait():
+            with controller.slot():
+                admitted.set()
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        while not controller.waiters:
+            time.sleep(0.01)
+
+        before = llm_admission_shed.get(reason='queue_full')
+        with self.assertRaises(LlmOverloaded) as raised:
+            controller.acquire()
+        self.assertGreaterEqual(raised.exception.wait, 1)
+        self.assertEqual(llm_admission_shed.get(reason='queue_full'), before + 1)
+
+        # The released slot goes to the queued call
+        done.set()
+        holder.join()
+        waiter.join()
+        self.assertTrue(admitted.is_set())
+        self.assertEqual((controller.running, len(controller.waiters)), (0, 0))
+
+    def test_shed_after_max_wait(self):
+        controller = AdmissionController(1, 5, 0.05)
+        done, holder = self.holdSlot(controller)
+        before = llm_admission_shed.get(reason='wait_timeout')
+        with self.assertRaises(LlmOverloaded):
+            controller.acquire()
+        self.assertEqual(llm_admission_shed.get(reason='wait_timeout'), before + 1)
+        self.assertFalse(controller.waiters)
+        done.set()
+        holder.join()
+
+    async def test_async_waiters_get_released_slots(self):
+        controller = AdmissionController(1, 2, 5)
+        order = []
+
+        async def call(name, seconds):
+            async with controller.slotAsync():
+                order.append(name)
+                await asyncio.sleep(seconds)
+        await asyncio.gather(call('first', 0.05), call('second', 0), call('third', 0))
+        self.assertEqual(order, ['first', 'second', 'third'])
+        self.assertEqual(controller.running, 0)
+
+    def test_llm_endpoints_shed_while_others_answer(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        with patch('workout.llm_connection.admission', AdmissionController(0, 0, 0)), \
+             patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider()):
+            response = self.client.post(reverse('create-workout'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(self.client.get(reverse('workout-list')).status_code, status.HTTP_200_OK)
+
+            response = self.client.post(reverse('create-workout-stream'), data, format='json', HTTP_CACHE_CONTROL='no-cache')
+            events = b''.join(response.streaming_content).decode()
+        self.assertIn('event: error', events)
+        self.assertIn('"retry_after": 1', events)
+
+
+class IdempotencyTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='idempotencyuser', email='idempotencyuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        cls.data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.provider = FakeProvider()
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def createWorkout(self, key, data=None):
+        return self.client.post(reverse('create-workout'), data or self.data, format='json', HTTP_CACHE_CONTROL='no-cache',
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_create_replayed(self):
+        with patch.object(FakeProvider, 'generate', wraps=self.provider.generate) as generate:
+            first = self.createWorkout('create-1')
+            retry = self.createWorkout('create-1')
+            self.assertEqual(generate.call_count, 1)
+        self.assertEqual((first.status_code, retry.status_code), (status.HTTP_201_CREATED, status.HTTP_201_CREATED))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 1)
+
+        # Another key is another workout, reusing a key for another request is refused
+        self.assertEqual(self.createWorkout('create-2').status_code, status.HTTP_201_CREATED)
+        response = self.createWorkout('create-1', {**self.data, 'difficulty': 'Hard'})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 2)
+
+    def test_expired_and_failed_responses_not_replayed(self):
+        with patch.object(FakeProvider, 'generate', side_effect=ValueError('bad response')):
+            self.assertEqual(self.createWorkout('create-1').status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        # The retry generates again
+        self.assertEqual(self.createWorkout('create-1').status_code, status.HTTP_201_CREATED)
+
+        IdempotencyRecord.objects.filter(user=self.user).update(expires=timezone.now() - timedelta(seconds=1))
+        response = self.createWorkout('create-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(IdempotencyRecord.objects.filter(user=self.user).count(), 1)
+
+    def test_patch_replayed(self):
+        workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+        addFirstWorkout(workout, sampleWorkout('first'))
+        url = reverse('specific-workout', args=[workout.id])
+        responses = [self.client.patch(url, {'llm_suggested_changes': ['More cardio']}, format='json', HTTP_IDEMPOTENCY_KEY='change-1')
+                     for i in range(2)]
+
+        self.assertEqual([r.status_code for r in responses], [status.HTTP_200_OK, status.HTTP_200_OK])
+        self.assertEqual(responses[1].json(), responses[0].json())
+        # The first workout, then one change and the workout it generated
+        self.assertEqual(WorkoutRevision.objects.filter(workout=workout).count(), 3)
+
+    def test_without_key(self):
+        self.client.post(reverse('create-workout'), self.data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.client.post(reverse('create-workout'), self.data, format='json', HTTP_CACHE_CONTROL='no-cache')
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 2)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class IdempotencyInFlightTest(APITransactionTestCase):
+    # The requests run on their own threads, which only see committed rows
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='inflightuser', email='inflightuser@example.com', password='testpassword')
+        self.access_token = str(RefreshToken.for_user(self.user).access_token)
+        self.provider = FakeProvider()
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def createWorkout(self, responses):
+        try:
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+            responses.append(client.post(reverse('create-workout'), {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'},
+                                         format='json', HTTP_CACHE_CONTROL='no-cache', HTTP_IDEMPOTENCY_KEY='create-1'))
+        finally:
+            connection.close()
+
+    def test_retry_waits_for_request_in_flight(self):
+        started, finish = threading.Event(), threading.Event()
+        generate = self.provider.generate
+
+        def slowGenerate(prompt):
+            started.set()
+            finish.wait(5)
+            return generate(prompt)
+
+        responses = []
+        with patch.object(self.provider, 'generate', side_effect=slowGenerate) as calls:
+            first = threading.Thread(target=self.createWorkout, args=(responses,))
+            first.start()
+            started.wait(5)
+
+            # A retry that cannot wait that long is told to come back
+            with override_settings(IDEMPOTENCY={**settings.IDEMPOTENCY, 'WAIT_TIMEOUT': 0.1}):
+                self.createWorkout(responses)
+            self.assertEqual(responses[0].status_code, status.HTTP_409_CONFLICT)
+            self.assertEqual(responses[0]['Retry-After'], '5')
+
+            retry = threading.Thread(target=self.createWorkout, args=(responses,))
+            retry.start()
+            time.sleep(0.2)
+            finish.set()
+            first.join()
+            retry.join()
+            self.assertEqual(calls.call_count, 1)
+
+        self.assertEqual([r.status_code for r in responses[1:]], [status.HTTP_201_CREATED, status.HTTP_201_CREATED])
+        self.assertEqual(responses[2]['Idempotent-Replayed'], 'true')
+        self.assertEqual(responses[2].json(), responses[1].json())
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 1)
+
+
+class WorkoutPlanTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='planuser', email='planuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.provider = FakeProvider(latency_mean=0.3)
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def createPlan(self, workouts):
+        return self.client.post(reverse('workout-plan'), {'workouts': workouts}, format='json', HTTP_CACHE_CONTROL='no-cache')
+
+    @throttleSettings(free=(10, 5, 7))
+    def test_week_generated_concurrently(self):
+        types = ['Cardio', 'Strength', 'Yoga', 'HIIT', 'Pilates', 'Swimming', 'Cycling']
+        start = time.monotonic()
+        response = self.createPlan([{'difficulty': 'Easy', 'workout_type': t, 'equipment_access': 'None'} for t in types])
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Seven 0.3s generations take about as long as one
+        self.assertLess(elapsed, 1.2)
+        results = response.json()['results']
+        self.assertEqual([result['workout']['workout_type'] for result in results], types)
+        self.assertTrue(all(result['workout']['structured_workout']['exercises'] for result in results))
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 7)
+        self.assertEqual(WorkoutRevision.objects.filter(workout__user=self.user, kind='workout').count(), 7)
+        self.assertTrue(Workout.objects.filter(user=self.user, workout_exercises__isnull=False).exists())
+
+    @throttleSettings(free=(3, 1, 2))
+    def test_rate_limited_per_workout(self):
+        workout = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        response = self.createPlan([workout] * 4)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIsNone(response.get('Retry-After'))
+
+        running, most = [], []
+        lock = threading.Lock()
+        generate = self.provider.generate
+
+        def countRunning(prompt):
+            with lock:
+                running.append(prompt)
+                most.append(len(running))
+            try:
+                return generate(prompt)
+            finally:
+                with lock:
+                    running.remove(prompt)
+
+        with patch.object(self.provider, 'generate', side_effect=countRunning):
+            response = self.createPlan([{**workout, 'workout_type': t} for t in ('Cardio', 'Yoga', 'HIIT')])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # No more at once than the user's concurrency cap
+        self.assertEqual(max(most), 2)
+        self.assertFalse(GenerationLease.objects.exists())
+
+        # The three workouts used up the bucket
+        response = self.createPlan([workout])
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertTrue(55 <= int(response['Retry-After']) <= 60)
+
+    def test_partial_results(self):
+        generate = self.provider.generate
+
+        def failYoga(prompt):
+            if 'Yoga' in prompt:
+                raise ValueError('bad response')
+            return generate(prompt)
+
+        with patch.object(self.provider, 'generate', side_effect=failYoga):
+            response = self.createPlan([
+                {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'},
+                {'workout_type': 'Strength', 'equipment_access': 'None'},
+                {'difficulty': 'Easy', 'workout_type': 'Yoga', 'equipment_access': 'None'},
+            ])
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], [201, 400, 500])
+        self.assertIn('difficulty', results[1]['errors'])
+        self.assertEqual(list(Workout.objects.filter(user=self.user).values_list('workout_type', flat=True)), ['Cardio'])
+
+    def test_limits(self):
+        workout = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        self.assertEqual(self.createPlan([]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.createPlan([workout] * (settings.WORKOUT_PLAN['MAX_WORKOUTS'] + 1)).status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Nothing could be generated because of the llm, the client is told when to come back
+        with patch.object(self.provider, 'generate', side_effect=LlmUnavailable(wait=7)):
+            response = self.createPlan([workout, workout])
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertFalse(Workout.objects.filter(user=self.user).exists())
+
+
+class AsyncViewTest(APITestCase):
+    # The async endpoints share their handling with the sync ones, so they answer the same requests the same way
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='asyncuser', email='asyncuser@example.com', password='testpassword')
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        cls.data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=FakeProvider())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def post(self, name, data, **headers):
+        return await self.async_client.post(reverse(name), data, content_type='application/json',
+                                            headers={'Authorization': 'Bearer ' + self.access_token, 'Cache-Control': 'no-cache', **headers})
+
+    async def test_prefer_respond_async(self):
+        response = await self.post('async-create-workout', self.data, Prefer='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Location'], response.json()['status_url'])
+        self.assertTrue(await WorkoutJob.objects.filter(workout__user=self.user, status='queued').aexists())
+
+    async def test_idempotency_key_replayed(self):
+        first = await self.post('async-create-workout', self.data, **{'Idempotency-Key': 'async-1'})
+        retry = await self.post('async-create-workout', self.data, **{'Idempotency-Key': 'async-1'})
+        self.assertEqual((first.status_code, retry.status_code), (status.HTTP_201_CREATED, status.HTTP_201_CREATED))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(await Workout.objects.filter(user=self.user).acount(), 1)
+
+    async def test_plan(self):
+        response = await self.post('async-workout-plan', {'workouts': [self.data, {'difficulty': 'Easy'}]})
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result['status'] for result in response.json()['results']], [201, 400])
+
+    @patch.object(LlmConnection, 'requestWorkoutAsync', new_callable=AsyncMock, side_effect=ValueError('bad response'))
+    @patch.object(LlmConnection, 'requestWorkout', side_effect=ValueError('bad response'))
+    async def test_same_error_body(self, mock_requestWorkout, mock_requestWorkoutAsync):
+        sync_response = await sync_to_async(self.client.post)(reverse('create-workout'), self.data, format='json')
+        async_response = await self.post('async-create-workout', self.data)
+        self.assertEqual(sync_response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(async_response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(async_response.json(), sync_response.json())
+        self.assertEqual(sync_response.json(), {"error": "Workout Generation Failed"})
+
+    async def test_permissions_enforced(self):
+        with patch.object(AsyncCreateWorkoutView, 'permission_classes', [IsAdminUser]):
+            response = await self.post('async-create-workout', self.data)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.json(), {"detail": "You do not have permission to perform this action."})
+
+    def test_error_details_sent_as_json(self):
+        response = AsyncAPIView().exceptionResponse(ValidationError({'length': ['A valid integer is required.']}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), {'length': ['A valid integer is required.']})
+
+
+class WorkoutListTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+        Workout.objects.bulk_create([
+            Workout(user=cls.user, difficulty='Easy' if i % 2 else 'Hard', workout_type='Cardio' if i < 3 else 'Yoga',
+                    equipment_access='None', llm_suggested_workout=['workout'])
+            for i in range(7)
+        ])
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_cursor_pagination(self):
+        ids = []
+        url = reverse('workout-list') + '?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data), 3)
+            ids += [workout['id'] for workout in response.data]
+            url = response.get('Link', '').partition('<')[2].partition('>')[0]
+
+        # Every workout exactly once, newest first
+        expected = list(Workout.objects.filter(user=self.user).order_by('-created', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_summary_and_filters(self):
+        response = self.client.get(reverse('workout-list'), {'view': 'summary', 'workout_type': 'Cardio', 'difficulty': 'Easy'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertNotIn('llm_suggested_workout', response.data[0])
+        self.assertFalse(response.has_header('Link'))
+
+        today = timezone.localdate()
+        self.assertEqual(len(self.client.get(reverse('workout-list'), {'created_after': today}).data), 7)
+        self.assertEqual(len(self.client.get(reverse('workout-list'), {'created_before': today - timedelta(days=1)}).data), 0)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse('workout-list'), {'cursor': 'nonsense'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('workout-list'), {'difficulty': 'Extreme'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ReadCacheTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='testuser@example.com', password='testpassword')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.user).access_token))
+        self.workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+        addFirstWorkout(self.workout, SAMPLE_WORKOUT)
+
+    def test_repeated_reads_are_cached(self):
+        url = reverse('specific-workout', args=[self.workout.id])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['structured_workout']['exercises'][0]['name'], 'Push Ups')
+
+    def test_writes_invalidate(self):
+        url = reverse('specific-workout', args=[self.workout.id])
+        self.client.get(url)
+        # Invalidation happens on commit, which the test transaction never reaches on its own
+        with self.captureOnCommitCallbacks(execute=True):
+            RevisionHistory(self.workout).append(['More core'], sampleWorkout('Plank'))
+        self.assertEqual(self.client.get(url).data['structured_workout']['exercises'][0]['name'], 'Plank')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {'workout_rating': 4}, format='json')
+        self.assertEqual(self.client.get(url).data['workout_rating'], 4)
+
+
+class WorkoutRevisionTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+        WorkoutRevision.objects.create(workout=self.workout, seq=1, kind='workout', text='first')
+
+    @patch.object(LlmConnection, 'changeWorkout', return_value=sampleWorkout('Squats'))
+    def test_patch_appends_revision(self, mock_changeWorkout):
+        response = self.client.patch(reverse('specific-workout', args=[self.workout.id]),
+                                     {'llm_suggested_changes': ['More cardio'], 'workout_rating': 4}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['llm_suggested_changes'], ['More cardio'])
+        self.assertEqual(response.data['llm_suggested_workout'], ['first', sampleWorkout('Squats')])
+        self.assertEqual(response.data['structured_workout']['exercises'][0]['name'], 'Squats')
+        self.assertEqual(response.data['workout_rating'], 4)
+        (history,), _ = mock_changeWorkout.call_args
+        self.assertEqual(history[0]['parts'][1:], ['More cardio'])
+        self.assertEqual(history[1], {'role': 'model', 'parts': ['first']})
+        self.assertEqual(list(self.workout.revisions.values_list('seq', 'kind')), [(1, 'workout'), (2, 'change'), (3, 'workout')])
+
+    @patch.object(LlmConnection, 'changeWorkout', return_value=sampleWorkout('Squats'))
+    def test_patch_queries_stay_flat(self, mock_changeWorkout):
+        url = reverse('specific-workout', args=[self.workout.id])
+        queries = []
+        for revisions in (2, 20):
+            while self.workout.revisions.count() < revisions * 2:
+                RevisionHistory(self.workout).append(['More cardio'], sampleWorkout('Rowing'))
+            # Folds the older change requests into the summary, as every patch after it does with one more
+            self.client.patch(url, {'llm_suggested_changes': ['Less cardio']}, format='json')
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.patch(url, {'llm_suggested_changes': ['Less cardio']}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        # Only the prompt is built from the recent revisions, the response has them all like GET
+        self.assertEqual(response.data, self.client.get(url).data)
+        self.assertEqual(len(response.data['llm_suggested_changes']), self.workout.revisions.filter(kind='change').count())
+
+    @patch.object(LlmConnection, 'changeWorkout', side_effect=ValueError('bad response'))
+    def test_failed_change_keeps_summary(self, mock_changeWorkout):
+        for i in range(5):
+            RevisionHistory(self.workout).append([f'change {i}'], sampleWorkout('Rowing'))
+        response = self.client.patch(reverse('specific-workout', args=[self.workout.id]),
+                                     {'llm_suggested_changes': ['More cardio']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.workout.refresh_from_db()
+        self.assertEqual((self.workout.history_summary, self.workout.history_summary_seq), ('', 0))
+
+    def test_concurrent_revision_conflicts(self):
+        history = RevisionHistory(self.workout)
+        RevisionHistory(self.workout).append(['Less cardio'], sampleWorkout('Rowing'))
+        with self.assertRaises(RevisionConflict):
+            history.append(['More cardio'], sampleWorkout('Squats'))
+
+    def test_migrate_legacy_arrays(self):
+        legacy = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None',
+                                        llm_suggested_changes=['a', 'b'], llm_suggested_workout=['w0', 'w1', 'w2'])
+        call_command('migrate_workout_revisions', stdout=StringIO())
+
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.llm_suggested_changes, legacy.llm_suggested_workout), ([], []))
+        self.assertEqual(list(legacy.revisions.values_list('kind', 'text')),
+                         [('workout', 'w0'), ('change', 'a'), ('workout', 'w1'), ('change', 'b'), ('workout', 'w2')])
+        # Workouts already using revisions are left alone
+        self.assertEqual(self.workout.revisions.count(), 1)
+
+
+class ChatHistoryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='testuser@example.com', password='testpassword')
+        self.workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+        addFirstWorkout(self.workout, sampleWorkout('w0'))
+
+    def revise(self, count, start=0):
+        for i in range(start, start + count):
+            RevisionHistory(self.workout).append([f'change {i}'], sampleWorkout(f'w{i + 1}'))
+
+    def build(self, changes, **kwargs):
+        chat_history = ChatHistory(self.workout, RevisionHistory(self.workout), **kwargs)
+        turns = chat_history.build(changes)
+        chat_history.saveSummary()
+        return turns
+
+    def test_keeps_request_latest_workout_and_recent_changes(self):
+        self.revise(5)
+        user, model = self.build(['new change'], recent_changes=3)
+        self.assertIn("workout_type: Cardio", user['parts'][0])
+        self.assertEqual(user['parts'][1], history_summary + 'change 0; change 1; change 2')
+        self.assertEqual(user['parts'][2:], ['change 3', 'change 4', 'new change'])
+        self.assertEqual(model['parts'], [sampleWorkout('w5')])
+
+    def test_summary_is_stored_once(self):
+        self.revise(3)
+        self.build(['new change'], recent_changes=2)
+        self.workout.refresh_from_db()
+        self.assertEqual((self.workout.history_summary, self.workout.history_summary_seq), ('change 0; change 1', 4))
+
+        # Nothing new dropped out of the recent changes, so nothing is written
+        chat_history = ChatHistory(self.workout, RevisionHistory(self.workout), recent_changes=2)
+        with self.assertNumQueries(0):
+            chat_history.build(['new change'])
+            chat_history.saveSummary()
+
+    def test_size_stays_flat(self):
+        # Once the summary fills its half of the budget, more revisions do not make the history any longer
+        sizes = []
+        self.revise(60)
+        for more in (0, 30):
+            self.revise(more, start=60)
+            sizes.append(sum(estimateTokens(part) for turn in self.build(['new change'], max_tokens=200) for part in turn['parts']))
+        self.assertLessEqual(max(sizes), 200)
+        self.assertLessEqual(abs(sizes[1] - sizes[0]), 5)
+
+    def test_change_history_reads_only_what_is_sent(self):
+        self.revise(8)
+        full = self.build(['new change'], recent_changes=3)
+        self.workout.refresh_from_db()
+        history = changeHistory(self.workout, recent_changes=3)
+        # The latest workout and the last three change requests, the rest is in the summary
+        self.assertEqual([kind for seq, kind, text in history.revisions], ['change', 'change', 'change', 'workout'])
+        self.assertEqual(history.last_seq, 17)
+        self.assertEqual(ChatHistory(self.workout, history, recent_changes=3).build(['new change']), full)
+
+        history.append(['new change'], sampleWorkout('w9'))
+        self.assertEqual(list(self.workout.revisions.values_list('seq', flat=True))[-2:], [18, 19])
+
+
+class StructuredWorkoutTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpassword'
+        )
+        cls.access_token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_parse_workout(self):
+        text = '```json\n{"workout": [{"exercise": {"name": " Plank ", "type": "Core"}}]}\n```'
+        self.assertEqual(parseWorkout(text), {'exercises': [{'name': 'Plank', 'type': 'Core', 'info': ''}]})
+        for invalid in ['Sample LLM Response', '{"workout": []}', '{"workout": [{"exericse": {"type": "Core"}}]}']:
+            with self.assertRaises(InvalidWorkout):
+                parseWorkout(invalid)
+
+    def test_invalid_response_is_not_saved_or_cached(self):
+        data = {'difficulty': 'Easy', 'workout_type': 'Cardio', 'equipment_access': 'None'}
+        provider = Mock(model_version='test')
+        provider.generate.return_value = 'Sure! Here is your workout'
+        with patch('workout.llm_connection.getLlmProvider', return_value=provider):
+            response = self.client.post(reverse('create-workout'), data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            provider.generate.return_value = SAMPLE_WORKOUT
+            response = self.client.post(reverse('create-workout'), data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(provider.generate.call_count, 2)
+        self.assertEqual(Workout.objects.filter(user=self.user).count(), 1)
+
+    def test_filter_by_exercise(self):
+        for name in ['Push Ups', 'Goblet Squat']:
+            workout = Workout.objects.create(user=self.user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+            addFirstWorkout(workout, sampleWorkout(name))
+
+        response = self.client.get(reverse('workout-list'), {'exercise': 'goblet  SQUAT'})
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['structured_workout']['exercises'][0]['name'], 'Goblet Squat')
+        self.assertEqual(Exercise.objects.count(), 2)
+
+
+class PrecomputeRecommendationsTest(APITransactionTestCase):
+    # The command generates from worker threads, which only see committed rows
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='testpassword') for i in range(3)]
+        for user in self.users[:2]:
+            workout = Workout.objects.create(user=user, difficulty='Easy', workout_type='Cardio', equipment_access='None')
+            addFirstWorkout(workout, sampleWorkout(user.username))
+        # Only workouts in the last --days days make a user active
+        Workout.objects.filter(user=self.users[1]).update(created=timezone.now() - timedelta(days=30))
+        self.provider = FakeProvider()
+        # Recommendations generated by other tests would be cache hits
+        getLlmCache().clear()
+        patcher = patch('workout.llm_connection.getLlmProvider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_precompute_and_resume(self):
+        with patch.object(FakeProvider, 'generate', wraps=self.provider.generate) as generate:
+            call_command('precompute_recommendations', '--days', '7', '--chunk-size', '1', stdout=StringIO())
+            self.assertEqual(generate.call_count, 1)
+            self.assertEqual(list(Recommendation.objects.values_list('user', flat=True)), [self.users[0].id])
+
+            run = RecommendationRun.objects.get(for_date=timezone.localdate())
+            self.assertEqual((run.created_count, run.last_user_id), (1, self.users[0].id))
+            self.assertIsNotNone(run.finished)
+
+            # Running again, even from the first user, does not regenerate
+            call_command('precompute_recommendations', '--restart', stdout=StringIO())
+            self.assertEqual(generate.call_count, 1)
+
+            # The endpoint only looks the precomputed recommendation up
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.users[0]).access_token))
+            response = self.client.get(reverse('recommendation'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(generate.call_count, 1)
+
+    def test_concurrent_first_requests_generate_once(self):
+        self.provider.latency_mean = 0.2
+        day = timezone.localdate()
+
+        def recommend(_):
+            try:
+                return createRecommendation(self.users[0], day, LlmConnection(use_cache=False)).id
+            finally:
+                connection.close()
+
+        with patch.object(FakeProvider, 'generate', wraps=self.provider.generate) as generate:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                ids = list(pool.map(recommend, range(4)))
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(len(set(ids)), 1)
+        self.assertEqual(Recommendation.objects.filter(user=self.users[0], for_date=day).count(), 1)
+
+    @throttleSettings(free=(1, 0, 1))
+    def test_waiter_giving_up_does_not_generate(self):
+        day = timezone.localdate()
+        started, finish = threading.Event(), threading.Event()
+        generate = self.provider.generate
+
+        def slowGenerate(prompt):
+            started.set()
+            finish.wait(5)
+            return generate(prompt)
+
+        def recommend():
+            try:
+                throttle = LlmThrottle(self.users[0], 'recommendation')
+                return createRecommendation(self.users[0], day, LlmConnection(use_cache=False), throttle)
+            finally:
+                connection.close()
+
+        with patch.object(FakeProvider, 'generate', side_effect=slowGenerate) as calls:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                leader = pool.submit(recommend)
+                started.wait(5)
+                # The leader holds the user's only token and lease, the waiter is told to come back instead of a 429
+                with patch('workout.recommendations.LOCK_WAIT', 0.1):
+                    with self.assertRaises(RecommendationPending) as raised:
+                        recommend()
+                self.assertEqual(raised.exception.wait, 5)
+                finish.set()
+                created = leader.result()
+        self.assertEqual(calls.call_count, 1)
+        # Finding the generated recommendation is not charged either
+        self.assertEqual(recommend().id, created.id)
+
+    def test_backfill_recommendation_dates(self):
+        now = timezone.now()
+        rows = [Recommendation.objects.create(user=self.users[0], recommendation=text) for text in ('first', 'second', 'older')]
+        Recommendation.objects.filter(id=rows[0].id).update(created=now - timedelta(minutes=5))
+        Recommendation.objects.filter(id=rows[2].id).update(created=now - timedelta(days=2))
+
+        call_command('backfill_recommendation_dates', stdout=StringIO())
+        # The racing duplicate is dropped, the latest of the day is kept
+        self.assertEqual(dict(Recommendation.objects.values_list('recommendation', 'for_date')),
+                         {'second': timezone.localdate(now), 'older': timezone.localdate(now - timedelta(days=2))})
@@ -0,0 +1,202 @@
+import hashlib
+import math
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+
+from users.models import UserProfile
+from workout.models import GenerationLease, RateLimitBucket, WorkoutJob
+
+
+# Refills the bucket for the time since the last request, capped at the burst size
+REFILL = "LEAST(%(burst)s, bucket.tokens + EXTRACT(EPOCH FROM statement_timestamp() - bucket.updated) * %(rate)s)"
+
+# One round trip per request, the row lock of the upsert serializes requests of the same user and endpoint. A request
+# costing more tokens than are left takes none
+TAKE_TOKEN = f'''
+INSERT INTO {RateLimitBucket._meta.db_table} AS bucket (key, tokens, updated, allowed)
+VALUES (%(key)s, CASE WHEN %(burst)s >= %(cost)s THEN %(burst)s - %(cost)s ELSE %(burst)s END, statement_timestamp(), %(burst)s >= %(cost)s)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = CASE WHEN {REFILL} >= %(cost)s THEN {REFILL} - %(cost)s ELSE {REFILL} END,
+    allowed = {REFILL} >= %(cost)s,
+    updated = statement_timestamp()
+RETURNING tokens, allowed
+'''
+
+
+'''Staff users are limited as the staff tier, everyone else by the tier on their profile'''
+def userTier(user):
+    if user.is_staff:
+        return 'staff'
+    return UserProfile.objects.filter(user_id=user.id).values_list('tier', flat=True).first() or 'free'
+
+
+'''Limits of a tier on an endpoint, endpoint.tier overrides the tier's own limits'''
+def throttleLimits(scope, tier):
+    limits = settings.LLM_THROTTLE['LIMITS']
+    return limits.get(f'{scope}.{tier}') or limits.get(tier) or limits['free']
+
+
+'''
+Rate limit of one user's generations on an llm endpoint (scope): a token bucket of requests per endpoint and a cap on
+generations in flight across all endpoints, background jobs included. Both live in the database so every server
+process shares them. acquire raises Throttled, which DRF turns into a 429 with Retry-After. Used as a context manager
+around the llm call, streams release once they finish with releaseAfter and jobs are charged with acquireJob.
+'''
+class LlmThrottle():
+    # Retry-After for a request turned away by the concurrency cap, about the time a generation takes
+    concurrency_wait = 5
+
+    def __init__(self, user, scope):
+        self.user = user
+        self.scope = scope
+        self.lease_ids = []
+        # Generations the request may run at once, the leases it holds
+        self.slots = 0
+
+    '''
+    Takes cost tokens and a lease for each of up to slots generations at once, at least one. A request that runs
+    several generations (a plan) gets as many leases as the user has free and runs that many at a time.
+    '''
+    def acquire(self, cost=1, slots=1):
+        if not settings.LLM_THROTTLE['ENABLED']:
+            self.slots = slots
+            return
+        limits = throttleLimits(self.scope, userTier(self.user))
+        self.acquireLeases(limits['CONCURRENT'], slots)
+        try:
+            self.takeToken(limits['BURST'], limits['PER_MINUTE'] / 60, cost)
+        except Throttled:
+            self.release()
+            raise
+
+    def takeToken(self, burst, rate, cost=1):
+        with connection.cursor() as cursor:
+            cursor.execute(TAKE_TOKEN, {'key': f'{self.scope}:{self.user.id}', 'burst': burst, 'rate': rate, 'cost': cost})
+            tokens, allowed = cursor.fetchone()
+        if not allowed:
+            # A cost over the burst size never fits
+            raise Throttled(wait=math.ceil((cost - tokens) / rate) if rate > 0 and cost <= burst else None)
+
+    def acquireLeases(self, concurrent, wanted):
+        now = timezone.now()
+        with transaction.atomic():
+            free = self.freeSlots(concurrent, now)
+            if free <= 0:
+                raise Throttled(wait=self.concurrency_wait)
+            expires = now + timedelta(seconds=settings.LLM_THROTTLE['LEASE_SECONDS'])
+            leases = GenerationLease.objects.bulk_create([GenerationLease(key=self.leaseKey(), expires=expires) for i in range(min(wanted, free))])
+        self.lease_ids = [lease.id for lease in leases]
+        self.slots = len(self.lease_ids)
+
+    def leaseKey(self):
+        return f'user:{self.user.id}'
+
+    '''
+    Generations the user may start before reaching concurrent in flight, counting the leases of requests generating
+    right now and the user's background jobs that are queued or running. Runs in the caller's transaction, the lock
+    serializes the count and insert of the same user until it ends.
+    '''
+    def freeSlots(self, concurrent, now):
+        key = self.leaseKey()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lockId(key)])
+        leases = GenerationLease.objects.filter(key=key)
+        leases.filter(expires__lte=now).delete()
+        jobs = WorkoutJob.objects.filter(workout__user_id=self.user.id, status__in=['queued', 'running'])
+        return concurrent - leases.count() - jobs.count()
+
+    '''
+    Charges a background generation like acquire. The job itself counts against the concurrency cap until it
+    finishes, so there is no lease to release. Call it in the transaction that creates the job.
+    '''
+    def acquireJob(self):
+        if not settings.LLM_THROTTLE['ENABLED']:
+            return
+        limits = throttleLimits(self.scope, userTier(self.user))
+        if self.freeSlots(limits['CONCURRENT'], timezone.now()) <= 0:
+            raise Throttled(wait=self.concurrency_wait)
+        self.takeToken(limits['BURST'], limits['PER_MINUTE'] / 60)
+
+    def release(self):
+        if self.lease_ids:
+            GenerationLease.objects.filter(id__in=self.lease_ids).delete()
+            self.lease_ids = []
+            self.slots = 0
+
+    '''Passes a stream through, releasing once it is exhausted or closed'''
+    def releaseAfter(self, stream):
+        return ReleasingStream(self, stream)
+
+    def releaseAfterAsync(self, stream):
+        return ReleasingStreamAsync(self, stream)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+'''
+A stream that releases its throttle once it is exhausted, fails or is closed. Django closes the response's content
+when the response is done, even when the client went away before the first chunk was asked for and a generator's
+finally would never run.
+'''
+class ReleasingStream():
+
+    def __init__(self, throttle, stream):
+        self.throttle = throttle
+        self.stream = iter(stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.stream, 'close'):
+                self.stream.close()
+        finally:
+            self.throttle.release()
+
+
+'''Async version of ReleasingStream, Django calls close from a thread once the response is done. Closing the stream stops the llm stream it reads from'''
+class ReleasingStreamAsync():
+
+    def __init__(self, throttle, stream):
+        self.throttle = throttle
+        self.stream = stream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            await sync_to_async(self.throttle.release)()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.stream, 'aclose'):
+                async_to_sync(self.stream.aclose)()
+        finally:
+            self.throttle.release()
+
+
+'''Advisory locks take a signed bigint, use the first 64 bits of the key's sha256'''
+def lockId(key):
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16], 16) - 2 ** 63
@@ -1,9 +1,22 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path('', views.CreateWorkoutView.as_view(), name='create-workout'),
+    path('plan/', views.WorkoutPlanView.as_view(), name='workout-plan'),
     path('list/', views.WorkoutListView.as_view(), name='workout-list'),
     path('<int:id>/', views.WorkoutView.as_view(), name='specific-workout'),
-    path('recommendation/', views.WorkoutRecommendation.as_view(), name ='recommendation' )
-]
\ No newline at end of file
+    path('recommendation/', views.WorkoutRecommendation.as_view(), name ='recommendation' ),
+    path('jobs/<int:id>/', views.WorkoutJobView.as_view(), name='workout-job'),
+    path('stream/', views.CreateWorkoutStreamView.as_view(), name='create-workout-stream'),
+    path('<int:id>/stream/', views.WorkoutStreamView.as_view(), name='specific-workout-stream'),
+    path('usage/top/', views.LlmUsageTopView.as_view(), name='llm-usage-top'),
+
+    # Async variants of the llm backed endpoints, served through backend/asgi.py
+    path('async/', async_views.AsyncCreateWorkoutView.as_view(), name='async-create-workout'),
+    path('async/plan/', async_views.AsyncWorkoutPlanView.as_view(), name='async-workout-plan'),
+    path('async/<int:id>/', async_views.AsyncWorkoutView.as_view(), name='async-specific-workout'),
+    path('async/recommendation/', async_views.AsyncWorkoutRecommendation.as_view(), name='async-recommendation'),
+    path('async/stream/', async_views.AsyncCreateWorkoutStreamView.as_view(), name='async-create-workout-stream'),
+    path('async/<int:id>/stream/', async_views.AsyncWorkoutStreamView.as_view(), name='async-specific-workout-stream'),
+]
@@ -1,20 +1,27 @@
 from django.shortcuts import render
-from workout.models import Workout, Recommendation
-from workout.serializers import WorkoutSerializer, RecommendationSerializer
+from workout.models import Workout, Recommendation, WorkoutJob
+from workout.serializers import WorkoutSerializer, WorkoutSummarySerializer, RecommendationSerializer, WorkoutJobSerializer
 from .models import Workout
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
 import requests
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.core.exceptions import ObjectDoesNotExist
 from users.views import IsAccessToken
+from backend.read_cache import cachedRead
 
 #For llm prompting
-from backend.settings import API_KEY, MODEL_VERSION
-from .llm_config import *
-import google.generativeai as genai
-from users.models import HealthData
+from .llm_connection import LlmConnection
+from .llm_cache import requestAllowsCache
+from .idempotency import idempotent
+from .llm_usage import TopConsumersQuerySerializer, requestEndpoint, topConsumers
+from .throttling import LlmThrottle
+from .streaming import eventStreamResponse, workoutEventStream
+from .pagination import WorkoutListQuerySerializer, filterWorkouts, paginateWorkouts
+from .recommendations import createRecommendation
+from .handlers import (WorkoutPatch, createPlan, finishCreateWorkout, foundRecommendation, generateWithin,
+                       recommendationResponse, saveWorkout, startCreateWorkout, validWorkout)
 from datetime import *
 from django.utils import timezone
 
@@ -23,33 +30,97 @@ class CreateWorkoutView(APIView):
     permission_classes = [IsAuthenticated, IsAccessToken] # Ensures only authenticated users using access token can access this API
 
     '''Create Workout'''
+    @idempotent
     def post(self, request):
-        serializer = WorkoutSerializer(data=request.data)
-        if serializer.is_valid():
-            try:
-                llm = LlmConnection()
-                workout = llm.requestWorkout(serializer)
-
-            except Exception as e:
-                print(f"[ERROR]:{str(e)}" )
-                if hasattr(e, 'code'):
-                    print(f"[ERROR CODE]: {e.code}")
-                return Response({"error:" "Workout Generation Failed"}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-            serializer.save(user=request.user, llm_suggested_workout = [workout])
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        serializer, response = startCreateWorkout(request)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        workout, failed = generateWithin(LlmThrottle(request.user, 'workout'), 'Workout', lambda: llm.requestWorkout(serializer))
+        if failed is not None:
+            return failed
+        return finishCreateWorkout(request, serializer, workout)
     
 
+class WorkoutPlanView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    '''Create several workouts at once, e.g. a week of them, generated concurrently. 207 when some of them failed'''
+    @idempotent
+    def post(self, request):
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        return createPlan(request, llm)
+
+
+class CreateWorkoutStreamView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    '''Create Workout, streaming the llm response as Server-Sent Events'''
+    def post(self, request):
+        serializer, response = validWorkout(request)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        save = lambda text: saveWorkout(request, serializer, text)
+        stream = workoutEventStream(llm.requestWorkoutStream(serializer), save)
+
+        # Taken once nothing is left to fail before the stream releases it
+        throttle = LlmThrottle(request.user, 'workout')
+        throttle.acquire()
+        return eventStreamResponse(throttle.releaseAfter(stream))
+
+
+class WorkoutStreamView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    '''Patch Workout, streaming the revised workout as Server-Sent Events'''
+    def patch(self, request, id):
+        workout_patch = WorkoutPatch(request, id)
+        response = workout_patch.start(require_changes=True)
+        if response is not None:
+            return response
+
+        llm = LlmConnection(user = request.user, endpoint = requestEndpoint(request))
+        stream = workoutEventStream(llm.changeWorkoutStream(workout_patch.chatHistory()), workout_patch.save)
+
+        # Taken once nothing is left to fail before the stream releases it
+        throttle = LlmThrottle(request.user, 'change')
+        throttle.acquire()
+        return eventStreamResponse(throttle.releaseAfter(stream))
+
+
+class WorkoutJobView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken]
+
+    '''Progress of a background workout generation'''
+    def get(self, request, id):
+        try:
+            job = WorkoutJob.objects.select_related('workout__user').get(id=id, workout__user=request.user)
+        except WorkoutJob.DoesNotExist:
+            return Response({"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        data = WorkoutJobSerializer(job).data
+        if job.status == 'complete':
+            data['workout'] = WorkoutSerializer(job.workout).data
+        return Response(data, status=status.HTTP_200_OK)
+
+
 class WorkoutListView(APIView):
     permission_classes = [IsAuthenticated, IsAccessToken] # Ensures only authenticated users using access token can access this API
 
-    '''View workout history by user'''
+    '''View workout history by user, newest first. The next page is linked in the Link header'''
     def get(self, request):
-        workouts = Workout.objects.filter(user=request.user)
-        serializer = WorkoutSerializer(workouts, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        query = WorkoutListQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = query.validated_data
+
+        workouts, next_url = paginateWorkouts(filterWorkouts(Workout.objects.filter(user=request.user), params), params, request)
+        serializer_class = WorkoutSummarySerializer if params['view'] == 'summary' else WorkoutSerializer
+        headers = {"Link": f'<{next_url}>; rel="next"'} if next_url else None
+        return Response(serializer_class(workouts, many=True).data, status=status.HTTP_200_OK, headers=headers)
     
 class WorkoutView(APIView):
     permission_classes = [IsAuthenticated, IsAccessToken] # Ensures only authenticated users using access token can access this API
@@ -57,9 +128,10 @@ class WorkoutView(APIView):
     '''View workout'''
     def get(self, request, id):
         try:
-            workout = Workout.objects.get(user=request.user, id=id)
-            serializer = WorkoutSerializer(workout)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            # Served from the read cache until the user's workouts change
+            data = cachedRead(request.user.id, f'workout:{id}', lambda: WorkoutSerializer(
+                Workout.objects.select_related('user').prefetch_related('revisions').get(user=request.user, id=id)).data)
+            return Response(data, status=status.HTTP_200_OK)
         
         except Workout.DoesNotExist:
             return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
@@ -77,40 +149,21 @@ class WorkoutView(APIView):
             return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
         
     '''Patch Workout'''
+    @idempotent
     def patch(self, request, id):
-        try:
-            workout = Workout.objects.get(user=request.user, id=id)
-            serializer = WorkoutSerializer(workout, data=request.data, partial=True)
-            if serializer.is_valid():
-                # Only contacts the llm if sending suggested changes
-                if "llm_suggested_changes" in request.data:
-                    #Extract the change request and workout history and append it to the list of requests
-                    print("[INFO]: Changing workout. Generating history")
-                    change_history = getattr(workout, "llm_suggested_changes")
-                    workout_history = getattr(workout, "llm_suggested_workout")
-
-                    if change_history == []:
-                        change_history = serializer.validated_data.get("llm_suggested_changes")
-                    else:
-                        change_history.extend(serializer.validated_data.get("llm_suggested_changes"))
-
-                    try:
-                        llm = LlmConnection()
-                        new_workout = llm.changeWorkout(change_history, workout_history)
-
-                    except Exception as e:
-                        print(f"[ERROR]:{str(e)}" )
-                        if hasattr(e, 'code'):
-                            print(f"[ERROR CODE]: {e.code}")
-                        return Response({"error:" "Workout Generation Failed"}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-                    workout_history.append(new_workout)
-                    serializer.save(llm_suggested_changes = change_history, llm_suggested_workout = workout_history)
-                serializer.save()
-                return Response(serializer.data, status=status.HTTP_200_OK)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        except Workout.DoesNotExist:
-            return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
+        workout_patch = WorkoutPatch(request, id)
+        response = workout_patch.start()
+        if response is not None:
+            return response
+        if not workout_patch.changesWorkout():
+            return workout_patch.finish()
+
+        llm = LlmConnection(user = request.user, endpoint = requestEndpoint(request))
+        new_workout, failed = generateWithin(LlmThrottle(request.user, 'change'), 'Workout',
+                                             lambda: llm.changeWorkout(workout_patch.chatHistory()))
+        if failed is not None:
+            return failed
+        return workout_patch.finish(new_workout)
         
     '''Delete Workout'''
     def delete(self, request, id):
@@ -123,156 +176,32 @@ class WorkoutView(APIView):
 
 class WorkoutRecommendation(APIView):
     permission_classes = [IsAuthenticated, IsAccessToken]
-    workout_history_max = 3
-    no_history_msg = '{"recommendation": "Try creating a workout to get started!", "parameters": {"length":"", "workout_type":"", "target_area":""}}'
-
-    def reduceWorkoutHistory(self, workout_count):
-        return workout_count if workout_count < self.workout_history_max else self.workout_history_max
 
     def get(self, request):
 
-        #Search for recos from today
-        try:
-            recommendation = Recommendation.objects.get(user=request.user, created__date = timezone.now())
-            serializer = RecommendationSerializer(recommendation)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-
-        #If not reco for today, create one
-        except Recommendation.DoesNotExist:
-            workout_count = Workout.objects.filter(user = request.user).count()
-            num_workouts = self.reduceWorkoutHistory(workout_count)
-
-            if num_workouts == 0:
-                return Response(RecommendationSerializer(Recommendation(recommendation = self.no_history_msg)).data, status=status.HTTP_200_OK)
-
-            #Request a new recommendation for the last N workouts
-            else:
-                last_n_workouts = Workout.objects.filter(user=request.user).order_by('-id')[:num_workouts]
-                final_suggested_workout = []
-                for workout_n in last_n_workouts:
-                    suggested_list = getattr(workout_n, 'llm_suggested_workout')
-                    final_suggested_workout.append(suggested_list[-1])
-                
-                try:
-                    llm = LlmConnection()
-                    response = llm.generateRecommendation(final_suggested_workout)
-              
-                except Exception as e:
-                    print(f"[ERROR]:{str(e)}" )
-                    if hasattr(e, 'code'):
-                        print(f"[ERROR CODE]: {e.code}")
-                    return Response({"error:" "Recommendation Generation Failed"}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-                recommendation = Recommendation.objects.create(user = request.user, recommendation = response)
-                return Response(RecommendationSerializer(recommendation).data, status = status.HTTP_200_OK)
-
-
-
-    '''Patch Workout'''
-    def patch(self, request, id):
-        try:
-            workout = Workout.objects.get(user=request.user, id=id)
-            serializer = WorkoutSerializer(workout, data=request.data, partial=True)
-            if serializer.is_valid():
-                # Only contacts the llm if sending suggested changes
-                if "llm_suggested_changes" in request.data:
-                    #Extract the change request and workout history and append it to the list of requests
-                    print("[INFO]: Changing workout. Generating history")
-                    change_history = getattr(workout, "llm_suggested_changes")
-                    workout_history = getattr(workout, "llm_suggested_workout")
-
-                    if change_history == []:
-                        change_history = serializer.validated_data.get("llm_suggested_changes")
-                    else:
-                        change_history.extend(serializer.validated_data.get("llm_suggested_changes"))
-
-                    try:
-                        llm = LlmConnection()
-                        new_workout = llm.changeWorkout(change_history, workout_history)
-
-                    except Exception as e:
-                        print(f"[ERROR]:{str(e)}" )
-                        if hasattr(e, 'code'):
-                            print(f"[ERROR CODE]: {e.code}")
-                        return Response({"error:" "Workout Generation Failed"}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-                    workout_history.append(new_workout)
-                    serializer.save(llm_suggested_changes = change_history, llm_suggested_workout = workout_history)
-                serializer.save()
-                return Response(serializer.data, status=status.HTTP_200_OK)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        except Workout.DoesNotExist:
-            return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
-
-    '''Delete Workout'''
-    def delete(self, request, id):
-        try:
-            workout = Workout.objects.get(user=request.user, id=id)
-            workout.delete()
-            return Response({"message": "Workout deleted successfully."}, status=status.HTTP_200_OK)
-        except Workout.DoesNotExist:
-            return Response({"error": "Workout not found."}, status=status.HTTP_404_NOT_FOUND)
-
-
-''' Used to connect and query llm'''
-class LlmConnection():
-
-    api_key = API_KEY
-    model_version = MODEL_VERSION
-    model = genai.GenerativeModel(model_version)
-    health_obj = HealthData.objects.first()
-
-    def __init__(self):
-        genai.configure(api_key = self.api_key)
-        return
-
-    '''Request a workout from the llm'''
-    def requestWorkout(self, serializer):
-        print("[INFO]: Connecting to Gemini")
-        prompt = self.generatePrompt(serializer.validated_data)
-        response = self.model.generate_content(prompt)
-        return response.candidates[0].content.parts[0].text
-
-    '''Make changes to the current llm workout'''
-    def changeWorkout(self, change_history, workout_history):
-        #Add sending the workout prompt info as history
-        print("[INFO]: Sending workout history to Gemini")
-        chat = self.model.start_chat(
-                    history = [
-                        {"role": "user", "parts": change_history},
-                        {"role": "model", "parts": workout_history}
-                    ]
-        ) 
-        response = chat.send_message(prompt_end)
-        return response.candidates[0].content.parts[0].text
-
-    '''Generates llm prompts'''
-    def generatePrompt(self, workout_data):
-        print("[INFO]: Creating Prompt")
-        #For serializers
-        prompt = prompt_start
-        for key in workout_keys:
-            val = workout_data.get(key)
-            prompt += str(key) + ": " + str(val) + "\n"
-        #For objects
-        for key in health_keys:
-            val = getattr(self.health_obj, key)
-            prompt += str(key) + ": " + str(val) + "\n"
-
-        prompt += prompt_end
-        return prompt
-    
-    def generateRecommendation(self, workout_list):
-        print("[INFO]: Creating Recommendation")
-        prompt = reco_start + str(workout_list) + '\n' + reco_end
-        response = self.model.generate_content(prompt)
-        return response.candidates[0].content.parts[0].text
-
-
-
-
-
+        #Search for recos from today, usually precomputed by python manage.py precompute_recommendations
+        day = timezone.localdate()
+        response = foundRecommendation(request, day)
+        if response is not None:
+            return response
 
+        #If not reco for today, create one from the last N workouts
+        llm = LlmConnection(use_cache = requestAllowsCache(request), user = request.user, endpoint = requestEndpoint(request))
+        # Rate limited once it is known this request generates it, not while waiting on another one that does
+        throttle = LlmThrottle(request.user, 'recommendation')
+        recommendation, failed = generateWithin(None, 'Recommendation', lambda: createRecommendation(request.user, day, llm, throttle))
+        if failed is not None:
+            return failed
+        return recommendationResponse(recommendation)
 
 
+class LlmUsageTopView(APIView):
+    permission_classes = [IsAuthenticated, IsAccessToken, IsAdminUser] # Staff only
 
+    '''Users with the most llm tokens over the last ?days= days, from the totals of python manage.py rollup_llm_usage'''
+    def get(self, request):
+        query = TopConsumersQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = query.validated_data
+        return Response({"days": params['days'], "users": topConsumers(params['days'], params['limit'])}, status=status.HTTP_200_OK)